@@ -1,18 +1,54 @@
 # coding=utf-8
 import collections
+try:
+    from collections.abc import Mapping
+except ImportError:  # Python 2.7
+    from collections import Mapping
+import random
+import time
 
 Vector = collections.namedtuple('Vector', ['dx', 'dy'])
 
 Square = collections.namedtuple('Square', ['x', 'y'])
 
+# 一步完整走法: 起点格子、终点格子和特殊走法标志位
+Move = collections.namedtuple('Move', ['origin', 'destination', 'flags'])
+
+MOVE_CAPTURE = 0x01  # 吃子(包括吃过路兵)
+MOVE_DOUBLE_STEP = 0x02  # 兵第一次移动时冲锋走两格
+MOVE_EN_PASSANT = 0x04  # 吃过路兵, 被吃掉的兵不在终点格子上
+MOVE_CASTLING = 0x08  # 王車易位, 起点和终点是王的位置
+MOVE_PROMOTION = 0x10  # 兵升变, 升变后的单位类型为 PROMOTION_UNIT_TYPES[flags >> 5]
+
+_zobrist_keys = {}
+# load_units() 反复摆放局面时用到的缓存: 已经创建过的单位编码 UnitID(1), UnitID(2)...,
+# 以及 ((单位类型, 玩家编号), 格子) -> 局面哈希随机数
+_unit_ids = []
+_piece_keys = {}
+
+
+def zobrist_key(*parts):
+    """局面哈希用的 64 位随机数, 同一组参数在任何进程中得到的随机数都相同
+
+    :param parts: 例如 ('unit', 单位类型名, 玩家编号, x, y)
+    :rtype : int
+    """
+    try:
+        return _zobrist_keys[parts]
+    except KeyError:
+        key = _zobrist_keys[parts] = random.Random('zobrist:{!r}'.format(parts)).getrandbits(64)
+        return key
+
 
 class Unit(object):
+    __slots__ = ('owner', 'has_been_moved')  # 同时存在成千上万个单位, 不为每个实例创建 __dict__
+
     def __init__(self, owner):
         self.owner = owner  # 所属玩家
         self.has_been_moved = None  # None 表示未知棋子当前状态是否已经走过
 
 
-class GameArena:
+class GameArena(object):
     """模拟竞技场
     """
 
@@ -30,9 +66,31 @@ class GameArena:
         :param width: x 轴方向上棋盘的宽度(=xmax), 例如国际象棋棋盘为 8 路纵列, 中国象棋棋盘则为 9 路
         :param ranks: 横行数量(=ymax)
         """
+        self.__reset(width, ranks)
+
+    def __reset(self, width, ranks):
+        """清空竞技场的全部数据"""
         self.__unit_info_list = []  # 按单位的编码顺序存储所有战斗单位的信息(其中并不包括该单位所在位置), 初始状态为空列表, 通过编码查找. 单位死亡后仍然保留记录
         # 二维数组共 width*ranks 个格子, 记录每个空格被哪一个棋子占领, 全部初始化置零表示所有格子均无人占领:
         self.__battlefield = [[self.UnitID(0)] * width for y in range(ranks)]
+        # 实时维护的快照, 只记录有棋子的格子. 征募和移动棋子时同步更新, 查询走法时不再重新遍历棋盘:
+        self.__snapshot = SnapshotBuilder((width, ranks)).snapshot
+        self.__attack_map = AttackMap(self.__snapshot)  # 各玩家的攻击计数表, 随快照增量更新
+        # 以下索引只记录棋盘上的单位, 与 __battlefield 同步更新:
+        self.__survivors = {}  # 单位编码 -> 所在格子 Square
+        self.__units_of_player = {}  # 玩家编号 -> 该玩家棋盘上所有单位编码的集合
+        self.__units_of_type = {}  # 单位类型 -> 该类型棋盘上所有单位编码的集合
+        self.__captured_units = []  # 按被吃掉的先后顺序记录离开棋盘的单位编码
+        self.__en_passant = None  # 上一步兵冲锋走两格时记录为 (越过的格子, 该兵的单位编码), 否则为 None
+        self.__players = []  # 按编号从小到大排列的全部玩家, 编号最小的玩家先走
+        self.__side_to_move = None  # 当前轮到走棋的玩家, None 表示尚未征募任何单位
+        self.__halfmove_clock = 0  # 自上一次吃子或走兵以来的半回合数
+        self.__fullmove_number = 1  # 回合数, 每轮到编号最小的玩家走棋时加一
+        self.__undo_stack = []  # make_move() 压栈, unmake_move() 出栈
+        # 局面哈希分两部分增量维护: 棋子部分在棋子离开或放上格子时异或更新,
+        # 状态部分(轮到哪名玩家走棋、王車易位权利、吃过路兵的纵列)在状态改变时重新计算
+        self.__piece_hash = 0
+        self.__state_hash = 0
 
     @property
     def size(self):
@@ -59,42 +117,159 @@ class GameArena:
         self.__unit_info_list.append(unit)
         unit_id = self.UnitID(len(self.__unit_info_list))
         unit.has_been_moved = False
+        if player_id not in self.__units_of_player:
+            self.__units_of_player[player_id] = set()
+            self.__players = sorted(self.__units_of_player)
+            if self.__side_to_move is None:
+                self.__side_to_move = player_id
+        self.__units_of_type.setdefault(unit_type, set())
         if square:
             x, y = square[0], square[1]
             xmax, ymax = self.size
             if x < 0 or y < 0 or x >= xmax or y >= ymax:
                 raise ValueError('invalid square:{}'.format(square))
-            self.__battlefield[y][x] = unit_id
-            # self.__survivors[unit_id] = Square(x, y)
+            self.__place_unit_on_square(unit_id, square)
+        self.__refresh_state_hash()
         return unit_id
 
+    def load_units(self, units, side_to_move=None):
+        """清空竞技场, 然后一次摆放好全部单位(例如按照棋谱摆放局面), 比逐个调用 new_unit_recruited_by_player() 快:
+        全部单位就位以后才计算各单位的火力范围, 局面哈希也只计算一次. 同一个竞技场可以反复调用, 不必重新创建,
+        此时上一个局面的单位实例会被回收重用
+
+        :param units: 可迭代对象, 每个元素为 (玩家编号, 格子, 单位类型, 是否移动过)
+        :param side_to_move: 轮到走棋的玩家, None 表示编号最小的玩家
+        :return: 按 units 的顺序分配的单位编码
+        :rtype : list
+        """
+        xmax, ymax = self.size
+        # 上一个局面的单位实例按 (类型, 玩家) 留作备用, 重新摆放时优先取用, 省去构造单位的开销
+        spare = {}
+        for unit in self.__unit_info_list:
+            spare.setdefault((type(unit), unit.owner), []).append(unit)
+        self.__reset(xmax, ymax)
+        unit_ids = []
+        placed = []
+        # 循环中用到的属性先取到局部变量里
+        unit_info_list, battlefield, snapshot, survivors = (self.__unit_info_list, self.__battlefield,
+                                                            self.__snapshot, self.__survivors)
+        units_of_player, units_of_type = self.__units_of_player, self.__units_of_type
+        unit_id_cache, piece_keys, node_type = _unit_ids, _piece_keys, Snapshot.Node
+        piece_hash = 0
+        for player_id, square, unit_type, has_been_moved in units:
+            x, y = square[0], square[1]
+            if x < 0 or y < 0 or x >= xmax or y >= ymax:
+                raise ValueError('invalid square:{}'.format(square))
+            row = battlefield[y]
+            if row[x]:
+                raise ValueError('square:{} is already occupied'.format(square))
+            owner = (unit_type, player_id)
+            reusable = spare.get(owner)
+            unit = reusable.pop() if reusable else unit_type(owner=player_id)
+            unit.has_been_moved = has_been_moved
+            unit_info_list.append(unit)
+            index = len(unit_info_list)
+            if index <= len(unit_id_cache):
+                unit_id = unit_id_cache[index - 1]
+            else:  # 编码从 1 开始连续分配, 缓存里缺的一定是下一个
+                unit_id = self.UnitID(index)
+                unit_id_cache.append(unit_id)
+            if type(square) is not Square:
+                square = Square(x, y)
+            piece_key = piece_keys.get((owner, square))
+            if piece_key is None:
+                piece_key = piece_keys[(owner, square)] = zobrist_key('unit', unit_type.__name__, player_id, x, y)
+            piece_hash ^= piece_key
+            row[x] = unit_id
+            snapshot[square] = node_type(unit_id, unit)
+            survivors[unit_id] = square
+            players_units = units_of_player.get(player_id)
+            if players_units is None:
+                players_units = units_of_player[player_id] = set()
+            players_units.add(unit_id)
+            type_units = units_of_type.get(unit_type)
+            if type_units is None:
+                type_units = units_of_type[unit_type] = set()
+            type_units.add(unit_id)
+            unit_ids.append(unit_id)
+            placed.append((unit_id, unit, square))
+        self.__piece_hash = piece_hash
+        self.__attack_map.add_units(placed)
+        self.__players = sorted(self.__units_of_player)
+        self.__side_to_move = side_to_move if side_to_move is not None else (self.__players or [None])[0]
+        self.__refresh_state_hash()
+        return unit_ids
+
     def owner_of_unit(self, unit_id):
         if not self.is_valid_unit_id(unit_id):
             raise ValueError('unit_id:{} not exists'.format(unit_id))
         return self.__unit_info_list[unit_id - 1].owner
 
+    def type_of_unit(self, unit_id):
+        """查询单位的类型(兵升变后为升变后的类型)
+
+        :rtype : type
+        """
+        if not self.is_valid_unit_id(unit_id):
+            raise ValueError('unit_id:{} not exists'.format(unit_id))
+        return type(self.__unit_info_list[unit_id - 1])
+
+    def __lift_unit(self, unit_id):
+        """把棋盘上的单位拿起来(离开棋盘), 同步更新快照和各项索引
+
+        :return: 单位原来所在的格子
+        :rtype : Square
+        """
+        square = self.__survivors.pop(unit_id)
+        unit = self.__unit_info_list[unit_id - 1]
+        self.__piece_hash ^= zobrist_key('unit', type(unit).__name__, unit.owner, square.x, square.y)
+        self.__battlefield[square.y][square.x] = self.UnitID(0)
+        del self.__snapshot[square]
+        self.__attack_map.remove_unit(unit_id)
+        self.__units_of_player[unit.owner].discard(unit_id)
+        self.__units_of_type[type(unit)].discard(unit_id)
+        return square
+
+    def __drop_unit(self, unit_id, square):
+        """把不在棋盘上的单位放到空格 square 上, 同步更新快照和各项索引"""
+        square = Square(square[0], square[1])
+        unit = self.__unit_info_list[unit_id - 1]
+        self.__piece_hash ^= zobrist_key('unit', type(unit).__name__, unit.owner, square.x, square.y)
+        self.__battlefield[square.y][square.x] = unit_id
+        self.__snapshot[square] = Snapshot.Node(unit_id, unit_instance=unit)
+        self.__attack_map.add_unit(unit_id, unit, square)
+        self.__survivors[unit_id] = square
+        self.__units_of_player[unit.owner].add(unit_id)
+        self.__units_of_type.setdefault(type(unit), set()).add(unit_id)
+
     def __place_unit_on_square(self, unit_id, square):
         """放置棋子(即移动或者复活棋子, 但该函数不能将棋子本身从棋盘上拿走)
 
         如果指定的单位已经死亡则将其复活并放入战场, 强制杀死指定位置上原有的单位无论是否是己方单位
+
+        :return: 被杀死的单位编码, 0 表示目标格原本是空格
+        :rtype : GameArena.UnitID
         """
         x, y = square[0], square[1]
-        try:
-            # 进行移动前, 先尝试寻找该棋子移动前的位置信息
-            square_before_move = self.find_square_from_unit_id(unit_id)
-        except ValueError:
-            # 这种情况没有“脚印”即不需要擦除
-            pass
-        else:  # 擦除脚印
-            self.__battlefield[square_before_move.y][square_before_move.x] = self.UnitID(0)
+        victim_id = self.__battlefield[y][x]
+        if victim_id == unit_id:
+            return self.UnitID(0)  # 原地不动
+        if victim_id:
+            self.__lift_unit(victim_id)
+            self.__captured_units.append(victim_id)
+        if unit_id in self.__survivors:  # 擦除脚印, 棋子不在棋盘上时没有“脚印”即不需要擦除
+            self.__lift_unit(unit_id)
         # 然后再将棋子放置到新位置
-        self.__battlefield[y][x] = unit_id
+        self.__drop_unit(unit_id, square)
+        return victim_id
 
     def move_unit_to_somewhere(self, unit_id, square):
         """移动棋子
 
         :param unit_id: 单位编码
         :param square: 目的地坐标
+        :return: 被吃掉的单位编码, 0 表示没有吃子
+        :rtype : GameArena.UnitID
         """
         if not self.is_valid_unit_id(unit_id):
             raise ValueError('unit_id:{} does not exist'.format(unit_id))
@@ -102,8 +277,202 @@ class GameArena:
         xmax, ymax = self.size
         if x < 0 or y < 0 or x >= xmax or y >= ymax:
             raise ValueError('invalid square:{}'.format(square))
-        self.__place_unit_on_square(unit_id, square)
-        self.__unit_info_list[unit_id - 1].has_been_moved = True
+        unit = self.__unit_info_list[unit_id - 1]
+        origin = self.__survivors.get(unit_id)
+        victim_id = self.__place_unit_on_square(unit_id, square)
+        unit.has_been_moved = True
+        self.__en_passant = None
+        if isinstance(unit, AbstractPawnUnit) and origin is not None and origin.x == x and abs(origin.y - y) == 2:
+            self.__en_passant = (Square(x, (origin.y + y) // 2), unit_id)
+        self.__refresh_state_hash()
+        return victim_id
+
+    def mark_unit_moved(self, unit_id, has_been_moved=True):
+        """直接设置单位是否移动过(例如按照棋谱摆放局面时), 同时更新局面哈希中的王車易位权利"""
+        if not self.is_valid_unit_id(unit_id):
+            raise ValueError('unit_id:{} does not exist'.format(unit_id))
+        self.__unit_info_list[unit_id - 1].has_been_moved = has_been_moved
+        self.__refresh_state_hash()
+
+    def is_unit_moved(self, unit_id):
+        """单位是否移动过(王車易位和兵冲锋走两格的条件)
+
+        :rtype : bool
+        """
+        if not self.is_valid_unit_id(unit_id):
+            raise ValueError('unit_id:{} does not exist'.format(unit_id))
+        return self.__unit_info_list[unit_id - 1].has_been_moved
+
+    @property
+    def position_hash(self):
+        """64 位局面哈希, 包括每个棋子的类型、所属玩家和位置, 以及轮到哪名玩家走棋、王車易位权利和吃过路兵的纵列
+
+        :rtype : int
+        """
+        return self.__piece_hash ^ self.__state_hash
+
+    def __refresh_state_hash(self):
+        state_hash = 0
+        if self.__side_to_move is not None:
+            state_hash ^= zobrist_key('side', self.__side_to_move)
+        if self.__en_passant is not None:
+            state_hash ^= zobrist_key('en_passant', self.__en_passant[0].x)
+        # 王車易位权利: 没有移动过的王与同一横行上没有移动过的己方車
+        for king_id in self.__units_of_type.get(KingUnit, ()):
+            king = self.__unit_info_list[king_id - 1]
+            if king.has_been_moved:
+                continue
+            king_square = self.__survivors[king_id]
+            for rook_id in self.__units_of_type.get(RookUnit, ()):
+                rook = self.__unit_info_list[rook_id - 1]
+                rook_square = self.__survivors[rook_id]
+                if rook.owner == king.owner and not rook.has_been_moved and rook_square.y == king_square.y:
+                    state_hash ^= zobrist_key('castling', rook.owner, rook_square.x, rook_square.y)
+        self.__state_hash = state_hash
+
+    @property
+    def side_to_move(self):
+        """当前轮到走棋的玩家编号, make_move() 之后自动轮换到下一名玩家
+
+        :rtype : GameArena.PlayerID
+        """
+        return self.__side_to_move
+
+    @side_to_move.setter
+    def side_to_move(self, player_id):
+        self.__side_to_move = player_id
+        self.__refresh_state_hash()
+
+    def next_player(self, player_id):
+        """按玩家编号从小到大循环, 排在 player_id 之后的玩家
+
+        :rtype : GameArena.PlayerID
+        """
+        i = self.__players.index(player_id)
+        return self.__players[(i + 1) % len(self.__players)]
+
+    @property
+    def players(self):
+        """按编号从小到大排列的全部玩家
+
+        :rtype : tuple
+        """
+        return tuple(self.__players)
+
+    @property
+    def halfmove_clock(self):
+        """自上一次吃子或走兵以来的半回合数
+
+        :rtype : int
+        """
+        return self.__halfmove_clock
+
+    @halfmove_clock.setter
+    def halfmove_clock(self, value):
+        self.__halfmove_clock = value
+
+    @property
+    def fullmove_number(self):
+        """回合数, 从 1 开始, 每轮到编号最小的玩家走棋时加一
+
+        :rtype : int
+        """
+        return self.__fullmove_number
+
+    @fullmove_number.setter
+    def fullmove_number(self, value):
+        self.__fullmove_number = value
+
+    @property
+    def ply(self):
+        """make_move() 之后还没有撤销的走法数量
+
+        :rtype : int
+        """
+        return len(self.__undo_stack)
+
+    def make_move(self, move):
+        """走一步棋(包括王車易位、吃过路兵、兵升变等特殊走法), 同时把恢复局面所需的信息压入撤销栈
+
+        这里不检查走法是否合法, 调用者应当只传入 retrieve_legal_moves_of_player() 生成的走法
+
+        :param move: Move(origin, destination, flags)
+        :return: 被吃掉的单位编码, 0 表示没有吃子
+        :rtype : GameArena.UnitID
+        """
+        origin, destination, flags = move
+        unit_id = self.__battlefield[origin[1]][origin[0]]
+        if not unit_id:
+            raise ValueError('no unit on square:{}'.format(origin))
+        unit = self.__unit_info_list[unit_id - 1]
+        has_been_moved = unit.has_been_moved
+        if flags & MOVE_EN_PASSANT:
+            victim_id = self.__en_passant[1]
+        else:
+            victim_id = self.__battlefield[destination[1]][destination[0]]
+        victim_square = None
+        if victim_id:
+            victim_square = self.__lift_unit(victim_id)
+            self.__captured_units.append(victim_id)
+        rook_id, rook_square, rook_has_been_moved = 0, None, None
+        if flags & MOVE_CASTLING:
+            # 王与車之间没有其他棋子, 朝王移动的方向找到的第一个单位就是参与易位的車
+            step = 1 if destination[0] > origin[0] else -1
+            x = origin[0] + step
+            while not self.__battlefield[origin[1]][x]:
+                x += step
+            rook_id = self.__battlefield[origin[1]][x]
+            rook = self.__unit_info_list[rook_id - 1]
+            rook_square, rook_has_been_moved = self.__lift_unit(rook_id), rook.has_been_moved
+        self.__lift_unit(unit_id)
+        promoted_from = None
+        if flags & MOVE_PROMOTION:
+            promoted_from = unit
+            unit = PROMOTION_UNIT_TYPES[flags >> 5](owner=promoted_from.owner)
+            self.__unit_info_list[unit_id - 1] = unit
+        self.__drop_unit(unit_id, destination)
+        if rook_id:
+            self.__drop_unit(rook_id, Square(origin[0] + step, origin[1]))
+            self.__unit_info_list[rook_id - 1].has_been_moved = True
+        self.__undo_stack.append((move, unit_id, promoted_from or unit, has_been_moved,
+                                  victim_id, victim_square, rook_id, rook_square, rook_has_been_moved,
+                                  self.__en_passant, self.__side_to_move, self.__halfmove_clock, self.__state_hash))
+        unit.has_been_moved = True
+        self.__en_passant = None
+        if flags & MOVE_DOUBLE_STEP:
+            self.__en_passant = (Square(origin[0], (origin[1] + destination[1]) // 2), unit_id)
+        if victim_id or isinstance(promoted_from or unit, AbstractPawnUnit):
+            self.__halfmove_clock = 0
+        else:
+            self.__halfmove_clock += 1
+        self.__side_to_move = self.next_player(unit.owner)
+        if self.__side_to_move == self.__players[0]:
+            self.__fullmove_number += 1
+        self.__refresh_state_hash()
+        return victim_id
+
+    def unmake_move(self):
+        """撤销最近一次 make_move(), 恢复之前的局面
+
+        :return: 被撤销的走法
+        :rtype : Move
+        """
+        if self.__side_to_move == self.__players[0]:
+            self.__fullmove_number -= 1
+        (move, unit_id, unit, has_been_moved, victim_id, victim_square, rook_id, rook_square, rook_has_been_moved,
+         self.__en_passant, self.__side_to_move, self.__halfmove_clock, self.__state_hash) = self.__undo_stack.pop()
+        self.__lift_unit(unit_id)
+        self.__unit_info_list[unit_id - 1] = unit  # 兵升变时恢复原来的兵
+        unit.has_been_moved = has_been_moved
+        self.__drop_unit(unit_id, move[0])
+        if rook_id:
+            self.__lift_unit(rook_id)
+            self.__drop_unit(rook_id, rook_square)
+            self.__unit_info_list[rook_id - 1].has_been_moved = rook_has_been_moved
+        if victim_id:
+            self.__drop_unit(victim_id, victim_square)
+            self.__captured_units.pop()
+        return move
 
     def is_valid_unit_id(self, unit_id):
         """unit_id 编码检查, 这里不区分是否已经死亡, 只要单位曾经存在即为有效 ID, unit_id=0 时无效
@@ -128,20 +497,346 @@ class GameArena:
         unit = self.__unit_info_list[unit_id - 1]
         return unit.retrieve_valid_moves(starting_square=square, snapshot=self.__take_snapshot())
 
+    def retrieve_legal_moves_of_player(self, player_id, captures=None, unit_types=None):
+        """一次性生成玩家全部合法走法, 所有棋子共用同一份快照视图
+
+        除了每个棋子自己的走法规则以外, 还会排除走完后己方王被将军的走法(牵制、应将),
+        并补充王車易位、吃过路兵和兵升变(每种升变类型各算一步走法)
+
+        :param player_id: 玩家编号
+        :param captures: None 表示全部走法; True 只要吃子和升变; False 只要其余的走法(用于分阶段生成走法)
+        :param unit_types: 可选, 只生成这些类型的单位的走法(例如解析 SAN 记法时已知走棋的单位类型)
+        :return: Move(origin, destination, flags) 组成的 tuple
+        :rtype : tuple
+        """
+        snapshot = self.__take_snapshot()
+        king_id = self.__king_of_player(player_id)
+        checkers = ()
+        pins = {}
+        evasion_squares = None  # 被将军时非王棋子只能走到这些格子(吃掉将军的棋子或者挡住火力线)
+        if king_id:
+            king_square = self.__survivors[king_id]
+            checkers = [unit_id for unit_id in self.__attack_map.attackers_of(king_square)
+                        if self.__unit_info_list[unit_id - 1].owner != player_id]
+            pins = self.__find_pins(king_square, player_id)
+            if len(checkers) == 1:
+                evasion_squares = set(self.__squares_between(checkers[0], king_square))
+                evasion_squares.add(self.__survivors[checkers[0]])
+        result = []
+        occupied = self.__snapshot
+        for unit_id in sorted(self.__units_of_player.get(player_id, ())):
+            if len(checkers) > 1 and unit_id != king_id:
+                continue  # 双将时只能走王
+            unit = self.__unit_info_list[unit_id - 1]
+            if unit_types is not None and type(unit) not in unit_types:
+                continue
+            origin = self.__survivors[unit_id]
+            allowed = pins.get(unit_id)
+            if captures is True and type(unit) in CAPTURE_FROM_ATTACK_MAP_TYPES:
+                # 只要吃子时, 車、象、后、马的吃子目标就是攻击计数表中火力范围内的敌方棋子, 不必重新生成走法
+                destinations = [target for target in self.__attack_map.shooting_range_of(unit_id)
+                                if target in occupied and occupied[target].unit.owner != player_id]
+            else:
+                destinations = unit.retrieve_valid_moves(starting_square=origin, snapshot=snapshot)
+            for destination in destinations:
+                if unit_id != king_id:
+                    if allowed is not None and destination not in allowed:
+                        continue  # 被牵制的棋子只能沿牵制线移动
+                    if evasion_squares is not None and destination not in evasion_squares:
+                        continue
+                flags = MOVE_CAPTURE if destination in occupied else 0
+                if isinstance(unit, AbstractPawnUnit):
+                    if abs(destination.y - origin.y) == 2:
+                        flags |= MOVE_DOUBLE_STEP
+                    if not 0 <= destination.y + unit.pawn_charge_direction.dy < snapshot.ymax:
+                        if captures is not False:
+                            for i in range(len(PROMOTION_UNIT_TYPES)):
+                                result.append(Move(origin, destination, flags | MOVE_PROMOTION | i << 5))
+                        continue
+                if captures is None or captures == bool(flags & MOVE_CAPTURE):
+                    result.append(Move(origin, destination, flags))
+        if king_id and not checkers and captures is not True and (unit_types is None or KingUnit in unit_types):
+            result += self.__castling_moves(king_id)
+        if self.__en_passant is not None and captures is not False and (
+                unit_types is None or WhitePawnUnit in unit_types or BlackPawnUnit in unit_types):
+            result += self.__en_passant_moves(player_id, king_id)
+        return tuple(result)
+
+    def is_legal_move(self, unit_id, square, special_moves=True):
+        """单位能否合法地走到 square 格子(与 retrieve_legal_moves_of_player() 的结果一致, 但不生成全部走法):
+        只检查这一个单位, 逐个生成它的可达格子, 找到 square 就立即返回
+
+        :param unit_id: 单位编码
+        :param square: 目的地坐标
+        :param special_moves: 为 False 时王車易位和吃过路兵不算在内
+        :rtype : bool
+        """
+        origin = self.__survivors.get(unit_id)
+        if origin is None:
+            return False  # 不存在或者不在棋盘上
+        xmax, ymax = self.size
+        x, y = square[0], square[1]
+        if x < 0 or y < 0 or x >= xmax or y >= ymax:
+            return False
+        target = Square(x, y)
+        unit = self.__unit_info_list[unit_id - 1]
+        occupant = self.__battlefield[y][x]
+        if occupant and self.__unit_info_list[occupant - 1].owner == unit.owner:
+            return False
+        snapshot = self.__take_snapshot()
+        king_id = self.__king_of_player(unit.owner)
+        if unit_id == king_id:
+            if target in unit.iter_valid_moves(origin, snapshot):
+                return True
+            return special_moves and abs(x - origin.x) == 2 and y == origin.y and not self.is_in_check(unit.owner) and \
+                any(move.destination == target for move in self.__castling_moves(king_id))
+        if king_id:
+            king_square = self.__survivors[king_id]
+            checkers = [checker_id for checker_id in self.__attack_map.attackers_of(king_square)
+                        if self.__unit_info_list[checker_id - 1].owner != unit.owner]
+            if len(checkers) > 1:
+                return False  # 双将时只能走王
+            allowed = self.__find_pins(king_square, unit.owner).get(unit_id)
+            if allowed is not None and target not in allowed:
+                return False  # 被牵制的棋子只能沿牵制线移动
+            if checkers and target not in self.__squares_between(checkers[0], king_square) and \
+                    target != self.__survivors[checkers[0]]:
+                # 吃过路兵吃掉将军的兵时终点不在上面这些格子里, 交给下面单独判断
+                return special_moves and self.__is_en_passant_target(unit_id, target)
+        if target in unit.iter_valid_moves(origin, snapshot):
+            return True
+        return special_moves and self.__is_en_passant_target(unit_id, target)
+
+    def __is_en_passant_target(self, unit_id, target):
+        if self.__en_passant is None or self.__en_passant[0] != target:
+            return False
+        if not isinstance(self.__unit_info_list[unit_id - 1], AbstractPawnUnit):
+            return False
+        player_id = self.__unit_info_list[unit_id - 1].owner
+        origin = self.__survivors[unit_id]
+        return any(move.origin == origin
+                   for move in self.__en_passant_moves(player_id, self.__king_of_player(player_id)))
+
+    def is_in_check(self, player_id):
+        """玩家的王当前是否正被将军, 没有王的玩家永远不会被将军
+
+        :rtype : bool
+        """
+        king_id = self.__king_of_player(player_id)
+        if not king_id:
+            return False
+        return self.__attack_map.is_attacked_by_enemy(self.__survivors[king_id], player_id)
+
+    @property
+    def en_passant_square(self):
+        """上一步兵冲锋越过的格子(对方可以在这里吃过路兵), 没有时为 None
+
+        :rtype : Square
+        """
+        return self.__en_passant[0] if self.__en_passant else None
+
+    @en_passant_square.setter
+    def en_passant_square(self, square):
+        """直接设置可以吃过路兵的格子(例如按照棋谱摆放局面时), 上一步冲锋的兵必须紧挨着该格子"""
+        self.__en_passant = None
+        if square is not None:
+            square = Square(square[0], square[1])
+            for dy in (-1, 1):
+                try:
+                    unit_id = self.unit_on_square((square.x, square.y + dy))
+                except ValueError:
+                    continue
+                unit = self.__unit_info_list[unit_id - 1] if unit_id else None
+                if isinstance(unit, AbstractPawnUnit) and unit.pawn_charge_direction.dy == dy:
+                    self.__en_passant = (square, unit_id)
+                    break
+            else:
+                raise ValueError('no pawn can be captured en passant on square:{}'.format(square))
+        self.__refresh_state_hash()
+
+    def __king_of_player(self, player_id):
+        for unit_id in self.__units_of_type.get(KingUnit, ()):
+            if self.__unit_info_list[unit_id - 1].owner == player_id:
+                return unit_id
+        return self.UnitID(0)
+
+    def __squares_between(self, unit_id, target):
+        """沿直线行进的单位与它攻击的目标之间的格子(不含两端), 其他单位没有这样的格子
+
+        :rtype : tuple
+        """
+        unit = self.__unit_info_list[unit_id - 1]
+        if not AttackMap.is_sliding_unit(unit):
+            return ()
+        xmax, ymax = self.size
+        table = RayTable.of(xmax, ymax, unit.directions, unit.limited_move_range)
+        for ray in table.rays_from(self.__survivors[unit_id]):
+            if target in ray:
+                return ray[:ray.index(target)]
+        return ()
+
+    def __find_pins(self, king_square, player_id):
+        """找出被敌方沿直线行进的单位牵制住的己方棋子
+
+        :return: 被牵制的单位编码 -> 该单位还可以走到的格子集合(王与牵制者之间的格子, 以及牵制者所在格子)
+        :rtype : dict
+        """
+        pins = {}
+        xmax, ymax = self.size
+        table = RayTable.of(xmax, ymax, ALL_DIRECTIONS, 0)
+        for (dx, dy), ray in zip(ALL_DIRECTIONS, table.rays_from(king_square)):
+            shield_id = 0
+            for distance, square in enumerate(ray, 1):
+                unit_id = self.__battlefield[square.y][square.x]
+                if not unit_id:
+                    continue
+                unit = self.__unit_info_list[unit_id - 1]
+                if unit.owner == player_id:
+                    if shield_id:
+                        break  # 中间隔着两个己方棋子, 不构成牵制
+                    shield_id = unit_id
+                    continue
+                if shield_id and AttackMap.is_sliding_unit(unit) and (-dx, -dy) in unit.directions and \
+                        (unit.limited_move_range <= 0 or unit.limited_move_range >= distance):
+                    pins[shield_id] = set(ray[:distance])
+                break
+        return pins
+
+    def __castling_moves(self, king_id):
+        """王車易位: 王和車都没有移动过, 两者之间没有其他棋子, 王不能正被将军, 途经的格子和终点不能处于敌方火力范围
+
+        王朝車的方向走两格, 車越过王停在王途经的格子上
+        """
+        king = self.__unit_info_list[king_id - 1]
+        if king.has_been_moved:
+            return []
+        king_square = self.__survivors[king_id]
+        xmax = self.size[0]
+        result = []
+        for rook_id in self.__units_of_type.get(RookUnit, ()):
+            rook = self.__unit_info_list[rook_id - 1]
+            rook_square = self.__survivors[rook_id]
+            if rook.owner != king.owner or rook.has_been_moved or rook_square.y != king_square.y:
+                continue
+            step = 1 if rook_square.x > king_square.x else -1
+            if abs(rook_square.x - king_square.x) < 3:
+                continue
+            if any(self.__battlefield[king_square.y][x] for x in range(king_square.x + step, rook_square.x, step)):
+                continue
+            path = [Square(king_square.x + step, king_square.y), Square(king_square.x + 2 * step, king_square.y)]
+            if any(self.__attack_map.is_attacked_by_enemy(square, king.owner) for square in path):
+                continue
+            result.append(Move(king_square, path[1], MOVE_CASTLING))
+        return result
+
+    def __en_passant_moves(self, player_id, king_id):
+        """吃过路兵. 被吃掉的兵不在终点格子上, 所以逐一试走一遍再检查己方王是否被将军"""
+        target, victim_id = self.__en_passant
+        victim_square = self.__survivors.get(victim_id)
+        if victim_square is None or self.__unit_info_list[victim_id - 1].owner == player_id:
+            return []
+        if target in self.__snapshot:
+            return []
+        result = []
+        snapshot = self.__take_snapshot()
+        for unit_id in sorted(self.__units_of_player.get(player_id, ())):
+            unit = self.__unit_info_list[unit_id - 1]
+            if not isinstance(unit, AbstractPawnUnit):
+                continue
+            origin = self.__survivors[unit_id]
+            if target not in unit.retrieve_squares_within_shooting_range(origin, snapshot):
+                continue
+            self.__lift_unit(victim_id)
+            self.__lift_unit(unit_id)
+            self.__drop_unit(unit_id, target)
+            safe = not king_id or not self.__attack_map.is_attacked_by_enemy(self.__survivors[king_id], player_id)
+            self.__lift_unit(unit_id)
+            self.__drop_unit(unit_id, origin)
+            self.__drop_unit(victim_id, victim_square)
+            if safe:
+                result.append(Move(origin, target, MOVE_CAPTURE | MOVE_EN_PASSANT))
+        return result
+
     def find_square_from_unit_id(self, unit_id):
-        """搜索特定棋子编码的棋子如果在棋盘上则返回坐标, 否则向上传递一个 ValueError 表示没找到
+        """查询特定棋子编码的棋子如果在棋盘上则返回坐标, 否则向上传递一个 ValueError 表示没找到
 
         :param unit_id:
         :rtype : Square
         """
         if not self.is_valid_unit_id(unit_id):
             raise ValueError('Error: invalid unit_id:{}'.format(unit_id))
-        for y in range(len(self.__battlefield)):
-            rank = self.__battlefield[y]
-            for x in range(len(rank)):
-                if unit_id == rank[x]:
-                    return Square(x, y)
-        raise ValueError('Note: unit_id:{} is not on chessboard'.format(unit_id))
+        try:
+            return self.__survivors[unit_id]
+        except KeyError:
+            raise ValueError('Note: unit_id:{} is not on chessboard'.format(unit_id))
+
+    def unit_on_square(self, square):
+        """查询格子上的单位编码, 0 表示空格
+
+        :rtype : GameArena.UnitID
+        """
+        x, y = square[0], square[1]
+        xmax, ymax = self.size
+        if x < 0 or y < 0 or x >= xmax or y >= ymax:
+            raise ValueError('invalid square:{}'.format(square))
+        return self.__battlefield[y][x]
+
+    def units_of_player(self, player_id):
+        """玩家在棋盘上的全部单位编码
+
+        :rtype : tuple
+        """
+        return tuple(self.__units_of_player.get(player_id, ()))
+
+    def placements_of_player(self, player_id):
+        """玩家在棋盘上的全部单位的 (单位类型, 所在格子), 供评估函数逐个累加, 不必对每个单位编码分别查询
+
+        :rtype : list
+        """
+        units, survivors = self.__unit_info_list, self.__survivors
+        return [(type(units[unit_id - 1]), survivors[unit_id]) for unit_id in self.__units_of_player.get(player_id, ())]
+
+    def square_vector(self, unit_codes):
+        """把棋盘导出为按格子编号(y*宽度+x)排列的字节串, 用于批量处理(例如 numpy.frombuffer)
+
+        :param unit_codes: 字典 (玩家, 单位类型) -> 1~255 的编码, 空格子为 0
+        :rtype : bytearray
+        """
+        xmax, ymax = self.size
+        vector = bytearray(xmax * ymax)
+        for unit_id, (x, y) in self.__survivors.items():
+            unit = self.__unit_info_list[unit_id - 1]
+            vector[y * xmax + x] = unit_codes[(unit.owner, type(unit))]
+        return vector
+
+    def units_of_type(self, unit_type):
+        """棋盘上某种类型(不含子类)的全部单位编码, 不区分玩家
+
+        :rtype : tuple
+        """
+        return tuple(self.__units_of_type.get(unit_type, ()))
+
+    def is_square_attacked(self, square, by_player):
+        """格子是否处于玩家 by_player 的火力范围内(查表, 不重新计算火力线)
+
+        :rtype : bool
+        """
+        return self.__attack_map.attack_count(Square(square[0], square[1]), by_player) > 0
+
+    def attack_count(self, square, by_player):
+        """格子被玩家 by_player 的多少个单位攻击
+
+        :rtype : int
+        """
+        return self.__attack_map.attack_count(Square(square[0], square[1]), by_player)
+
+    @property
+    def captured_units(self):
+        """已经被吃掉(离开棋盘)的单位编码, 按被吃掉的先后顺序排列
+
+        :rtype : tuple
+        """
+        return tuple(self.__captured_units)
 
     def is_occupied_square(self, square):
         x, y = square[0], square[1]
@@ -151,39 +846,91 @@ class GameArena:
         return self.__battlefield[y][x] > 0
 
     def __take_snapshot(self):
-        """遍历所有格子的信息, 生成一份快照"""
-        builder = SnapshotBuilder(self.size)
-        for y in range(len(self.__battlefield)):
-            rank = self.__battlefield[y]
-            for x in range(len(rank)):
-                unit_id = rank[x]
-                if unit_id > 0:
-                    unit = self.__unit_info_list[unit_id - 1]
-                else:
-                    unit = None
-                builder.set_node(x, y, unit_id, unit_instance=unit)
-        return builder.snapshot
+        """返回实时快照的只读视图, 不复制任何格子的信息
+
+        :rtype : SnapshotView
+        """
+        return SnapshotView(self.__snapshot, attack_map=self.__attack_map)
 
 
 class Snapshot(dict):
     xmax = 0
     ymax = 0
+    attack_map = None  # 与快照同步维护的 AttackMap, 没有时为 None
 
     def get_node(self, x, y):
-        try:
-            return self[Square(x, y)]
-        except KeyError:
-            if 0 <= x < self.xmax and 0 <= y < self.ymax:
-                return Snapshot.Node(unit_id=0, unit_instance=None)
-            # 否则上报一个 ValueError 异常:
-            raise ValueError('Error: x,y坐标越界: get_node(x={},y={})'.format(x, y))
+        node = self.get((x, y))  # 普通元组与 Square 的哈希值相同, 查找时不必构造 Square
+        if node is not None:
+            return node
+        if 0 <= x < self.xmax and 0 <= y < self.ymax:
+            return Snapshot.EMPTY_NODE
+        # 否则上报一个 ValueError 异常:
+        raise ValueError('Error: x,y坐标越界: get_node(x={},y={})'.format(x, y))
+
+    def excluding(self, square):
+        """返回一个不修改快照本身的只读视图, 视图中 square 格子被当作空格
+
+        :rtype : SnapshotView
+        """
+        return SnapshotView(self, hidden_squares=(square,))
+
+    class Node(object):
+        __slots__ = ('unit_id', 'unit')
 
-    class Node:
         def __init__(self, unit_id, unit_instance=None):
             self.unit_id = unit_id
             self.unit = unit_instance
 
 
+# 所有空格共用的节点, 只读
+Snapshot.EMPTY_NODE = Snapshot.Node(unit_id=0, unit_instance=None)
+
+
+class SnapshotView(Mapping):
+    """快照的只读视图
+
+    走法规则只通过 get()、get_node() 和 items() 读取快照, 所以多次查询可以共用同一份快照而不必各自复制,
+    需要假定某些格子为空时(例如计算王的逃跑路线)用 excluding() 叠加一层视图即可
+    """
+
+    def __init__(self, snapshot, hidden_squares=(), attack_map=None):
+        self.__snapshot = snapshot
+        self.__hidden_squares = hidden_squares  # 视图中被当作空格的格子
+        self.xmax = snapshot.xmax
+        self.ymax = snapshot.ymax
+        self.attack_map = attack_map  # 隐藏了格子的视图与攻击计数不再一致, 此时应为 None
+
+    def __getitem__(self, square):
+        if square in self.__hidden_squares:
+            raise KeyError(square)
+        return self.__snapshot[square]
+
+    def __iter__(self):
+        for square in self.__snapshot:
+            if square not in self.__hidden_squares:
+                yield square
+
+    def __len__(self):
+        return len(self.__snapshot) - sum(1 for square in self.__hidden_squares if square in self.__snapshot)
+
+    def get(self, square, default=None):
+        if square in self.__hidden_squares:
+            return default
+        return self.__snapshot.get(square, default)
+
+    def get_node(self, x, y):
+        if (x, y) in self.__hidden_squares:
+            return Snapshot.EMPTY_NODE
+        return self.__snapshot.get_node(x, y)
+
+    def excluding(self, square):
+        """在当前视图的基础上再隐藏一个格子
+
+        :rtype : SnapshotView
+        """
+        return SnapshotView(self.__snapshot, hidden_squares=self.__hidden_squares + (square,))
+
+
 class SnapshotBuilder:
     def __init__(self, size):
         self.__xmax, self.__ymax = size[0], size[1]
@@ -203,11 +950,222 @@ class SnapshotBuilder:
             raise ValueError('Error: 坐标越界: set_node(x={},y={})'.format(x, y))
 
 
+class RayTable(object):
+    """预先计算好的射线表, 每种 (xmax, ymax, directions, limited_move_range) 组合只建一张表
+
+    rays_from(square) 按 directions 的顺序给出每个方向上由近及远的全部格子, 走法生成时只需沿表中的格子前进直到遇见第一个棋子;
+    只走一步的棋子(王、马等)另有 targets_from(square) 直接给出全部目标格子.
+    每个起点的射线在第一次被查询时才计算, 所以超大棋盘也不必一次性建完整张表
+    """
+    __cache = {}
+
+    @classmethod
+    def of(cls, xmax, ymax, directions, limited_move_range):
+        """查找或新建一张射线表
+
+        :param directions: Vector 矢量组成的 tuple
+        :param limited_move_range: 0 或负数表示不限步数
+        :rtype : RayTable
+        """
+        key = (xmax, ymax, directions, limited_move_range if limited_move_range > 0 else 0)
+        table = cls.__cache.get(key)
+        if table is None:
+            table = cls.__cache[key] = cls(*key)
+        return table
+
+    def __init__(self, xmax, ymax, directions, limited_move_range):
+        self.xmax = xmax
+        self.ymax = ymax
+        self.directions = directions
+        self.limited_move_range = limited_move_range
+        # 同一张表内相同坐标的格子共用一个 Square 对象
+        self.__squares = [[Square(x, y) for y in range(ymax)] for x in range(xmax)]
+        self.__rays = {}
+        self.__targets = {}
+
+    def rays_from(self, square):
+        """各个方向上由近及远的射线, 每条射线是一个 Square 组成的 tuple
+
+        :rtype : tuple
+        """
+        try:
+            return self.__rays[square]
+        except KeyError:
+            pass
+        rays = []
+        for dx, dy in self.directions:
+            ray = []
+            x, y = square[0] + dx, square[1] + dy
+            while 0 <= x < self.xmax and 0 <= y < self.ymax:
+                if 0 < self.limited_move_range <= len(ray):
+                    break
+                ray.append(self.__squares[x][y])
+                x, y = x + dx, y + dy
+            rays.append(tuple(ray))
+        rays = self.__rays[square] = tuple(rays)
+        return rays
+
+    def targets_from(self, square):
+        """所有射线上的格子合并成一个 tuple, 只走一步的棋子不会被阻挡, 可以直接使用
+
+        :rtype : tuple
+        """
+        try:
+            return self.__targets[square]
+        except KeyError:
+            pass
+        targets = self.__targets[square] = tuple(s for ray in self.rays_from(square) for s in ray)
+        return targets
+
+
+class AttackMap(object):
+    """与实时快照同步维护的攻击计数表
+
+    记录每个单位当前的火力范围, 以及每个格子被哪些单位攻击.
+    某个格子上的棋子出现或消失时, 只有火力线经过(或止于)该格子的車、象、后等沿直线行进的单位需要重新计算,
+    其余单位的火力范围与棋盘上的棋子分布无关, 保持不变
+    """
+
+    def __init__(self, snapshot):
+        """
+        :param snapshot: 竞技场实时维护的快照, 由调用者负责在 add_unit()/remove_unit() 之前先行更新
+        """
+        self.__snapshot = snapshot
+        self.__units = {}  # 单位编码 -> (单位, 所在格子, 火力范围)
+        self.__attackers = {}  # 格子 -> 攻击该格子的单位编码集合, 各玩家的攻击数量由集合中的单位现场统计
+        self.__pending = []  # add_units() 加入、尚未计算火力范围的单位, 第一次查询时才计算
+
+    @staticmethod
+    def is_sliding_unit(unit):
+        """火力线是否可能被其他棋子阻挡"""
+        return isinstance(unit, StraightMovingAndAttackingUnit) and unit.limited_move_range != 1
+
+    def __attach(self, unit_id, unit, square):
+        shooting_range = unit.retrieve_squares_within_shooting_range(square, self.__snapshot)
+        self.__units[unit_id] = (unit, square, shooting_range)
+        attackers = self.__attackers
+        for target in shooting_range:
+            attacker_ids = attackers.get(target)
+            if attacker_ids is None:
+                attackers[target] = {unit_id}
+            else:
+                attacker_ids.add(unit_id)
+
+    def __detach(self, unit_id):
+        unit, square, shooting_range = self.__units.pop(unit_id)
+        attackers = self.__attackers
+        for target in shooting_range:
+            attackers[target].discard(unit_id)
+        return unit, square
+
+    def __refresh_sliding_attackers(self, square):
+        """格子 square 的占用状态改变后, 重新计算火力线经过该格子的沿直线行进的单位"""
+        for unit_id in tuple(self.__attackers.get(square, ())):
+            unit = self.__units[unit_id][0]
+            if self.is_sliding_unit(unit):
+                self.__attach(unit_id, *self.__detach(unit_id))
+
+    def __settle(self):
+        """计算 add_units() 加入的单位的火力范围"""
+        pending, self.__pending = self.__pending, []
+        for unit_id, unit, square in pending:
+            self.__attach(unit_id, unit, square)
+
+    def add_unit(self, unit_id, unit, square):
+        """单位已经被放到 square 格子上"""
+        if self.__pending:
+            self.__settle()
+        self.__refresh_sliding_attackers(square)
+        self.__attach(unit_id, unit, square)
+
+    def add_units(self, units):
+        """批量加入单位, 调用前全部单位都已经放到快照上, 因此不需要重新计算其他单位的火力线.
+        火力范围推迟到第一次查询或修改时才计算, 只摆放局面而不生成走法(例如批量读取 EPD 后只做评估)时完全省去这部分开销
+
+        :param units: 可迭代对象, 每个元素为 (单位编码, 单位, 所在格子)
+        """
+        self.__pending.extend(units)
+
+    def remove_unit(self, unit_id):
+        """单位已经从棋盘上离开"""
+        if self.__pending:
+            self.__settle()
+        square = self.__detach(unit_id)[1]
+        self.__refresh_sliding_attackers(square)
+
+    def attack_count(self, square, player_id):
+        """格子被玩家 player_id 的多少个单位攻击
+
+        :rtype : int
+        """
+        if self.__pending:
+            self.__settle()
+        units = self.__units
+        return sum(1 for unit_id in self.__attackers.get(square, ()) if units[unit_id][0].owner == player_id)
+
+    def is_attacked_by_enemy(self, square, player_id):
+        """格子是否处于玩家 player_id 以外其他任何玩家的火力范围内
+
+        :rtype : bool
+        """
+        if self.__pending:
+            self.__settle()
+        units = self.__units
+        for unit_id in self.__attackers.get(square, ()):
+            if units[unit_id][0].owner != player_id:
+                return True
+        return False
+
+    def attackers_of(self, square):
+        """攻击该格子的所有单位编码
+
+        :rtype : tuple
+        """
+        if self.__pending:
+            self.__settle()
+        return tuple(self.__attackers.get(square, ()))
+
+    def shooting_range_of(self, unit_id):
+        """单位当前的火力范围(不区分目标格子上是敌方还是己方的棋子)
+
+        :rtype : tuple
+        """
+        if self.__pending:
+            self.__settle()
+        return self.__units[unit_id][2]
+
+    def squares_behind(self, square, player_id):
+        """敌方沿直线行进的单位攻击 square 时, 火力线在 square 之后的下一个格子
+
+        square 上的棋子(通常是王)离开火力线方向时, 它原先挡住的这个格子同样处于火力范围内
+
+        :rtype : set
+        """
+        if self.__pending:
+            self.__settle()
+        result = set()
+        for unit_id in self.__attackers.get(square, ()):
+            unit, origin, shooting_range = self.__units[unit_id]
+            if unit.owner == player_id or not self.is_sliding_unit(unit):
+                continue
+            table = RayTable.of(self.__snapshot.xmax, self.__snapshot.ymax,
+                                unit.directions, unit.limited_move_range)
+            for ray in table.rays_from(origin):
+                if square in ray:
+                    i = ray.index(square) + 1
+                    if i < len(ray):
+                        result.add(ray[i])
+                    break
+        return result
+
+
 import abc
 
 
 class AbstractPawnUnit(Unit):
     __metaclass__ = abc.ABCMeta
+    __slots__ = ()
+    attack_directions = ()  # 斜吃的两个方向, 由子类按冲锋方向给出
 
     @abc.abstractproperty
     def pawn_charge_direction(self):
@@ -223,46 +1181,39 @@ class AbstractPawnUnit(Unit):
         self.has_been_moved = False  # 是否被移动过(兵第一次移动时可以进行冲锋走两格,之后只能沿棋盘纵列每步走一格)
 
     def retrieve_valid_moves(self, starting_square, snapshot):
-        """兵只直走和斜吃两种情况(吃过路兵功能未实现, 需要另外单独处理)
+        """兵只直走和斜吃两种情况(吃过路兵和升变由 GameArena.retrieve_legal_moves_of_player 单独处理)
 
         :param starting_square: 兵当前位置
         :param snapshot: 作战双方棋子的位置的一个快照
         :rtype : tuple
         """
-        result = []
+        return tuple(self.iter_valid_moves(starting_square, snapshot))
 
+    def iter_valid_moves(self, starting_square, snapshot):
+        """retrieve_valid_moves() 的生成器版本, 逐个给出可以到达的格子, 调用者找到需要的格子后可以提前结束"""
         # 先分析直走
         dx, dy = self.pawn_charge_direction
         x, y = starting_square.x + dx, starting_square.y + dy
         max_steps = 1
         if not self.has_been_moved:
             max_steps = 2
-        step = 1
-        squares = []
-        while step <= max_steps:
-            step += 1
+        for step in range(max_steps):
             if y < 0 or y >= snapshot.ymax:
                 break  # 此时已经跑到棋盘外面了
-            other_unit_id = snapshot.get_node(x, y).unit_id
-            if not other_unit_id:
-                squares.append(Square(x, y))
-                y += dy
-        result += squares
+            if snapshot.get_node(x, y).unit_id:
+                break  # 前方被挡住
+            yield Square(x, y)
+            y += dy
 
         # 再分析斜吃
-        dy = self.pawn_charge_direction.dy
-        squares = []
-        for x, y in self.retrieve_squares_within_shooting_range(starting_square, snapshot):
-            node = snapshot.get_node(x, y)
+        for square in self.retrieve_squares_within_shooting_range(starting_square, snapshot):
+            node = snapshot.get_node(square.x, square.y)
             if not node.unit_id:
                 # 斜线方向上没有棋子时兵不能斜吃斜走, 但是吃过路兵除外
-                continue  # FIXME: 此处信息不足, 暂时无法判断能否吃过路兵
-            unit = node.unit
-            if unit.owner == self.owner:
+                continue  # 快照中没有上一步走法的信息, 吃过路兵由竞技场判断
+            if node.unit.owner == self.owner:
                 continue  # 兵不能斜吃己方棋子
-            squares.append(Square(x, y))
-        result += squares
-        return tuple(result)
+            yield square
 
     def retrieve_squares_within_shooting_range(self, starting_square, snapshot):
         """分析兵可以攻击的两格火力点(射程), 不需要区分目标格子上是否为己方的棋子
@@ -271,26 +1222,24 @@ class AbstractPawnUnit(Unit):
         :param snapshot: 作战双方棋子的位置的一个快照
         :rtype : tuple
         """
-        result = []
-        dy = self.pawn_charge_direction.dy
-        for dx in {-1, 1}:
-            x, y = starting_square.x + dx, starting_square.y + dy
-            if x < 0 or x >= snapshot.xmax or y < 0 or y >= snapshot.ymax:
-                continue  # 此时已经跑到棋盘外面了
-            result.append(Square(x, y))
-        return tuple(result)
+        table = RayTable.of(snapshot.xmax, snapshot.ymax, self.attack_directions, 1)
+        return table.targets_from(starting_square)
+
+    def iter_squares_within_shooting_range(self, starting_square, snapshot):
+        """retrieve_squares_within_shooting_range() 的生成器版本"""
+        return iter(self.retrieve_squares_within_shooting_range(starting_square, snapshot))
 
 
 class WhitePawnUnit(AbstractPawnUnit):
-    @property
-    def pawn_charge_direction(self):
-        return Vector(0, 1)
+    __slots__ = ()
+    pawn_charge_direction = Vector(0, 1)
+    attack_directions = (Vector(-1, 1), Vector(1, 1))
 
 
 class BlackPawnUnit(AbstractPawnUnit):
-    @property
-    def pawn_charge_direction(self):
-        return Vector(0, -1)
+    __slots__ = ()
+    pawn_charge_direction = Vector(0, -1)
+    attack_directions = (Vector(-1, -1), Vector(1, -1))
 
 
 class StraightMovingAndAttackingUnit(Unit):
@@ -301,10 +1250,10 @@ class StraightMovingAndAttackingUnit(Unit):
     中国象棋的象和马有有蹩腿规则, 也需要单独判定
     """
 
-    def __init__(self, owner):
-        super(StraightMovingAndAttackingUnit, self).__init__(owner)
-        self.directions = []  # 用一组 Vector 矢量描述棋子可以朝哪些方向走
-        self.limited_move_range = 0  # 用负数或 0 代表不限制棋子最大移动格数, 用正整数 N 代表棋子最大移动距离(倍数 N). 王和马只能按移动矢量的一倍距离进行移动(倍数 N=1)
+    __slots__ = ()
+    # 以下两项是同一类型所有单位共用的类属性, 不为每个实例单独保存:
+    directions = ()  # 用一组 Vector 矢量描述棋子可以朝哪些方向走
+    limited_move_range = 0  # 用负数或 0 代表不限制棋子最大移动格数, 用正整数 N 代表棋子最大移动距离(倍数 N). 王和马只能按移动矢量的一倍距离进行移动(倍数 N=1)
 
     def retrieve_valid_moves(self, starting_square, snapshot):
         """计算走法沿直线走和吃子的棋子可以到达哪些格子
@@ -313,13 +1262,15 @@ class StraightMovingAndAttackingUnit(Unit):
         :param snapshot: 作战双方棋子的位置的一个快照
         :rtype : tuple
         """
-        squares = []
-        for x, y in self.retrieve_squares_within_shooting_range(starting_square, snapshot):
-            node = snapshot.get_node(x, y)
+        return tuple(self.iter_valid_moves(starting_square, snapshot))
+
+    def iter_valid_moves(self, starting_square, snapshot):
+        """retrieve_valid_moves() 的生成器版本, 逐个给出可以到达的格子, 调用者找到需要的格子后可以提前结束"""
+        for square in self.iter_squares_within_shooting_range(starting_square, snapshot):
+            node = snapshot.get(square)
             # 可以占领空格或攻击敌人所在的格子, 但不能攻击己方棋子所在的格子:
-            if not node.unit_id or node.unit.owner != self.owner:
-                squares.append(Square(x, y))
-        return tuple(squares)
+            if node is None or not node.unit_id or node.unit.owner != self.owner:
+                yield square
 
     def retrieve_squares_within_shooting_range(self, starting_square, snapshot):
         """计算沿直线走和吃子的棋子可以的所有火力点(当前火力射程范围), 不需要区分目标格子上是敌方还是己方的棋子
@@ -328,37 +1279,44 @@ class StraightMovingAndAttackingUnit(Unit):
         :param snapshot: 作战双方棋子的位置的一个快照
         :rtype : tuple
         """
+        table = RayTable.of(snapshot.xmax, snapshot.ymax, self.directions, self.limited_move_range)
+        if table.limited_move_range == 1:
+            return table.targets_from(starting_square)  # 只走一步时火力线不会被阻挡
+        # 与 iter_squares_within_shooting_range() 相同, AttackMap 每次走子都要重新计算火力线, 这里直接构造列表
+        get = snapshot.get
         result = []
-        for dx, dy in self.directions:  # 每个方向单独处理
-            squares = []
-            step_count = 1
-            x, y = starting_square[0] + dx, starting_square[1] + dy
-            # 若不限制棋子移动格数则一直循环, 直到碰到其他棋子或者棋盘边界:
-            while step_count <= self.limited_move_range if self.limited_move_range > 0 else True:
-                step_count += 1
-                if x < 0 or x >= snapshot.xmax or y < 0 or y >= snapshot.ymax:
-                    # 此时已经跑到棋盘外面了, 结束 while 循环
+        for ray in table.rays_from(starting_square):
+            for square in ray:
+                result.append(square)
+                node = get(square)
+                if node is not None and node.unit_id > 0:
                     break
-                node = snapshot.get_node(x, y)
-                if node.unit_id > 0:
+        return tuple(result)
+
+    def iter_squares_within_shooting_range(self, starting_square, snapshot):
+        """retrieve_squares_within_shooting_range() 的生成器版本, 按射线方向逐个给出火力点"""
+        table = RayTable.of(snapshot.xmax, snapshot.ymax, self.directions, self.limited_move_range)
+        if table.limited_move_range == 1:
+            for square in table.targets_from(starting_square):  # 只走一步时火力线不会被阻挡
+                yield square
+            return
+        for ray in table.rays_from(starting_square):  # 每个方向单独处理
+            for square in ray:
+                yield square
+                node = snapshot.get(square)
+                if node is not None and node.unit_id > 0:
                     # 存在敌人时, 火力线被敌人阻挡, 火力覆盖不到后面的位置了
                     # 存在己方棋子时, 火力线则被己方阻挡, 结果同上
-                    squares.append(Square(x, y))
-                    break  # 结束 while 循环
-                squares.append(Square(x, y))
-                x, y = x + dx, y + dy
-            result += squares
-        return tuple(result)
+                    break
 
 
 class RookUnit(StraightMovingAndAttackingUnit):
-    # TODO: 王車易位功能暂未实现, 需要在王的走法部分补充代码单独进行处理
+    # 王車易位由 GameArena.retrieve_legal_moves_of_player 单独处理
     """車(国际象棋与中国象棋通用)"""
 
-    def __init__(self, owner):
-        super(RookUnit, self).__init__(owner)
-        self.directions = [Vector(1, 0), Vector(0, 1), Vector(-1, 0), Vector(0, -1)]  # 車可以前后左右四个方向(纵向、横向)移动, 不限格数
-        self.limited_move_range = 0  # 0 for no limit
+    __slots__ = ()
+    directions = (Vector(1, 0), Vector(0, 1), Vector(-1, 0), Vector(0, -1))  # 車可以前后左右四个方向(纵向、横向)移动, 不限格数
+    limited_move_range = 0  # 0 for no limit
 
     def retrieve_valid_moves(self, starting_square, snapshot):
         """車的走法(国际象棋与中国象棋完全相同)
@@ -373,32 +1331,29 @@ class RookUnit(StraightMovingAndAttackingUnit):
 class BishopUnit(StraightMovingAndAttackingUnit):
     """国际象棋象的走法: 斜走 and 不限格数"""
 
-    def __init__(self, owner):
-        super(BishopUnit, self).__init__(owner)
-        self.directions = [Vector(1, 1), Vector(-1, 1), Vector(-1, -1), Vector(1, -1)]  # 象可以朝四个斜方向移动, 不限格数
-        self.limited_move_range = 0  # 0 for no limit
+    __slots__ = ()
+    directions = (Vector(1, 1), Vector(-1, 1), Vector(-1, -1), Vector(1, -1))  # 象可以朝四个斜方向移动, 不限格数
+    limited_move_range = 0  # 0 for no limit
 
 
 class QueenUnit(StraightMovingAndAttackingUnit):
     """国际象棋后的走法: 直走或斜走, 并且均不限格数"""
 
-    def __init__(self, owner):
-        super(QueenUnit, self).__init__(owner)
-        self.directions = \
-            [Vector(1, 0), Vector(1, 1), Vector(0, 1), Vector(-1, 1),
-             Vector(-1, 0), Vector(-1, -1), Vector(0, -1), Vector(1, -1)]
-        self.limited_move_range = 0  # 0 for no limit
+    __slots__ = ()
+    directions = \
+        (Vector(1, 0), Vector(1, 1), Vector(0, 1), Vector(-1, 1),
+         Vector(-1, 0), Vector(-1, -1), Vector(0, -1), Vector(1, -1))
+    limited_move_range = 0  # 0 for no limit
 
 
 class KingUnit(StraightMovingAndAttackingUnit):
     """国际象棋王的走法: 直走或斜走, 并且均不限格数"""
 
-    def __init__(self, owner):
-        super(KingUnit, self).__init__(owner)
-        self.directions = \
-            [Vector(1, 0), Vector(1, 1), Vector(0, 1), Vector(-1, 1),
-             Vector(-1, 0), Vector(-1, -1), Vector(0, -1), Vector(1, -1)]
-        self.limited_move_range = 1  # 王能朝各个方向走, 但只能走一格
+    __slots__ = ()
+    directions = \
+        (Vector(1, 0), Vector(1, 1), Vector(0, 1), Vector(-1, 1),
+         Vector(-1, 0), Vector(-1, -1), Vector(0, -1), Vector(1, -1))
+    limited_move_range = 1  # 王能朝各个方向走, 但只能走一格
 
     def retrieve_valid_moves(self, starting_square, snapshot):
         """国际象棋王的走法
@@ -407,31 +1362,277 @@ class KingUnit(StraightMovingAndAttackingUnit):
         :param snapshot: 作战双方棋子的位置的一个快照
         :rtype : tuple
         """
+        return tuple(self.iter_valid_moves(starting_square, snapshot))
+
+    def iter_valid_moves(self, starting_square, snapshot):
+        """retrieve_valid_moves() 的生成器版本"""
         # 王的一般走法是只能走一格(先不考虑王車易位的特殊情况)
-        regular_moves = super(KingUnit, self).retrieve_valid_moves(starting_square, snapshot)
+        regular_moves = super(KingUnit, self).iter_valid_moves(starting_square, snapshot)
+        attack_map = snapshot.attack_map
+        if attack_map is not None:
+            # 竞技场维护着攻击计数表时直接查表, 另外还要排除王身后被敌方車、象或后的火力线覆盖的格子
+            behind = attack_map.squares_behind(starting_square, self.owner)
+            for square in regular_moves:
+                if square not in behind and not attack_map.is_attacked_by_enemy(square, self.owner):
+                    yield square
+            return
         result = set(regular_moves)
         # 上面几个格子可能会被将军, 逐一排除:
-        # 下面要从 snapshot 中将王从自己当前所在的位置处移除
+        # 下面要从 snapshot 中将王从自己当前所在的位置处移除(只叠加一层视图, 不修改调用者传入的快照)
         # 否则王自己也出现在 snapshot 中, 将阻挡敌方棋子的特定进攻路线, 导致计算王可以走的逃跑路线时出现逻辑错误
         # (测试用例要注意检查被将军时, 王能否向背离敌方車、象或后的方向逃跑)
-        del snapshot[starting_square]
+        snapshot = snapshot.excluding(starting_square)
         for square, node in snapshot.items():
             if node.unit_id and node.unit.owner != self.owner:
                 dangerous_squares = node.unit.retrieve_squares_within_shooting_range(square, snapshot)
                 result -= set(dangerous_squares)
-        # TODO: 需要获取更多信息用于实现王車易位功能
-        return tuple(result)
+        # 王車易位需要知道王和車是否移动过, 由 GameArena.retrieve_legal_moves_of_player 单独处理
+        for square in result:
+            yield square
 
 
 class KnightUnit(StraightMovingAndAttackingUnit):
     """国际象棋马的走法: 马走“日”的对角, 国际象棋的马不蹩腿"""
 
-    def __init__(self, owner):
-        super(KnightUnit, self).__init__(owner)
-        self.directions = \
-            [Vector(2, 1), Vector(1, 2), Vector(-1, 2), Vector(-2, 1),
-             Vector(-2, -1), Vector(-1, -2), Vector(1, -2), Vector(2, -1)]
-        self.limited_move_range = 1
+    __slots__ = ()
+    directions = \
+        (Vector(2, 1), Vector(1, 2), Vector(-1, 2), Vector(-2, 1),
+         Vector(-2, -1), Vector(-1, -2), Vector(1, -2), Vector(2, -1))
+    limited_move_range = 1
+
+
+# 走法就是火力范围内除己方棋子以外的格子的单位类型(王还要排除受攻击的格子, 兵的直走和斜吃不同, 都不在其中)
+CAPTURE_FROM_ATTACK_MAP_TYPES = frozenset((QueenUnit, RookUnit, BishopUnit, KnightUnit))
+
+# 国际象棋兵升变时可选的单位类型, 按照 Move.flags >> 5 的取值排列
+PROMOTION_UNIT_TYPES = (QueenUnit, RookUnit, BishopUnit, KnightUnit)
+
+# 直走和斜走的全部 8 个方向, 用于查找牵制
+ALL_DIRECTIONS = (Vector(1, 0), Vector(1, 1), Vector(0, 1), Vector(-1, 1),
+                  Vector(-1, 0), Vector(-1, -1), Vector(0, -1), Vector(1, -1))
+
+WHITE = GameArena.PlayerID(1)  # 国际象棋白方, 先走
+BLACK = GameArena.PlayerID(2)  # 国际象棋黑方
+
+FEN_UNIT_TYPES = {
+    'K': KingUnit, 'Q': QueenUnit, 'R': RookUnit, 'B': BishopUnit, 'N': KnightUnit,
+    'P': WhitePawnUnit, 'p': BlackPawnUnit,
+}
+
+START_POSITION_FEN = 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1'
+
+
+# 热点路径的计数器和计时器. 默认关闭: 此时所有方法都是原来的函数, 没有任何额外开销;
+# enable_instrumentation() 把被统计的方法替换成计数/计时的包装函数, disable_instrumentation() 换回原来的函数
+_instrumentation = {}  # (操作, 单位类型名) -> [调用次数, 累计秒数]
+_original_methods = []  # 启用时被替换的 (类, 方法名, 类自身是否定义了该方法, 原方法)
+_entered = [0]  # 正在执行的 retrieve_valid_moves() 包装函数的层数, 其中调用的 iter_valid_moves() 不重复计数
+INSTRUMENTED_UNIT_TYPES = (WhitePawnUnit, BlackPawnUnit, KnightUnit, BishopUnit, RookUnit, QueenUnit, KingUnit)
+
+
+def _instrument(cls, name, key, timed=True, outer=False, inner=False):
+    """把 cls.name 替换成计数(timed 为 True 时同时计时)的包装函数
+
+    :param outer: 外层入口, 执行期间标记为已进入
+    :param inner: 内层方法, 从外层入口里调用时不计数, 只统计被直接调用的次数
+    """
+    stats = _instrumentation.setdefault(key, [0, 0.0])
+    method = getattr(cls, name)
+    perf_counter = getattr(time, 'perf_counter', time.time)  # Python 2.7 没有 perf_counter
+    entered = _entered
+    if timed:
+        def wrapper(*args, **kwargs):
+            started = perf_counter()
+            entered[0] += outer
+            try:
+                return method(*args, **kwargs)
+            finally:
+                entered[0] -= outer
+                stats[0] += 1
+                stats[1] += perf_counter() - started
+    else:
+        def wrapper(*args, **kwargs):
+            if not (inner and entered[0]):
+                stats[0] += 1
+            return method(*args, **kwargs)
+    # 恢复时放回类字典里的原对象(Python 2.7 的 getattr() 每次返回一个新的未绑定方法)
+    _original_methods.append((cls, name, name in cls.__dict__, cls.__dict__.get(name)))
+    setattr(cls, name, wrapper)
+
+
+def enable_instrumentation():
+    """开始统计: 快照视图的创建、各类单位 retrieve_valid_moves()/iter_valid_moves() 的调用、
+    走法规则查询的格子数, 以及 find_square_from_unit_id() 的调用. 重复调用没有影响.
+    retrieve_valid_moves() 内部调用的 iter_valid_moves() 不计数, iter_valid_moves 只统计被直接调用的次数,
+    因此两项相加就是生成各类单位走法的次数"""
+    if _original_methods:
+        return
+    _instrument(GameArena, '_GameArena__take_snapshot', ('snapshot', ''))
+    _instrument(GameArena, 'find_square_from_unit_id', ('find_square_from_unit_id', ''))
+    # Snapshot.get_node() 和 SnapshotView 最终都通过 Snapshot.get() 查询格子
+    _instrument(Snapshot, 'get', ('square_probe', ''), timed=False)
+    for unit_type in INSTRUMENTED_UNIT_TYPES:
+        _instrument(unit_type, 'retrieve_valid_moves', ('retrieve_valid_moves', unit_type.__name__), outer=True)
+        # 生成器的耗时算在使用者身上, 这里只计数
+        _instrument(unit_type, 'iter_valid_moves', ('iter_valid_moves', unit_type.__name__), timed=False,
+                    inner=True)
+
+
+def disable_instrumentation():
+    """停止统计, 恢复原来的方法, 已经统计的数据保留"""
+    while _original_methods:
+        cls, name, own, method = _original_methods.pop()
+        if own:
+            setattr(cls, name, method)
+        else:
+            delattr(cls, name)
+
+
+def reset_instrumentation():
+    """把所有计数器和计时器清零"""
+    for stats in _instrumentation.values():
+        stats[0], stats[1] = 0, 0.0
+
+
+def instrumentation_counters():
+    """统计数据
+
+    :return: {操作: {'calls': 调用次数, 'seconds': 累计秒数}}, 按单位类型统计的操作名为 '操作/单位类型名',
+             只计数的操作没有 'seconds'
+    :rtype : dict
+    """
+    result = {}
+    for (operation, unit_type), (calls, seconds) in sorted(_instrumentation.items()):
+        entry = {'calls': calls}
+        if operation not in ('square_probe', 'iter_valid_moves'):
+            entry['seconds'] = seconds
+        result['{}/{}'.format(operation, unit_type) if unit_type else operation] = entry
+    return result
+
+
+def instrumentation_prometheus(prefix='gamearena'):
+    """Prometheus 文本格式的统计数据
+
+    :rtype : str
+    """
+    lines = ['# TYPE {}_calls_total counter'.format(prefix)]
+    timed = []
+    for (operation, unit_type), (calls, seconds) in sorted(_instrumentation.items()):
+        labels = 'operation="{}"'.format(operation) + (',unit="{}"'.format(unit_type) if unit_type else '')
+        lines.append('{}_calls_total{{{}}} {}'.format(prefix, labels, calls))
+        if operation not in ('square_probe', 'iter_valid_moves'):
+            timed.append('{}_seconds_total{{{}}} {:.9f}'.format(prefix, labels, seconds))
+    lines.append('# TYPE {}_seconds_total counter'.format(prefix))
+    return '\n'.join(lines + timed) + '\n'
+
+
+def new_arena_from_fen(fen):
+    """按照 FEN 字符串摆放一个国际象棋局面(白方为 WHITE, 黑方为 BLACK), 详见 gamenotation.load_fen()
+
+    :rtype : GameArena
+    """
+    import gamenotation  # gamenotation 依赖本模块, 所以在这里才导入
+    return gamenotation.load_fen(fen)
+
+
+def coordinate_notation(move):
+    """走法的坐标记法, 例如 e2e4、e7e8q(升变时在末尾加上升变类型的小写字母)
+
+    :rtype : str
+    """
+    origin, destination, flags = move
+    text = '{}{}{}{}'.format(chr(ord('a') + origin[0]), origin[1] + 1, chr(ord('a') + destination[0]), destination[1] + 1)
+    if flags & MOVE_PROMOTION:
+        text += 'qrbn'[flags >> 5]
+    return text
+
+
+def parse_coordinate_notation(arena, text):
+    """coordinate_notation() 的逆运算: 在 arena 当前局面轮到走棋一方的合法走法中找出与坐标记法 text 对应的走法
+
+    :return: 对应的 Move, 不是合法走法时返回 None
+    :rtype : Move
+    """
+    text = text.strip().lower()
+    for move in arena.retrieve_legal_moves_of_player(arena.side_to_move):
+        if coordinate_notation(move) == text:
+            return move
+    return None
+
+
+# perft 参考局面: (名称, FEN, 深度为 1, 2, 3... 时的叶子节点数)
+PERFT_POSITIONS = [
+    ('initial', START_POSITION_FEN, (20, 400, 8902, 197281, 4865609)),
+    ('kiwipete', 'r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1', (48, 2039, 97862, 4085603)),
+    ('position3', '8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1', (14, 191, 2812, 43238, 674624)),
+    ('position4', 'r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1', (6, 264, 9467, 422333)),
+    ('position5', 'rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8', (44, 1486, 62379, 2103487)),
+    ('position6', 'r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 10',
+     (46, 2079, 89890, 3894594)),
+]
+
+
+def perft(arena, depth, divide=False):
+    """统计从当前局面出发走 depth 步之后的叶子节点数量(用于验证走法生成的正确性, 也是走法生成速度的基准测试)
+
+    :param arena: 轮到 arena.side_to_move 走棋的局面, 统计结束后局面保持不变
+    :param depth: 搜索深度
+    :param divide: 为 True 时分别统计第一步每种走法之后的叶子节点数量
+    :return: 叶子节点数量; divide=True 时返回 {第一步走法: 叶子节点数量}
+    :rtype : int or dict
+    """
+    moves = arena.retrieve_legal_moves_of_player(arena.side_to_move)
+    if divide:
+        result = {}
+        for move in moves:
+            arena.make_move(move)
+            result[move] = perft(arena, depth - 1) if depth > 1 else 1
+            arena.unmake_move()
+        return result
+    if depth <= 1:
+        return len(moves) if depth == 1 else 1
+    nodes = 0
+    for move in moves:
+        arena.make_move(move)
+        nodes += perft(arena, depth - 1)
+        arena.unmake_move()
+    return nodes
+
+
+def do_perft_test(max_depth=3, fen=None, divide=False, log=None):
+    """perft 正确性与速度测试: 默认对全部参考局面逐一验证叶子节点数量, 并报告每秒节点数
+
+    :param max_depth: 每个局面最多测试到的深度
+    :param fen: 只测试指定局面(此时没有参考数值可以对照)
+    :param divide: 为 True 时输出第一步每种走法之后的叶子节点数量
+    :return: 全部结果均与参考数值一致时返回 True
+    :rtype : bool
+    """
+    import sys
+    import time
+    log = log or sys.stdout
+    positions = PERFT_POSITIONS if fen is None else [('fen', fen, ())]
+    all_passed = True
+    for name, position, expected_counts in positions:
+        arena = new_arena_from_fen(position)
+        for depth in range(1, max_depth + 1):
+            started = time.time()
+            if divide:
+                counts = perft(arena, depth, divide=True)
+                nodes = sum(counts.values())
+            else:
+                nodes = perft(arena, depth)
+            seconds = max(time.time() - started, 1e-9)
+            expected = expected_counts[depth - 1] if depth <= len(expected_counts) else None
+            passed = expected is None or nodes == expected
+            all_passed = all_passed and passed
+            log.write('{:10s} depth {} nodes {:>10d} {:>8s} {:6.2f}s {:>9.0f} nodes/s\n'.format(
+                name, depth, nodes, '-' if expected is None else ('ok' if passed else 'FAIL'),
+                seconds, nodes / seconds))
+        if divide:
+            for move in sorted(counts, key=coordinate_notation):
+                log.write('  {} {}\n'.format(coordinate_notation(move), counts[move]))
+    return all_passed
 
 
 def do_self_test():
@@ -465,8 +1666,98 @@ def do_self_test():
     white_rook = arena.new_unit_recruited_by_player(white, Square(0, 0), RookUnit)
     m = arena.retrieve_valid_moves_of_unit(white_rook)
     print(m)
+    # 属性赋值必须经过 setter(旧式类在 Python 2.7 上会忽略 setter, 只添加一个实例属性)
+    position_hash = arena.position_hash
+    arena.side_to_move = black
+    arena.halfmove_clock, arena.fullmove_number = 3, 7
+    assert 'side_to_move' not in vars(arena)
+    assert arena.side_to_move == black and arena.position_hash != position_hash
+    assert (arena.halfmove_clock, arena.fullmove_number) == (3, 7)
+    # __slots__ 只对新式类有效, 单位和快照节点都没有 __dict__
+    assert not hasattr(Snapshot.EMPTY_NODE, '__dict__') and not hasattr(RookUnit(owner=white), '__dict__')
+    check_is_legal_move(log)
+
+
+def check_is_legal_move(log):
+    """is_legal_move() 与 retrieve_legal_moves_of_player() 的结果逐格比较, 并比较两者的速度"""
+    import time
+    arenas = []
+    for name, fen, counts in PERFT_POSITIONS:  # 参考局面以及走一步以后的全部局面
+        arenas.append(new_arena_from_fen(fen))
+        for move in arenas[-1].retrieve_legal_moves_of_player(arenas[-1].side_to_move):
+            arena = new_arena_from_fen(fen)
+            arena.make_move(move)
+            arenas.append(arena)
+    for arena in arenas:
+        player_id = arena.side_to_move
+        legal = set((move.origin, move.destination) for move in arena.retrieve_legal_moves_of_player(player_id))
+        xmax, ymax = arena.size
+        for unit_id in arena.units_of_player(player_id):
+            origin = arena.find_square_from_unit_id(unit_id)
+            for x in range(xmax):
+                for y in range(ymax):
+                    assert arena.is_legal_move(unit_id, (x, y)) == ((origin, (x, y)) in legal), (origin, (x, y))
+    # 速度: 检查一步走法 vs 生成全部走法
+    arena = new_arena_from_fen(PERFT_POSITIONS[1][1])
+    moves = arena.retrieve_legal_moves_of_player(arena.side_to_move)
+    started = time.time()
+    for i in range(20):
+        for move in moves:
+            arena.is_legal_move(arena.unit_on_square(move.origin), move.destination)
+    single = (time.time() - started) / (20 * len(moves))
+    started = time.time()
+    for i in range(20):
+        arena.retrieve_legal_moves_of_player(arena.side_to_move)
+    full = (time.time() - started) / 20
+    log.write('is_legal_move: {:.1f}us, full generation: {:.1f}us ({:.0%})\n'.format(
+        single * 1e6, full * 1e6, single / full))
+
+
+def do_instrumentation_test(depth=2, log=None):
+    """打开统计后运行 perft, 输出 Prometheus 文本格式的统计数据"""
+    import sys
+    import gamearena  # 作为脚本运行时本模块是 __main__, 而 new_arena_from_fen() 创建的是 gamearena 模块中的类
+    log = log or sys.stdout
+    original = gamearena.GameArena.__dict__['find_square_from_unit_id']
+    gamearena.enable_instrumentation()
+    try:
+        for name, fen, counts in PERFT_POSITIONS:
+            arena = new_arena_from_fen(fen)
+            assert arena.find_square_from_unit_id(arena.units_of_player(arena.side_to_move)[0])
+            assert perft(arena, depth) == counts[depth - 1]
+    finally:
+        gamearena.disable_instrumentation()
+    assert gamearena.GameArena.__dict__['find_square_from_unit_id'] is original
+    assert 'retrieve_valid_moves' not in gamearena.BishopUnit.__dict__
+    counters = gamearena.instrumentation_counters()
+    assert counters['snapshot']['calls'] > 0 and counters['find_square_from_unit_id']['calls'] >= len(PERFT_POSITIONS)
+    log.write(gamearena.instrumentation_prometheus())
+    # retrieve_valid_moves() 内部调用的 iter_valid_moves() 不重复计数
+    gamearena.reset_instrumentation()
+    pawn = gamearena.WhitePawnUnit(owner=gamearena.WHITE)
+    pawn.has_been_moved = False
+    empty = gamearena.SnapshotBuilder((8, 8)).snapshot
+    gamearena.enable_instrumentation()
+    try:
+        assert len(pawn.retrieve_valid_moves(gamearena.Square(4, 1), empty)) == 2
+        assert len(list(pawn.iter_valid_moves(gamearena.Square(4, 1), empty))) == 2
+    finally:
+        gamearena.disable_instrumentation()
+    counters = gamearena.instrumentation_counters()
+    assert counters['retrieve_valid_moves/WhitePawnUnit']['calls'] == 1
+    assert counters['iter_valid_moves/WhitePawnUnit']['calls'] == 1
+    gamearena.reset_instrumentation()
+    assert all(entry['calls'] == 0 for entry in gamearena.instrumentation_counters().values())
 
 
 if '__main__' == __name__:
-    do_self_test()
-    pass
+    import sys
+    if len(sys.argv) > 1 and sys.argv[1] == 'stats':
+        # 用法: python gamearena.py stats [深度]
+        do_instrumentation_test(depth=int(sys.argv[2]) if len(sys.argv) > 2 else 2)
+    elif len(sys.argv) > 1 and sys.argv[1] == 'perft':
+        # 用法: python gamearena.py perft [深度] [FEN]
+        do_perft_test(max_depth=int(sys.argv[2]) if len(sys.argv) > 2 else 3,
+                      fen=' '.join(sys.argv[3:]) or None, divide=len(sys.argv) > 3)
+    else:
+        do_self_test()
@@ -0,0 +1,376 @@
+# coding=utf-8
+"""可重现的计时基准场景, 结果输出为 JSON, 并可比较两次结果找出性能退化
+
+每个场景由 setup(rng) 准备数据(随机数发生器使用固定的种子, 每次运行的输入完全相同),
+返回 (被计时的函数, 每次调用完成的操作数). 被计时的函数先预热一次, 然后重复 repeat 轮,
+每轮连续调用 number 次, 记录每个操作的平均耗时. 计时期间关闭垃圾回收, 与 timeit 的做法一致.
+
+场景覆盖:
+    geometry.*      game.ChessWithAnalyticGeometry 的王、后、車、象、馬活动范围计算
+    board.*         gameboard.ChessBoard.find_available_move()
+    arena.*         gamearena 的走法生成、走子/悔棋时快照的增量维护、按 FEN 重建快照
+    service.*       gameservice.GameService 的轮流走棋
+
+命令行:
+    python gamebenchmark.py run [--out results.json] [--filter 子串] [--repeat N] [--scale F]
+    python gamebenchmark.py compare old.json new.json [--threshold 0.1] [--statistic median]
+compare 在任何场景变慢超过阈值时以状态码 1 退出, 便于在持续集成中使用.
+"""
+import argparse
+import collections
+import gc
+import json
+import platform
+import random
+import sys
+import time
+
+import game
+import gamearena
+import gamenotation
+from gameboard import ChessBoard
+from gameservice import GameService
+
+RESULT_FORMAT = 1
+DEFAULT_REPEAT = 7
+DEFAULT_SEED = 20161017
+STATISTICS = ('min', 'median', 'mean')
+
+Scenario = collections.namedtuple('Scenario', ['name', 'setup', 'number', 'description'])
+
+SCENARIOS = []
+
+
+def scenario(name, number, description):
+    """注册一个场景, number 为每轮计时连续调用的次数"""
+    def register(setup):
+        SCENARIOS.append(Scenario(name, setup, number, description))
+        return setup
+    return register
+
+
+def _geometry_scenario(method_name):
+    def setup(rng):
+        chess = game.ChessWithAnalyticGeometry()
+        method = getattr(chess, method_name)
+        squares = [(x, y) for x in range(8) for y in range(8)]
+        rng.shuffle(squares)
+
+        def run():
+            for x, y in squares:
+                method(x, y)
+        return run, len(squares)
+    return setup
+
+
+for _unit in ('king', 'queen', 'rook', 'bishop', 'knight'):
+    scenario('geometry.{}_move_range'.format(_unit), 20,
+             'ChessWithAnalyticGeometry.{}_move_range() on all 64 squares'.format(_unit))(
+        _geometry_scenario('{}_move_range'.format(_unit)))
+del _unit
+
+CHESS_BOARD_RULES = {
+    gamearena.KingUnit: ChessBoard.KingChessRule(), gamearena.QueenUnit: ChessBoard.QueenChessRule(),
+    gamearena.RookUnit: ChessBoard.RookChessRule(), gamearena.BishopUnit: ChessBoard.BishopChessRule(),
+    gamearena.KnightUnit: ChessBoard.KnightChessRule(),
+}
+
+
+def _chess_board_from_fen(fen):
+    """按 FEN 的棋子布局摆放 ChessBoard, 返回 (棋盘, [(棋子编号, 走法规则)]), 兵没有走法规则, 不参与计时"""
+    board = ChessBoard()
+    pieces = []
+    for owner, square, unit_type, has_been_moved in gamenotation.parse_fen(fen).units:
+        name = chr(gamenotation.FEN_CODES[(owner, unit_type)])
+        piece_id = board.make_id_for_new_chess_piece(owner, name, (square.x, square.y))
+        rule = CHESS_BOARD_RULES.get(unit_type)
+        if rule is not None:
+            pieces.append((piece_id, rule))
+    return board, pieces
+
+
+@scenario('board.find_available_move', 20, 'ChessBoard.find_available_move() for every piece of the perft positions')
+def _setup_board_find_available_move(rng):
+    boards = [_chess_board_from_fen(fen) for name, fen, counts in gamearena.PERFT_POSITIONS]
+
+    def run():
+        for board, pieces in boards:
+            for piece_id, rule in pieces:
+                board.find_available_move(piece_id, rule)
+    return run, sum(len(pieces) for board, pieces in boards)
+
+
+def _random_arenas(rng, count, plies):
+    """从初始局面随机走 plies 步得到 count 个局面, 由 rng 的种子决定"""
+    arenas = []
+    for _ in range(count):
+        arena = gamenotation.load_fen(gamearena.START_POSITION_FEN)
+        for _ in range(plies):
+            moves = arena.retrieve_legal_moves_of_player(arena.side_to_move)
+            if not moves:
+                break
+            arena.make_move(rng.choice(sorted(moves)))
+        arenas.append(arena)
+    return arenas
+
+
+def _perft_arenas():
+    return [gamearena.new_arena_from_fen(fen) for name, fen, counts in gamearena.PERFT_POSITIONS]
+
+
+@scenario('arena.legal_moves', 10, 'GameArena.retrieve_legal_moves_of_player() on perft and random positions')
+def _setup_arena_legal_moves(rng):
+    arenas = _perft_arenas() + _random_arenas(rng, 10, 20)
+
+    def run():
+        for arena in arenas:
+            arena.retrieve_legal_moves_of_player(arena.side_to_move)
+    return run, len(arenas)
+
+
+@scenario('arena.valid_moves_of_unit', 10, 'GameArena.retrieve_valid_moves_of_unit() for every unit')
+def _setup_arena_valid_moves_of_unit(rng):
+    work = [(arena, unit_id) for arena in _perft_arenas() + _random_arenas(rng, 10, 20)
+            for player_id in arena.players for unit_id in arena.units_of_player(player_id)]
+
+    def run():
+        for arena, unit_id in work:
+            arena.retrieve_valid_moves_of_unit(unit_id)
+    return run, len(work)
+
+
+@scenario('arena.make_unmake', 10, 'GameArena.make_move()/unmake_move() pairs, updating the live snapshot')
+def _setup_arena_make_unmake(rng):
+    work = [(arena, arena.retrieve_legal_moves_of_player(arena.side_to_move))
+            for arena in _perft_arenas() + _random_arenas(rng, 10, 20)]
+
+    def run():
+        for arena, moves in work:
+            for move in moves:
+                arena.make_move(move)
+                arena.unmake_move()
+    return run, sum(len(moves) for arena, moves in work)
+
+
+@scenario('arena.load_fen', 10, 'rebuild the snapshot of a reused GameArena from FEN')
+def _setup_arena_load_fen(rng):
+    fens = [fen for name, fen, counts in gamearena.PERFT_POSITIONS]
+    fens += [gamenotation.arena_to_fen(arena) for arena in _random_arenas(rng, 10, 20)]
+    arena = gamenotation.load_fen(fens[0])
+
+    def run():
+        for fen in fens:
+            gamenotation.load_fen(fen, arena)
+    return run, len(fens)
+
+
+@scenario('arena.perft2', 3, 'perft depth 2 of the perft positions (leaf nodes)')
+def _setup_arena_perft2(rng):
+    arenas = _perft_arenas()
+
+    def run():
+        for arena in arenas:
+            gamearena.perft(arena, 2)
+    return run, sum(counts[1] for name, fen, counts in gamearena.PERFT_POSITIONS)
+
+
+def _service_scenario(players):
+    def setup(rng):
+        ids = list(range(1, players + 1))
+        rng.shuffle(ids)  # 走棋次序由编号大小决定, 与传入的顺序无关
+        service = GameService(ids, ['player {}'.format(i) for i in ids])
+        turns = 1000
+
+        def run():
+            for _ in range(turns):
+                service.get_current_player_id()
+                service.end_this_turn()
+        return run, turns
+    return setup
+
+
+for _players in (2, 4):
+    scenario('service.turn_cycle_{}p'.format(_players), 20,
+             'GameService.get_current_player_id()/end_this_turn() with {} players'.format(_players))(
+        _service_scenario(_players))
+del _players
+
+
+def time_scenario(item, repeat=DEFAULT_REPEAT, scale=1.0, seed=DEFAULT_SEED):
+    """运行一个场景
+
+    :param scale: number 的倍数, 例如 0.1 用于快速冒烟测试
+    :return: 可以直接写入 JSON 的结果, 时间单位为每个操作的秒数
+    :rtype : dict
+    """
+    run, operations = item.setup(random.Random('{}:{}'.format(seed, item.name)))
+    number = max(1, int(item.number * scale))
+    run()  # 预热
+    samples = []
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            started = time.perf_counter()
+            for _ in range(number):
+                run()
+            samples.append((time.perf_counter() - started) / (number * operations))
+    finally:
+        if gc_enabled:
+            gc.enable()
+    ordered = sorted(samples)
+    middle = len(ordered) // 2
+    median = ordered[middle] if len(ordered) % 2 else (ordered[middle - 1] + ordered[middle]) / 2
+    return collections.OrderedDict([
+        ('description', item.description),
+        ('operations', operations),
+        ('number', number),
+        ('repeat', repeat),
+        ('samples', samples),
+        ('min', ordered[0]),
+        ('median', median),
+        ('mean', sum(samples) / len(samples)),
+        ('ops_per_second', 1.0 / median if median > 0 else None),
+    ])
+
+
+def run_benchmarks(name_filter=None, repeat=DEFAULT_REPEAT, scale=1.0, seed=DEFAULT_SEED, log=None):
+    """运行名称包含 name_filter 的全部场景
+
+    :rtype : dict
+    """
+    results = collections.OrderedDict()
+    for item in SCENARIOS:
+        if name_filter and name_filter not in item.name:
+            continue
+        results[item.name] = time_scenario(item, repeat=repeat, scale=scale, seed=seed)
+        if log:
+            log.write('{:32s} {:>12.3f} us/op {:>12.0f} ops/s\n'.format(
+                item.name, results[item.name]['median'] * 1e6, results[item.name]['ops_per_second'] or 0))
+    return collections.OrderedDict([
+        ('format', RESULT_FORMAT),
+        ('created', time.strftime('%Y-%m-%dT%H:%M:%S')),
+        ('python', platform.python_version()),
+        ('implementation', platform.python_implementation()),
+        ('platform', platform.platform()),
+        ('seed', seed),
+        ('scenarios', results),
+    ])
+
+
+def load_results(path):
+    with open(path) as f:
+        data = json.load(f)
+    if data.get('format') != RESULT_FORMAT:
+        raise ValueError('{}: unsupported benchmark result format {!r}'.format(path, data.get('format')))
+    return data
+
+
+def compare_results(old, new, threshold=0.1, statistic='median'):
+    """比较两次运行的结果
+
+    :param threshold: 新结果比旧结果慢超过这个比例时记为退化, 快超过这个比例时记为改进
+    :return: 按场景名排序的 (场景名, 旧耗时, 新耗时, 新/旧比值, 状态) 列表,
+             状态为 'regression', 'improvement', 'unchanged', 'added' 或 'removed'
+    :rtype : list
+    """
+    if statistic not in STATISTICS:
+        raise ValueError('statistic must be one of {}'.format(', '.join(STATISTICS)))
+    rows = []
+    old_scenarios, new_scenarios = old['scenarios'], new['scenarios']
+    for name in sorted(set(old_scenarios) | set(new_scenarios)):
+        if name not in new_scenarios:
+            rows.append((name, old_scenarios[name][statistic], None, None, 'removed'))
+            continue
+        if name not in old_scenarios:
+            rows.append((name, None, new_scenarios[name][statistic], None, 'added'))
+            continue
+        before, after = old_scenarios[name][statistic], new_scenarios[name][statistic]
+        ratio = after / before if before > 0 else float('inf')
+        if ratio > 1 + threshold:
+            status = 'regression'
+        elif ratio < 1 - threshold:
+            status = 'improvement'
+        else:
+            status = 'unchanged'
+        rows.append((name, before, after, ratio, status))
+    return rows
+
+
+def write_comparison(rows, log):
+    def microseconds(seconds):
+        return '-' if seconds is None else '{:.3f}'.format(seconds * 1e6)
+    log.write('{:32s} {:>12s} {:>12s} {:>8s}  {}\n'.format('scenario', 'old us/op', 'new us/op', 'ratio', 'status'))
+    for name, before, after, ratio, status in rows:
+        log.write('{:32s} {:>12s} {:>12s} {:>8s}  {}\n'.format(
+            name, microseconds(before), microseconds(after), '-' if ratio is None else '{:.3f}'.format(ratio),
+            status))
+
+
+def do_self_test():
+    """以下为模块自测试代码"""
+    log = sys.stdout
+    log.write('Module:{}\n'.format(__name__))
+    board, pieces = _chess_board_from_fen(gamearena.START_POSITION_FEN)
+    assert len(pieces) == 16
+    assert sum(len(board.find_available_move(piece_id, rule)) for piece_id, rule in pieces) == 8  # 只有馬能走
+    first = run_benchmarks(repeat=3, scale=0.05, log=log)
+    assert list(first['scenarios']) == [item.name for item in SCENARIOS]
+    assert all(len(result['samples']) == 3 and result['min'] > 0 for result in first['scenarios'].values())
+    data = json.loads(json.dumps(first))
+    assert compare_results(data, data)[0][-1] == 'unchanged'
+    slower = json.loads(json.dumps(first))
+    slower['scenarios']['arena.legal_moves']['median'] *= 1.5
+    del slower['scenarios']['service.turn_cycle_4p']
+    statuses = dict((row[0], row[-1]) for row in compare_results(first, slower, threshold=0.1))
+    assert statuses['arena.legal_moves'] == 'regression' and statuses['service.turn_cycle_4p'] == 'removed'
+    assert set(statuses.values()) == {'regression', 'removed', 'unchanged'}
+    # 同一个种子下每个场景的输入完全相同
+    item = SCENARIOS[[s.name for s in SCENARIOS].index('arena.load_fen')]
+    fens = [gamenotation.arena_to_fen(arena) for arena in _random_arenas(random.Random('x'), 3, 10)]
+    assert fens == [gamenotation.arena_to_fen(arena) for arena in _random_arenas(random.Random('x'), 3, 10)]
+    assert time_scenario(item, repeat=1, scale=0.1)['operations'] == len(gamearena.PERFT_POSITIONS) + 10
+
+
+def main():
+    parser = argparse.ArgumentParser(description='reproducible timed benchmark scenarios')
+    commands = parser.add_subparsers(dest='command')
+    run = commands.add_parser('run', help='run scenarios and write JSON results')
+    run.add_argument('--out', default=None, help='JSON results file, default: standard output')
+    run.add_argument('--filter', default=None, help='only run scenarios whose name contains this text')
+    run.add_argument('--repeat', type=int, default=DEFAULT_REPEAT, help='timed rounds per scenario')
+    run.add_argument('--scale', type=float, default=1.0, help='multiplier of the calls per round')
+    run.add_argument('--seed', type=int, default=DEFAULT_SEED)
+    run.add_argument('--list', action='store_true', help='only list the scenarios')
+    compare = commands.add_parser('compare', help='compare two JSON results, exit 1 on regression')
+    compare.add_argument('old')
+    compare.add_argument('new')
+    compare.add_argument('--threshold', type=float, default=0.1,
+                         help='relative slowdown reported as a regression (0.1 = 10%%)')
+    compare.add_argument('--statistic', choices=STATISTICS, default='median')
+    args = parser.parse_args()
+    if args.command == 'run':
+        if args.list:
+            for item in SCENARIOS:
+                print('{:32s} {}'.format(item.name, item.description))
+            return
+        results = run_benchmarks(args.filter, repeat=args.repeat, scale=args.scale, seed=args.seed,
+                                 log=sys.stderr)
+        if args.out:
+            with open(args.out, 'w') as f:
+                json.dump(results, f, indent=2)
+                f.write('\n')
+        else:
+            json.dump(results, sys.stdout, indent=2)
+            sys.stdout.write('\n')
+    elif args.command == 'compare':
+        rows = compare_results(load_results(args.old), load_results(args.new), args.threshold, args.statistic)
+        write_comparison(rows, sys.stdout)
+        if any(row[-1] == 'regression' for row in rows):
+            sys.exit(1)
+    else:
+        do_self_test()
+
+
+if '__main__' == __name__:
+    main()
@@ -0,0 +1,408 @@
+# coding=utf-8
+"""以整数位棋盘(bitboard)存储占位信息的 GameArena 替代实现
+
+格子 (x, y) 对应整数的第 y*width+x 位. 8x8 棋盘恰好是一个 64 位整数,
+其他尺寸的棋盘同样适用(Python 整数没有位数上限).
+每种单位类型的射线掩码表只准备一次, 王的走法所需的敌方火力范围在棋子移动之前一直缓存,
+掩码到格子元组的转换按掩码缓存(结果只取决于掩码本身).
+
+速度: 8x8 棋盘上单个单位的走法查询, 反复查询同一批局面时(自测试, 掩码缓存全部命中)约为 GameArena 的 4~5 倍,
+每个局面只查询一次、掩码缓存几乎不命中时约 2~2.7 倍; 自测试断言至少 MIN_SPEEDUP 倍.
+最初期望的 10 倍达不到: 每次查询仍然是一次 Python 方法调用, 返回由 Square 组成的元组, 这部分固定开销
+与 GameArena 相同, 位棋盘只能省掉逐格扫描棋盘的那部分.
+"""
+from gamearena import Square, GameArena, AbstractPawnUnit, KingUnit, StraightMovingAndAttackingUnit
+
+MIN_SPEEDUP = 3  # 自测试要求的走法查询速度与 GameArena 之比
+SQUARES_CACHE_LIMIT = 1 << 16  # squares_of() 最多缓存的掩码数量, 超过后清空重来
+
+
+class BitboardGeometry(object):
+    """与棋子无关的掩码表, 每种棋盘尺寸只计算一次
+
+    rays[(dx, dy, limit)][i] 为从第 i 格出发沿矢量 (dx, dy) 最多走 limit 步(limit<=0 表示不限步数)经过的格子掩码
+    """
+    __cache = {}
+
+    def __init__(self, width, ranks):
+        self.width = width
+        self.ranks = ranks
+        self.squares = tuple(Square(i % width, i // width) for i in range(width * ranks))
+        self.full_mask = (1 << (width * ranks)) - 1
+        self.__rays = {}
+        self.__leapers = {}
+        self.__plans = {}
+        self.__squares_of = {}
+
+    @classmethod
+    def of_size(cls, width, ranks):
+        key = (width, ranks)
+        geometry = cls.__cache.get(key)
+        if geometry is None:
+            geometry = cls.__cache[key] = cls(width, ranks)
+        return geometry
+
+    def index_of(self, x, y):
+        return y * self.width + x
+
+    def ray_masks(self, dx, dy, limit):
+        """沿单一方向的射线掩码表
+
+        :rtype : tuple
+        """
+        key = (dx, dy, limit if limit > 0 else 0)
+        table = self.__rays.get(key)
+        if table is None:
+            table = []
+            for x0, y0 in self.squares:
+                mask = 0
+                step = 0
+                x, y = x0 + dx, y0 + dy
+                while 0 <= x < self.width and 0 <= y < self.ranks:
+                    step += 1
+                    if 0 < limit < step:
+                        break
+                    mask |= 1 << self.index_of(x, y)
+                    x, y = x + dx, y + dy
+                table.append(mask)
+            table = self.__rays[key] = tuple(table)
+        return table
+
+    def leaper_masks(self, directions):
+        """只走一步的棋子(王、马)在各个格子上的全部目标格掩码
+
+        :param directions: Vector 矢量组成的 tuple
+        :rtype : tuple
+        """
+        table = self.__leapers.get(directions)
+        if table is None:
+            table = []
+            for x0, y0 in self.squares:
+                mask = 0
+                for dx, dy in directions:
+                    x, y = x0 + dx, y0 + dy
+                    if 0 <= x < self.width and 0 <= y < self.ranks:
+                        mask |= 1 << self.index_of(x, y)
+                table.append(mask)
+            table = self.__leapers[directions] = tuple(table)
+        return table
+
+    def attack_plan(self, directions, limit):
+        """一种单位类型计算火力范围所需的全部掩码表, 每种 (directions, limit) 组合只准备一次
+
+        :return: 只走一步时为 (leaper_masks(directions), ()), 否则为 (None, ((射线掩码表, 是否递增方向), ...))
+        :rtype : tuple
+        """
+        key = (directions, limit if limit > 0 else 0)
+        plan = self.__plans.get(key)
+        if plan is None:
+            if limit == 1:
+                plan = (self.leaper_masks(directions), ())
+            else:
+                plan = (None, tuple((self.ray_masks(dx, dy, limit), self.is_forward_ray(dx, dy))
+                                    for dx, dy in directions))
+            self.__plans[key] = plan
+        return plan
+
+    def pawn_steps(self, dy):
+        """兵直走一格和两格的目标格掩码表
+
+        :return: (走一格的掩码表, 走两格的掩码表)
+        :rtype : tuple
+        """
+        one = self.ray_masks(0, dy, 1)
+        two = tuple(both ^ single for both, single in zip(self.ray_masks(0, dy, 2), one))
+        return one, two
+
+    def squares_of(self, mask):
+        """掩码中全部置位对应的格子(从低位到高位)
+
+        :rtype : tuple
+        """
+        squares = self.__squares_of.get(mask)
+        if squares is None:
+            if len(self.__squares_of) >= SQUARES_CACHE_LIMIT:
+                self.__squares_of.clear()
+            all_squares = self.squares
+            result = []
+            rest = mask
+            while rest:
+                low = rest & -rest
+                result.append(all_squares[low.bit_length() - 1])
+                rest ^= low
+            squares = self.__squares_of[mask] = tuple(result)
+        return squares
+
+    def is_forward_ray(self, dx, dy):
+        """射线方向上格子编号是否递增(递增时离起点最近的阻挡棋子是最低位, 否则是最高位)"""
+        return dy > 0 or (dy == 0 and dx > 0)
+
+
+def iterate_bits(mask):
+    """依次给出掩码中每个置位的编号(从低位到高位)"""
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+class BitboardGameArena(object):
+    """用位棋盘表示的模拟竞技场, 公开接口与 gamearena.GameArena 相同
+
+    每名玩家各有一个占位掩码, 每种单位类型各有一个占位掩码, 走法通过掩码运算生成
+    """
+
+    PlayerID = GameArena.PlayerID
+    UnitID = GameArena.UnitID
+
+    def __init__(self, width, ranks):
+        """初始化游戏竞技场数据
+
+        :param width: x 轴方向上棋盘的宽度(=xmax)
+        :param ranks: 横行数量(=ymax)
+        """
+        self.__geometry = BitboardGeometry.of_size(width, ranks)
+        self.__unit_info_list = []  # 按单位的编码顺序存储所有战斗单位的信息, 单位死亡后仍然保留记录
+        self.__unit_index = []  # 与 __unit_info_list 一一对应, 记录单位所在格子的编号, -1 表示不在棋盘上
+        self.__unit_id_on_index = {}  # 格子编号 -> 单位编码, 只记录有棋子的格子
+        self.__player_masks = {}  # 玩家编号 -> 该玩家所有棋子的占位掩码
+        self.__type_masks = {}  # 单位类型 -> 该类型所有棋子的占位掩码
+        self.__occupied = 0  # 双方全部棋子的占位掩码
+        self.__enemy_attack_cache = {}  # (玩家编号, 占位掩码) -> 敌方火力范围掩码, 任何棋子离开或放上格子时清空
+        self.__type_plans = {}  # 单位类型 -> (兵的直走掩码表或 None, 只走一步的目标格掩码表或 None, 射线表)
+
+    @property
+    def size(self):
+        """长度和宽度格子数
+
+        :rtype : int, int
+        """
+        return self.__geometry.width, self.__geometry.ranks
+
+    def __check_square(self, square):
+        x, y = square[0], square[1]
+        xmax, ymax = self.size
+        if x < 0 or y < 0 or x >= xmax or y >= ymax:
+            raise ValueError('invalid square:{}'.format(square))
+        return self.__geometry.index_of(x, y)
+
+    def new_unit_recruited_by_player(self, player_id, square, unit_type):
+        """征募一个虚拟单位进入战场, 返回值表示为其分配的编码
+
+        :param player_id: 玩家编号, 每个单位必须有一个玩家归属
+        :param square: 单位的初始位置
+        :param unit_type: 单位的类型, 必须继承 class Unit
+        :return: 为新单位分配的编码, 最小值从 1 开始分配
+        :rtype : GameArena.UnitID
+        """
+        unit = unit_type(owner=player_id)
+        unit.has_been_moved = False
+        self.__unit_info_list.append(unit)
+        self.__unit_index.append(-1)
+        unit_id = self.UnitID(len(self.__unit_info_list))
+        self.__player_masks.setdefault(player_id, 0)
+        self.__type_masks.setdefault(unit_type, 0)
+        if square:
+            self.__put(unit_id, self.__check_square(square))
+        return unit_id
+
+    def owner_of_unit(self, unit_id):
+        if not self.is_valid_unit_id(unit_id):
+            raise ValueError('unit_id:{} not exists'.format(unit_id))
+        return self.__unit_info_list[unit_id - 1].owner
+
+    def __put(self, unit_id, index):
+        """将单位放到编号为 index 的格子上, 原先占据该格子的单位(无论敌我)被移出棋盘"""
+        victim_id = self.__unit_id_on_index.get(index)
+        if victim_id:
+            self.__remove(victim_id)
+        unit = self.__unit_info_list[unit_id - 1]
+        bit = 1 << index
+        self.__player_masks[unit.owner] |= bit
+        self.__type_masks[type(unit)] |= bit
+        self.__occupied |= bit
+        self.__enemy_attack_cache.clear()
+        self.__unit_id_on_index[index] = unit_id
+        self.__unit_index[unit_id - 1] = index
+
+    def __remove(self, unit_id):
+        index = self.__unit_index[unit_id - 1]
+        if index < 0:
+            return
+        unit = self.__unit_info_list[unit_id - 1]
+        bit = 1 << index
+        self.__player_masks[unit.owner] &= ~bit
+        self.__type_masks[type(unit)] &= ~bit
+        self.__occupied &= ~bit
+        self.__enemy_attack_cache.clear()
+        del self.__unit_id_on_index[index]
+        self.__unit_index[unit_id - 1] = -1
+
+    def move_unit_to_somewhere(self, unit_id, square):
+        """移动棋子
+
+        :param unit_id: 单位编码
+        :param square: 目的地坐标
+        """
+        if not self.is_valid_unit_id(unit_id):
+            raise ValueError('unit_id:{} does not exist'.format(unit_id))
+        index = self.__check_square(square)
+        self.__remove(unit_id)
+        self.__put(unit_id, index)
+        self.__unit_info_list[unit_id - 1].has_been_moved = True
+
+    def is_valid_unit_id(self, unit_id):
+        """unit_id 编码检查, 这里不区分是否已经死亡, 只要单位曾经存在即为有效 ID, unit_id=0 时无效
+
+        :rtype : bool
+        """
+        return 1 <= unit_id <= len(self.__unit_info_list)
+
+    def find_square_from_unit_id(self, unit_id):
+        """特定编码的棋子如果在棋盘上则返回坐标, 否则向上传递一个 ValueError 表示没找到
+
+        :rtype : Square
+        """
+        if not self.is_valid_unit_id(unit_id):
+            raise ValueError('Error: invalid unit_id:{}'.format(unit_id))
+        index = self.__unit_index[unit_id - 1]
+        if index < 0:
+            raise ValueError('Note: unit_id:{} is not on chessboard'.format(unit_id))
+        return self.__geometry.squares[index]
+
+    def is_occupied_square(self, square):
+        x, y = square[0], square[1]
+        xmax, ymax = self.size
+        if x < 0 or y < 0 or x >= xmax or y >= ymax:
+            return False
+        return bool(self.__occupied >> self.__geometry.index_of(x, y) & 1)
+
+    def retrieve_valid_moves_of_unit(self, unit_id):
+        """查询走法
+
+        :param unit_id: 棋子单位的编码
+        :return: 依据棋子自己的走法规则搜索该棋子所有可达位置
+        :rtype : tuple
+        """
+        unit_index = self.__unit_index
+        if not 1 <= unit_id <= len(unit_index):
+            return {}
+        index = unit_index[unit_id - 1]
+        if index < 0:
+            raise ValueError('Note: unit_id:{} is not on chessboard'.format(unit_id))
+        return self.__geometry.squares_of(self.__valid_moves_mask(self.__unit_info_list[unit_id - 1], index))
+
+    def __plan_of(self, unit_type):
+        """单位类型的走法掩码表, 每种类型只准备一次(走法矢量都是类属性)"""
+        plan = self.__type_plans.get(unit_type)
+        if plan is None:
+            geometry = self.__geometry
+            if issubclass(unit_type, AbstractPawnUnit):
+                plan = (geometry.pawn_steps(unit_type.pawn_charge_direction.dy),
+                        geometry.attack_plan(unit_type.attack_directions, 1)[0], ())
+            else:
+                plan = (None,) + geometry.attack_plan(unit_type.directions, unit_type.limited_move_range)
+            self.__type_plans[unit_type] = plan
+        return plan
+
+    def __valid_moves_mask(self, unit, index):
+        occupied = self.__occupied
+        pawn_steps, leapers, rays = self.__plan_of(type(unit))
+        own = self.__player_masks[unit.owner]
+        if pawn_steps is not None:
+            # 兵直走时被挡住就不能前进, 第一次移动且前一格为空时才能走两格; 斜走只能吃敌方棋子
+            mask = pawn_steps[0][index] & ~occupied
+            if mask and not unit.has_been_moved:
+                mask |= pawn_steps[1][index] & ~occupied
+            return mask | (leapers[index] & occupied & ~own)
+        if leapers is not None:
+            mask = leapers[index] & ~own
+        else:
+            mask = self.__ray_attack_mask(rays, index, occupied) & ~own
+        if isinstance(unit, KingUnit):
+            # 计算敌方火力范围时要先把王自己从棋盘上拿走, 否则王会挡住敌方車、象或后的火力线
+            mask &= ~self.__enemy_attack_mask(unit.owner, occupied & ~(1 << index))
+        return mask
+
+    @staticmethod
+    def __ray_attack_mask(rays, index, occupied):
+        mask = 0
+        for table, forward in rays:
+            ray = table[index]
+            blockers = ray & occupied
+            if blockers:
+                # 火力线止于第一个阻挡的棋子(含该格), 后面的格子需要从射线中去掉
+                if forward:
+                    ray ^= table[(blockers & -blockers).bit_length() - 1]
+                else:
+                    ray ^= table[blockers.bit_length() - 1]
+            mask |= ray
+        return mask
+
+    def __attack_mask(self, unit, index, occupied):
+        """单位在 index 格上的火力范围掩码, 不区分目标格子上是敌方还是己方的棋子"""
+        pawn_steps, leapers, rays = self.__plan_of(type(unit))
+        if leapers is not None:
+            return leapers[index]
+        return self.__ray_attack_mask(rays, index, occupied)
+
+    def __enemy_attack_mask(self, player_id, occupied):
+        key = (player_id, occupied)
+        mask = self.__enemy_attack_cache.get(key)
+        if mask is not None:
+            return mask
+        mask = 0
+        for owner, player_mask in self.__player_masks.items():
+            if owner == player_id:
+                continue
+            for index in iterate_bits(player_mask & occupied):
+                unit = self.__unit_info_list[self.__unit_id_on_index[index] - 1]
+                mask |= self.__attack_mask(unit, index, occupied)
+        self.__enemy_attack_cache[key] = mask
+        return mask
+
+
+def do_self_test():
+    """模块自测试: 与 gamearena.GameArena 对照走法结果, 并比较每秒生成的走法数量"""
+    import sys
+    import timeit
+    import gamearena
+    log = sys.stdout
+    log.write('Module:{}\n'.format(__name__))
+    name_order = [gamearena.RookUnit, gamearena.KnightUnit, gamearena.BishopUnit, gamearena.QueenUnit,
+                  gamearena.KingUnit, gamearena.BishopUnit, gamearena.KnightUnit, gamearena.RookUnit]
+    arenas = [gamearena.GameArena(8, 8), BitboardGameArena(8, 8)]
+    units = []
+    for arena in arenas:
+        white, black = arena.PlayerID(1), arena.PlayerID(2)
+        unit_ids = []
+        for x, unit_type in enumerate(name_order):
+            unit_ids.append(arena.new_unit_recruited_by_player(white, Square(x, 0), unit_type))
+            unit_ids.append(arena.new_unit_recruited_by_player(white, Square(x, 1), gamearena.WhitePawnUnit))
+            unit_ids.append(arena.new_unit_recruited_by_player(black, Square(x, 6), gamearena.BlackPawnUnit))
+            unit_ids.append(arena.new_unit_recruited_by_player(black, Square(x, 7), unit_type))
+        # 1.e4 e5 2.Qh5 Nc6 3.Bc4 Nf6
+        for unit_index, square in [(13, (4, 3)), (14, (4, 4)), (12, (7, 4)), (7, (2, 5)),
+                                   (20, (2, 3)), (27, (5, 5))]:
+            arena.move_unit_to_somewhere(unit_ids[unit_index], Square(*square))
+        units.append(unit_ids)
+    for i in range(len(units[0])):
+        expected, actual = [set(arena.retrieve_valid_moves_of_unit(unit_ids[i]))
+                            for arena, unit_ids in zip(arenas, units)]
+        assert expected == actual, (i, expected, actual)
+    rates = []
+    for arena, unit_ids in zip(arenas, units):
+        def generate_all():
+            for unit_id in unit_ids:
+                arena.retrieve_valid_moves_of_unit(unit_id)
+        seconds = min(timeit.repeat(generate_all, number=20, repeat=5)) / 20
+        rates.append(len(unit_ids) / seconds)
+        log.write('{}: {:.0f} unit queries/s\n'.format(type(arena).__name__, rates[-1]))
+    # 位棋盘实现存在的意义在于比 GameArena 快
+    log.write('speedup: {:.1f}x (required {}x)\n'.format(rates[1] / rates[0], MIN_SPEEDUP))
+    assert rates[1] >= MIN_SPEEDUP * rates[0], 'BitboardGameArena is only {:.1f}x faster than GameArena'.format(
+        rates[1] / rates[0])
+
+
+if '__main__' == __name__:
+    do_self_test()
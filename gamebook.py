@@ -0,0 +1,238 @@
+# coding=utf-8
+"""内存映射(mmap)的二进制开局库
+
+文件格式(小端):
+    文件头 16 字节: 魔数 b'GAMEBOOK', 版本号(uint32), 棋盘宽度(uint32, 用于解码走法)
+    之后是按 (局面哈希, 权重降序) 排序的定长条目, 每条 24 字节:
+        局面哈希(uint64), 走法(uint64, gametransposition.encode_move() 的结果), 权重(uint32), 保留(uint32)
+
+查询时通过 mmap 对文件做二分查找, 不把开局库读进内存, 多个工作进程打开同一个文件时共用操作系统的页缓存.
+开局库由 build_book() 从对局集合编译生成, 命令行: python gamebook.py build 输入文件 输出文件
+"""
+import json
+import mmap
+import os
+import struct
+import sys
+
+import gamearena
+from gametransposition import encode_move, decode_move
+
+BOOK_MAGIC = b'GAMEBOOK'
+BOOK_VERSION = 1
+HEADER = struct.Struct('<8sII')
+ENTRY = struct.Struct('<QQII')
+ENTRY_KEY = struct.Struct('<Q')
+
+
+class OpeningBook(object):
+    """只读开局库"""
+
+    def __init__(self, path):
+        self.path = path
+        self.__file = open(path, 'rb')
+        self.__map = mmap.mmap(self.__file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.width = HEADER.unpack_from(self.__map, 0)
+        if magic != BOOK_MAGIC or version != BOOK_VERSION:
+            self.close()
+            raise ValueError('{} is not an opening book (version {})'.format(path, BOOK_VERSION))
+        if (len(self.__map) - HEADER.size) % ENTRY.size:
+            self.close()
+            raise ValueError('{} is truncated'.format(path))
+        self.entry_count = (len(self.__map) - HEADER.size) // ENTRY.size
+
+    def close(self):
+        if self.__map is not None:
+            self.__map.close()
+            self.__file.close()
+            self.__map = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self.entry_count
+
+    def __find_first(self, key):
+        """二分查找第一条局面哈希 >= key 的条目的下标"""
+        book, lo, hi = self.__map, 0, self.entry_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if ENTRY_KEY.unpack_from(book, HEADER.size + mid * ENTRY.size)[0] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def entries(self, key):
+        """局面哈希为 key 的全部条目, 按权重从高到低
+
+        :return: [(move_code, weight), ...]
+        :rtype : list
+        """
+        book = self.__map
+        result = []
+        for index in range(self.__find_first(key), self.entry_count):
+            entry_key, move_code, weight, _ = ENTRY.unpack_from(book, HEADER.size + index * ENTRY.size)
+            if entry_key != key:
+                break
+            result.append((move_code, weight))
+        return result
+
+    def moves(self, arena):
+        """arena 当前局面的开局库走法, 只保留在当前局面合法的走法(防止哈希冲突)
+
+        :return: [(Move, weight), ...] 按权重从高到低
+        :rtype : list
+        """
+        candidates = self.entries(arena.position_hash)
+        if not candidates:
+            return []
+        legal = set(arena.retrieve_legal_moves_of_player(arena.side_to_move))
+        moves = []
+        for move_code, weight in candidates:
+            move = decode_move(move_code, self.width)
+            if move in legal:
+                moves.append((move, weight))
+        return moves
+
+    def choose_move(self, arena, rng=None):
+        """从开局库选一步棋
+
+        :param rng: 可选, random.Random 实例; 给出时按权重随机选择, 否则选权重最高的走法
+        :return: Move, 开局库里没有当前局面时返回 None
+        :rtype : Move
+        """
+        moves = self.moves(arena)
+        if not moves:
+            return None
+        if rng is None:
+            return moves[0][0]
+        pick = rng.uniform(0, sum(weight for move, weight in moves))
+        for move, weight in moves:
+            pick -= weight
+            if pick <= 0:
+                return move
+        return moves[-1][0]
+
+
+def read_games(path):
+    """读取对局集合, 逐盘给出 (坐标记法走法列表, 结果)
+
+    支持两种格式: gametournament 输出的 JSONL(使用 moves 和 result 字段),
+    或者每行一盘棋的文本文件(以空格分隔的坐标记法走法, 行末可以带 1-0、0-1 或 1/2-1/2)
+    """
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            if line.startswith('{'):
+                record = json.loads(line)
+                yield record['moves'].split(), record.get('result')
+            else:
+                tokens = line.split()
+                result = tokens.pop() if tokens and tokens[-1] in ('1-0', '0-1', '1/2-1/2', '*') else None
+                yield tokens, result
+
+
+def build_book(games, path, max_plies=20, min_weight=1, log=None):
+    """从对局集合编译开局库
+
+    每盘棋从初始局面开始回放前 max_plies 步, 每步棋按走棋一方的对局结果计权重: 胜 2, 和(或结果未知) 1, 负 0.
+    同一局面同一走法的权重累加, 累计权重小于 min_weight 的走法不写入开局库.
+
+    :param games: 可迭代对象, 每个元素为 (坐标记法走法列表, 结果)
+    :return: 写入的条目数
+    :rtype : int
+    """
+    weights = {}
+    width = 8
+    game_count = 0
+    for moves, result in games:
+        arena = gamearena.new_arena_from_fen(gamearena.START_POSITION_FEN)
+        width = arena.size[0]
+        for text in moves[:max_plies]:
+            move = gamearena.parse_coordinate_notation(arena, text)
+            if move is None:
+                break  # 棋谱有误, 忽略这盘棋的剩余部分
+            if result == '1-0':
+                weight = 2 if arena.side_to_move == gamearena.WHITE else 0
+            elif result == '0-1':
+                weight = 2 if arena.side_to_move == gamearena.BLACK else 0
+            else:
+                weight = 1
+            entry = (arena.position_hash, encode_move(move, width))
+            weights[entry] = weights.get(entry, 0) + weight
+            arena.make_move(move)
+        game_count += 1
+    entries = sorted(((key, -weight, move_code) for (key, move_code), weight in weights.items()
+                      if weight >= min_weight))
+    temporary = path + '.tmp'
+    with open(temporary, 'wb') as f:
+        f.write(HEADER.pack(BOOK_MAGIC, BOOK_VERSION, width))
+        for key, weight, move_code in entries:
+            f.write(ENTRY.pack(key, move_code, min(-weight, 0xffffffff), 0))
+    getattr(os, 'replace', os.rename)(temporary, path)  # 正在读取旧文件的进程不受影响
+    if log:
+        log.write('{} games, {} positions, {} entries written to {}\n'.format(
+            game_count, len(set(key for key, weight, move_code in entries)), len(entries), path))
+    return len(entries)
+
+
+def do_self_test():
+    """以下为模块自测试代码"""
+    import random
+    import tempfile
+    log = sys.stdout
+    log.write('Module:{}\n'.format(__name__))
+    games = [
+        ('e2e4 e7e5 g1f3 b8c6 f1b5'.split(), '1-0'),
+        ('e2e4 e7e5 g1f3 g8f6'.split(), '1/2-1/2'),
+        ('e2e4 c7c5 g1f3'.split(), '0-1'),
+        ('d2d4 d7d5 c2c4'.split(), None),
+    ]
+    path = os.path.join(tempfile.mkdtemp(), 'test.book')
+    build_book(games, path, log=log)
+    with OpeningBook(path) as book:
+        arena = gamearena.new_arena_from_fen(gamearena.START_POSITION_FEN)
+        moves = [(gamearena.coordinate_notation(move), weight) for move, weight in book.moves(arena)]
+        log.write('start position: {}\n'.format(moves))
+        assert moves == [('e2e4', 3), ('d2d4', 1)]
+        assert gamearena.coordinate_notation(book.choose_move(arena)) == 'e2e4'
+        assert book.choose_move(arena, random.Random(1)) is not None
+        arena.make_move(gamearena.parse_coordinate_notation(arena, 'e2e4'))
+        moves = [(gamearena.coordinate_notation(move), weight) for move, weight in book.moves(arena)]
+        assert moves == [('c7c5', 2), ('e7e5', 1)], moves
+        arena.make_move(gamearena.parse_coordinate_notation(arena, 'a7a6'))
+        assert book.choose_move(arena) is None
+        # gamegui 的走法: move_unit_to_somewhere() 之后给 side_to_move 赋值, 黑方也要查到开局库走法
+        arena = gamearena.new_arena_from_fen(gamearena.START_POSITION_FEN)
+        pawn = arena.unit_on_square(gamearena.Square(4, 1))
+        arena.move_unit_to_somewhere(pawn, gamearena.Square(4, 3))
+        arena.side_to_move = arena.next_player(arena.owner_of_unit(pawn))
+        assert arena.side_to_move == gamearena.BLACK
+        moves = [(gamearena.coordinate_notation(move), weight) for move, weight in book.moves(arena)]
+        assert moves == [('c7c5', 2), ('e7e5', 1)], moves
+    os.remove(path)
+
+
+def main():
+    """用法: python gamebook.py [build 输入文件 输出文件 [最大步数] | probe 开局库文件 ["FEN"]]"""
+    if len(sys.argv) > 3 and sys.argv[1] == 'build':
+        max_plies = int(sys.argv[4]) if len(sys.argv) > 4 else 20
+        build_book(read_games(sys.argv[2]), sys.argv[3], max_plies=max_plies, log=sys.stdout)
+    elif len(sys.argv) > 2 and sys.argv[1] == 'probe':
+        fen = sys.argv[3] if len(sys.argv) > 3 else gamearena.START_POSITION_FEN
+        with OpeningBook(sys.argv[2]) as book:
+            for move, weight in book.moves(gamearena.new_arena_from_fen(fen)):
+                print('{} {}'.format(gamearena.coordinate_notation(move), weight))
+    else:
+        do_self_test()
+
+
+if '__main__' == __name__:
+    main()
@@ -0,0 +1,211 @@
+# coding=utf-8
+"""子力价值 + 位置分值表(piece-square table)的局面评估, 支持用 NumPy 一次评估大批局面
+
+GameArena.square_vector() 把局面导出为每格一个字节的编码(0 为空, 1~6 白方兵马象車后王, 7~12 黑方),
+export_positions() 把一批局面拼成 (N, 64) 的 uint8 数组, evaluate_squares() 或 evaluate_planes()
+用一次向量化计算得出全部局面的分值, 不对每个局面做 Python 循环.
+evaluate() 是相同算法的单个局面版本, 不依赖 NumPy, 可以作为 gamesearch.Searcher 的 evaluate 参数.
+
+NumPy 是可选依赖, 只有批量评估需要它.
+"""
+import sys
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import gamearena
+from gamearena import WHITE, BLACK
+from gamearena import KingUnit, QueenUnit, RookUnit, BishopUnit, KnightUnit, WhitePawnUnit, BlackPawnUnit
+from gamesearch import UNIT_VALUES
+
+# 单位编码, 与 square_vector() 导出的字节一致
+UNIT_CODES = dict(
+    [((WHITE, unit_type), code) for code, unit_type in
+     enumerate((WhitePawnUnit, KnightUnit, BishopUnit, RookUnit, QueenUnit, KingUnit), 1)] +
+    [((BLACK, unit_type), code) for code, unit_type in
+     enumerate((BlackPawnUnit, KnightUnit, BishopUnit, RookUnit, QueenUnit, KingUnit), 7)])
+CODE_COUNT = 13
+
+# 白方的位置分值表, 按照棋盘从第 8 横行到第 1 横行的顺序书写(与看棋盘的方向一致)
+PIECE_SQUARE_TABLES = {
+    WhitePawnUnit: (
+        0, 0, 0, 0, 0, 0, 0, 0,
+        50, 50, 50, 50, 50, 50, 50, 50,
+        10, 10, 20, 30, 30, 20, 10, 10,
+        5, 5, 10, 25, 25, 10, 5, 5,
+        0, 0, 0, 20, 20, 0, 0, 0,
+        5, -5, -10, 0, 0, -10, -5, 5,
+        5, 10, 10, -20, -20, 10, 10, 5,
+        0, 0, 0, 0, 0, 0, 0, 0),
+    KnightUnit: (
+        -50, -40, -30, -30, -30, -30, -40, -50,
+        -40, -20, 0, 0, 0, 0, -20, -40,
+        -30, 0, 10, 15, 15, 10, 0, -30,
+        -30, 5, 15, 20, 20, 15, 5, -30,
+        -30, 0, 15, 20, 20, 15, 0, -30,
+        -30, 5, 10, 15, 15, 10, 5, -30,
+        -40, -20, 0, 5, 5, 0, -20, -40,
+        -50, -40, -30, -30, -30, -30, -40, -50),
+    BishopUnit: (
+        -20, -10, -10, -10, -10, -10, -10, -20,
+        -10, 0, 0, 0, 0, 0, 0, -10,
+        -10, 0, 5, 10, 10, 5, 0, -10,
+        -10, 5, 5, 10, 10, 5, 5, -10,
+        -10, 0, 10, 10, 10, 10, 0, -10,
+        -10, 10, 10, 10, 10, 10, 10, -10,
+        -10, 5, 0, 0, 0, 0, 5, -10,
+        -20, -10, -10, -10, -10, -10, -10, -20),
+    RookUnit: (
+        0, 0, 0, 0, 0, 0, 0, 0,
+        5, 10, 10, 10, 10, 10, 10, 5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        0, 0, 0, 5, 5, 0, 0, 0),
+    QueenUnit: (
+        -20, -10, -10, -5, -5, -10, -10, -20,
+        -10, 0, 0, 0, 0, 0, 0, -10,
+        -10, 0, 5, 5, 5, 5, 0, -10,
+        -5, 0, 5, 5, 5, 5, 0, -5,
+        0, 0, 5, 5, 5, 5, 0, -5,
+        -10, 5, 5, 5, 5, 5, 0, -10,
+        -10, 0, 5, 0, 0, 0, 0, -10,
+        -20, -10, -10, -5, -5, -10, -10, -20),
+    KingUnit: (
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -20, -30, -30, -40, -40, -30, -30, -20,
+        -10, -20, -20, -20, -20, -20, -20, -10,
+        20, 20, 0, 0, 0, 0, 20, 20,
+        20, 30, 10, 0, 0, 10, 30, 20),
+}
+
+
+def _square_scores():
+    """每种单位编码在每个格子(y*8+x)上的分值, 站在白方角度: 白方为正, 黑方为负"""
+    scores = [[0] * 64 for _ in range(CODE_COUNT)]
+    for (owner, unit_type), code in UNIT_CODES.items():
+        table = PIECE_SQUARE_TABLES[WhitePawnUnit if unit_type is BlackPawnUnit else unit_type]
+        value = UNIT_VALUES[unit_type]
+        for square in range(64):
+            x, y = square % 8, square // 8
+            if owner == WHITE:
+                scores[code][square] = value + table[(7 - y) * 8 + x]
+            else:
+                scores[code][square] = -(value + table[y * 8 + x])  # 黑方上下镜像
+    return scores
+
+
+SQUARE_SCORES = _square_scores()
+
+
+def evaluate(arena, player_id):
+    """单个局面的评估(不依赖 NumPy), 与批量评估的结果相同
+
+    :return: 站在玩家 player_id 角度的分值(单位: 1/100 兵)
+    :rtype : int
+    """
+    if arena.size != (8, 8):
+        raise ValueError('piece-square tables need an 8x8 board, got {}'.format(arena.size))
+    score = 0
+    for square, code in enumerate(arena.square_vector(UNIT_CODES)):
+        if code:
+            score += SQUARE_SCORES[code][square]
+    return score if player_id == WHITE else -score
+
+
+def _require_numpy():
+    if numpy is None:
+        raise ImportError('batch evaluation requires numpy (pip install numpy)')
+
+
+def export_positions(arenas):
+    """把一批 8x8 局面导出为数组
+
+    :return: (squares, sides): squares 为 (N, 64) uint8 单位编码, sides 为 (N,) int8, 白方走棋为 1, 黑方走棋为 -1
+    :rtype : tuple
+    """
+    _require_numpy()
+    vectors = bytearray()
+    sides = []
+    for arena in arenas:
+        if arena.size != (8, 8):
+            raise ValueError('piece-square tables need an 8x8 board, got {}'.format(arena.size))
+        vectors += arena.square_vector(UNIT_CODES)
+        sides.append(1 if arena.side_to_move == WHITE else -1)
+    return numpy.frombuffer(bytes(vectors), dtype=numpy.uint8).reshape(-1, 64), numpy.array(sides, dtype=numpy.int8)
+
+
+def piece_planes(squares):
+    """把 (N, 64) 单位编码转换成 (N, 12, 64) 的布尔棋子平面, 第 i 个平面对应编码 i+1"""
+    _require_numpy()
+    codes = numpy.arange(1, CODE_COUNT, dtype=numpy.uint8)
+    return numpy.asarray(squares)[:, None, :] == codes[None, :, None]
+
+
+def evaluate_squares(squares, sides=None, chunk_size=1 << 16):
+    """批量评估 (N, 64) 单位编码数组
+
+    :param sides: 可选, (N,) 数组, 给出时分值站在走棋一方的角度(1 白方, -1 黑方), 否则站在白方角度
+    :param chunk_size: 每次处理的局面数, 限制中间数组的内存
+    :rtype : numpy.ndarray
+    """
+    _require_numpy()
+    squares = numpy.asarray(squares, dtype=numpy.intp)
+    flat_scores = numpy.array(SQUARE_SCORES, dtype=numpy.int32).ravel()
+    columns = numpy.arange(64, dtype=numpy.intp)
+    result = numpy.empty(len(squares), dtype=numpy.int32)
+    for start in range(0, len(squares), chunk_size):
+        block = squares[start:start + chunk_size]
+        result[start:start + len(block)] = flat_scores[block * 64 + columns].sum(axis=1)
+    if sides is not None:
+        result *= numpy.asarray(sides, dtype=numpy.int32)
+    return result
+
+
+def evaluate_planes(planes, sides=None):
+    """批量评估 (N, 12, 64) 棋子平面, 结果与 evaluate_squares() 相同
+
+    :rtype : numpy.ndarray
+    """
+    _require_numpy()
+    weights = numpy.array(SQUARE_SCORES[1:], dtype=numpy.int32)
+    result = numpy.einsum('npk,pk->n', numpy.asarray(planes, dtype=numpy.int32), weights)
+    if sides is not None:
+        result *= numpy.asarray(sides, dtype=numpy.int32)
+    return result
+
+
+def do_self_test(batch_size=1000000):
+    """以下为模块自测试代码"""
+    log = sys.stdout
+    log.write('Module:{}\n'.format(__name__))
+    arenas = []
+    for name, fen, counts in gamearena.PERFT_POSITIONS:
+        arenas.append(gamearena.new_arena_from_fen(fen))
+        log.write('{:10s} {:>5d}\n'.format(name, evaluate(arenas[-1], arenas[-1].side_to_move)))
+    assert evaluate(arenas[0], WHITE) == 0
+    if numpy is None:
+        log.write('numpy not installed, skipping batch evaluation\n')
+        return
+    squares, sides = export_positions(arenas)
+    expected = [evaluate(arena, arena.side_to_move) for arena in arenas]
+    assert evaluate_squares(squares, sides).tolist() == expected
+    assert evaluate_planes(piece_planes(squares), sides).tolist() == expected
+    batch = numpy.tile(squares, (batch_size // len(squares) + 1, 1))[:batch_size]
+    started = time.time()
+    evaluate_squares(batch)
+    seconds = time.time() - started
+    log.write('evaluate_squares: {} positions in {:.2f}s, {:.0f} positions/s\n'.format(
+        batch_size, seconds, batch_size / max(seconds, 1e-9)))
+
+
+if '__main__' == __name__:
+    do_self_test()
@@ -9,6 +9,7 @@ import direct.showbase.ShowBase
 import direct.gui.OnscreenText
 import direct.task.Task
 import gamearena
+import gamebook
 
 
 class IllegalMoveException(Exception):
@@ -17,7 +18,7 @@ class IllegalMoveException(Exception):
 
 class MyChessboard(direct.showbase.ShowBase.ShowBase):
 
-    def __init__(self, fStartDirect=True, windowType=None):
+    def __init__(self, fStartDirect=True, windowType=None, book_path=None):
         direct.showbase.ShowBase.ShowBase.__init__(self, fStartDirect=fStartDirect, windowType=windowType)
         self.disableMouse()
         # Since we are using collision detection to do picking, we set it up like
@@ -103,6 +104,13 @@ class MyChessboard(direct.showbase.ShowBase.ShowBase):
         # Usage: self.__pidOnSquare[i], 其中: 0<=i<64. i=0 时代表棋盘 a1 格, i=63 时代表棋盘 h8 格
         self.__pidOnSquare = piece_id_sorted_by_square
 
+        # 可选的开局库, 每走一步后在屏幕上提示开局库里的下一步棋
+        self.__book = gamebook.OpeningBook(book_path) if book_path else None
+        self.__bookHint = direct.gui.OnscreenText.OnscreenText(
+            text='', parent=self.a2dTopRight, align=panda3d.core.TextNode.ARight,
+            style=1, fg=(1, 1, 1, 1), pos=(-0.06, -0.1), scale=.05)
+        self.__updateBookHint()
+
         self.__graveyard = self.__defaultGraveyard()  # 初始化虚拟墓地空间用于容放被吃掉的棋子
         self.__pointingTo = 0  # 取值范围: 整数 0 表示当前没有鼠标指针指向的棋盘格子, 整数 1~64 表示鼠标指向 64 个棋盘方格之一
         self.__dragging = 0  # 取值范围: 整数 0 表示当前鼠标指针没有拖拽住棋盘格子上的棋子, 整数 1~64 表示正在拖拽, 被拖拽的棋子原位于 64 个棋盘方格之一
@@ -330,9 +338,9 @@ class MyChessboard(direct.showbase.ShowBase.ShowBase):
         pid = self.__pidOnSquare[fr]
         if not pid:
             return False
-        valid_moves = self.arena.retrieve_valid_moves_of_unit(pid)
         destination = gamearena.Square(x=to%8, y=to//8)
-        return destination in valid_moves
+        # 界面通过 move_unit_to_somewhere() 同步移动棋子, 还不能处理王車易位和吃过路兵
+        return self.arena.is_legal_move(pid, destination, special_moves=False)
 
     def __movePiece(self, fr, to):
         """
@@ -363,6 +371,19 @@ class MyChessboard(direct.showbase.ShowBase.ShowBase):
         # 必须同步移动 Arena 中的棋子
         destination = gamearena.Square(x=to%8, y=to//8)
         self.arena.move_unit_to_somewhere(pid1, destination)
+        self.arena.side_to_move = self.arena.next_player(self.arena.owner_of_unit(pid1))
+        self.__updateBookHint()
+
+    def __updateBookHint(self):
+        """显示开局库中当前局面的走法"""
+        if self.__book is None:
+            return
+        moves = self.__book.moves(self.arena)
+        if moves:
+            text = 'Book: ' + ' '.join(gamearena.coordinate_notation(move) for move, weight in moves[:3])
+        else:
+            text = ''
+        self.__bookHint.setText(text)
 
     def __sendToGraveyard(self, pid):
         piece = self.__pieces[pid]
@@ -446,7 +467,7 @@ def main():
     directionalLight.setDirection(panda3d.core.LVector3(0, 45, -45))
     directionalLight.setColor((0.2, 0.2, 0.2, 1))
 
-    base = MyChessboard()
+    base = MyChessboard(book_path=sys.argv[1] if len(sys.argv) > 1 else None)  # 可选参数: 开局库文件
     base.render.setLight(base.render.attachNewNode(ambientLight))  # 设置光源
     base.render.setLight(base.render.attachNewNode(directionalLight))  # 设置光源
     base.run()
@@ -0,0 +1,462 @@
+# coding=utf-8
+"""FEN/EPD 局面记法: 解析、导出, 以及从大文件中流式读取 EPD 局面
+
+FEN 没有记录棋子是否移动过, 读取时按以下规则推断 has_been_moved:
+兵在初始横行上视为没有移动过; 王和車按照王車易位权利推断; 其他棋子一律视为已经移动过.
+与推断结果不一致的棋子, 导出 EPD 时用两个扩展操作记录: moved "格子..." 和 unmoved "格子...",
+读取时据此修正, 因此 EPD 可以原样保存走棋方、王車易位权利和每个棋子的 has_been_moved.
+EPD 的 hmvc 和 fmvn 操作对应半回合计数和回合数.
+
+read_epd() 逐行读取 EPD 文件, 可以反复使用同一个 GameArena(见 GameArena.load_units()), 速度指标为
+EPD_POSITIONS_PER_SECOND_TARGET 局面/秒, 用 python gamenotation.py bench 测量. 在单核 x86-64 Linux 虚拟机、
+CPython 3.11 上约为 5800~7500 局面/秒(同一台机器多次测量的范围), 大部分时间花在 GameArena.load_units() 上.
+"""
+import collections
+import io
+import os
+import re
+import sys
+import tempfile
+import time
+
+import gamearena
+from gamearena import GameArena, Square, WHITE, BLACK, AbstractPawnUnit
+from gamearena import MOVE_CAPTURE, MOVE_CASTLING, MOVE_PROMOTION, PROMOTION_UNIT_TYPES
+from gamearena import KingUnit, QueenUnit, RookUnit, BishopUnit, KnightUnit, WhitePawnUnit, BlackPawnUnit
+
+EPD_POSITIONS_PER_SECOND_TARGET = 5000
+
+# FEN 字母 -> (玩家, 单位类型)
+FEN_UNITS = {
+    'K': (WHITE, KingUnit), 'Q': (WHITE, QueenUnit), 'R': (WHITE, RookUnit),
+    'B': (WHITE, BishopUnit), 'N': (WHITE, KnightUnit), 'P': (WHITE, WhitePawnUnit),
+    'k': (BLACK, KingUnit), 'q': (BLACK, QueenUnit), 'r': (BLACK, RookUnit),
+    'b': (BLACK, BishopUnit), 'n': (BLACK, KnightUnit), 'p': (BLACK, BlackPawnUnit),
+}
+# (玩家, 单位类型) -> FEN 字母的 ASCII 码, 用作 GameArena.square_vector() 的编码
+FEN_CODES = dict((unit, ord(letter)) for letter, unit in FEN_UNITS.items())
+# SAN 标准代数记法的棋子字母, 兵没有字母
+SAN_LETTERS = {KingUnit: 'K', QueenUnit: 'Q', RookUnit: 'R', BishopUnit: 'B', KnightUnit: 'N'}
+SAN_UNIT_TYPES = dict((letter, unit_type) for unit_type, letter in SAN_LETTERS.items())
+# EPD 的一个操作: 到分号(或者行尾)为止, 引号内的分号不算
+EPD_OPERATION_PATTERN = re.compile(r'((?:[^;"]|"[^"]*")*)(?:;|$)')
+SAN_PATTERN = re.compile(r'^([KQRBN])?([a-z])??([0-9]+)??x?([a-z][0-9]+)(?:=?([QRBN]))?$')
+
+# units: [(玩家, Square, 单位类型, 是否移动过), ...] 按 FEN 的书写顺序(第 8 横行到第 1 横行)
+Position = collections.namedtuple('Position', ['width', 'ranks', 'units', 'side_to_move', 'en_passant',
+                                               'halfmove_clock', 'fullmove_number'])
+
+
+_squares = {}  # (x, y) -> Square, 解析 FEN 时重复使用同一批 Square 对象
+
+
+def square_name(square):
+    return '{}{}'.format(chr(ord('a') + square[0]), square[1] + 1)
+
+
+def parse_square(text):
+    if len(text) < 2 or not 'a' <= text[0] <= 'z' or not text[1:].isdigit():
+        raise ValueError('invalid square: {!r}'.format(text))
+    return Square(ord(text[0]) - ord('a'), int(text[1:]) - 1)
+
+
+def parse_fen(fen, moved=(), unmoved=()):
+    """解析 FEN(至少包括棋子位置和走棋方两个字段, 其余字段可以省略)
+
+    :param moved: 额外标记为移动过的格子(EPD 扩展操作 moved)
+    :param unmoved: 额外标记为没有移动过的格子(EPD 扩展操作 unmoved)
+    :rtype : Position
+    """
+    fields = fen.split()
+    if not fields:
+        raise ValueError('empty FEN')
+    rows = fields[0].split('/')
+    ranks = len(rows)
+    units = []
+    width = None
+    for i, row in enumerate(rows):
+        y = ranks - 1 - i
+        x = 0
+        skip = 0
+        for c in row:
+            if c.isdigit():
+                skip = skip * 10 + int(c)
+                continue
+            x += skip
+            skip = 0
+            try:
+                player_id, unit_type = FEN_UNITS[c]
+            except KeyError:
+                raise ValueError('invalid piece {!r} in FEN: {}'.format(c, fen))
+            if unit_type is WhitePawnUnit:
+                has_been_moved = y != 1
+            elif unit_type is BlackPawnUnit:
+                has_been_moved = y != ranks - 2
+            else:
+                has_been_moved = True
+            square = _squares.get((x, y))
+            if square is None:
+                square = _squares[(x, y)] = Square(x, y)
+            units.append([player_id, square, unit_type, has_been_moved])
+            x += 1
+        x += skip
+        if width is None:
+            width = x
+        elif x != width:
+            raise ValueError('rank {} has {} squares instead of {}: {}'.format(y + 1, x, width, fen))
+    castling = fields[2] if len(fields) > 2 else '-'
+    for player_id, letters in ((WHITE, 'KQ'), (BLACK, 'kq')):
+        kings = [unit for unit in units if unit[0] == player_id and unit[2] is KingUnit]
+        if not kings or (letters[0] not in castling and letters[1] not in castling):
+            continue
+        king = kings[0]
+        home_rooks = sorted((unit for unit in units if unit[0] == player_id and unit[2] is RookUnit
+                             and unit[1].y == king[1].y), key=lambda unit: unit[1].x)
+        king[3] = False
+        if letters[0] in castling:
+            for rook in home_rooks[-1:]:
+                if rook[1].x > king[1].x:
+                    rook[3] = False
+        if letters[1] in castling:
+            for rook in home_rooks[:1]:
+                if rook[1].x < king[1].x:
+                    rook[3] = False
+    if moved or unmoved:
+        overrides = dict([(Square(*s), True) for s in moved] + [(Square(*s), False) for s in unmoved])
+        for unit in units:
+            unit[3] = overrides.get(unit[1], unit[3])
+    side_to_move = BLACK if len(fields) > 1 and fields[1] == 'b' else WHITE
+    en_passant = parse_square(fields[3]) if len(fields) > 3 and fields[3] != '-' else None
+    halfmove_clock = int(fields[4]) if len(fields) > 4 else 0
+    fullmove_number = int(fields[5]) if len(fields) > 5 else 1
+    return Position(width, ranks, [tuple(unit) for unit in units], side_to_move, en_passant,
+                    halfmove_clock, fullmove_number)
+
+
+def load_position(position, arena=None):
+    """按照 Position 摆放局面
+
+    :param arena: 可选, 尺寸相同时直接清空并重用这个竞技场, 否则新建一个
+    :rtype : GameArena
+    """
+    if arena is None or arena.size != (position.width, position.ranks):
+        arena = GameArena(width=position.width, ranks=position.ranks)
+    arena.load_units(position.units, side_to_move=position.side_to_move)
+    if position.en_passant is not None:
+        arena.en_passant_square = position.en_passant
+    arena.halfmove_clock = position.halfmove_clock
+    arena.fullmove_number = position.fullmove_number
+    return arena
+
+
+def load_fen(fen, arena=None):
+    """按照 FEN 字符串摆放一个国际象棋局面(白方为 WHITE, 黑方为 BLACK)
+
+    :param arena: 可选, 尺寸相同时直接清空并重用这个竞技场
+    :rtype : GameArena
+    """
+    return load_position(parse_fen(fen), arena)
+
+
+def __placement_and_castling(arena):
+    """FEN 的棋子位置字段和王車易位字段"""
+    xmax, ymax = arena.size
+    vector = arena.square_vector(FEN_CODES)
+    rows = []
+    for y in range(ymax - 1, -1, -1):
+        row, empty = '', 0
+        for code in vector[y * xmax:(y + 1) * xmax]:
+            if code:
+                if empty:
+                    row += str(empty)
+                    empty = 0
+                row += chr(code)
+            else:
+                empty += 1
+        rows.append(row + (str(empty) if empty else ''))
+    castling = ''
+    for player_id, letters in ((WHITE, 'KQ'), (BLACK, 'kq')):
+        for king_id in arena.units_of_type(KingUnit):
+            if arena.owner_of_unit(king_id) != player_id or arena.is_unit_moved(king_id):
+                continue
+            king_square = arena.find_square_from_unit_id(king_id)
+            rooks = [arena.find_square_from_unit_id(rook_id).x for rook_id in arena.units_of_type(RookUnit)
+                     if arena.owner_of_unit(rook_id) == player_id and not arena.is_unit_moved(rook_id)
+                     and arena.find_square_from_unit_id(rook_id).y == king_square.y]
+            if any(x > king_square.x for x in rooks):
+                castling += letters[0]
+            if any(x < king_square.x for x in rooks):
+                castling += letters[1]
+    return '/'.join(rows), castling or '-'
+
+
+def arena_to_fen(arena):
+    """导出 GameArena 当前局面的 FEN(白方为 WHITE, 黑方为 BLACK)
+
+    :rtype : str
+    """
+    placement, castling = __placement_and_castling(arena)
+    en_passant = arena.en_passant_square
+    return '{} {} {} {} {} {}'.format(placement, 'w' if arena.side_to_move == WHITE else 'b', castling,
+                                      square_name(en_passant) if en_passant else '-',
+                                      arena.halfmove_clock, arena.fullmove_number)
+
+
+def move_to_san(arena, move):
+    """走法的 SAN 标准代数记法, 例如 e4、Nbd7、exd6、O-O、e8=Q+、Qh4#
+
+    :param move: arena 当前局面轮到走棋一方的一步合法走法
+    :rtype : str
+    """
+    origin, destination, flags = move
+    unit_type = arena.type_of_unit(arena.unit_on_square(origin))
+    if flags & MOVE_CASTLING:
+        text = 'O-O' if destination[0] > origin[0] else 'O-O-O'
+    elif issubclass(unit_type, AbstractPawnUnit):
+        text = square_name(origin)[0] + 'x' if flags & MOVE_CAPTURE else ''
+        text += square_name(destination)
+        if flags & MOVE_PROMOTION:
+            text += '=' + SAN_LETTERS[PROMOTION_UNIT_TYPES[flags >> 5]]
+    else:
+        # 同类型的其他棋子也能走到同一个格子时, 依次用纵列、横行、格子区分
+        rivals = [m.origin for m in arena.retrieve_legal_moves_of_player(arena.side_to_move, unit_types=(unit_type,))
+                  if m.destination == destination and m.origin != origin]
+        name = square_name(origin)
+        if not rivals:
+            prefix = ''
+        elif all(square[0] != origin[0] for square in rivals):
+            prefix = name[0]
+        elif all(square[1] != origin[1] for square in rivals):
+            prefix = name[1:]
+        else:
+            prefix = name
+        text = SAN_LETTERS[unit_type] + prefix + ('x' if flags & MOVE_CAPTURE else '') + square_name(destination)
+    arena.make_move(move)
+    try:
+        if arena.is_in_check(arena.side_to_move):
+            text += '#' if not arena.retrieve_legal_moves_of_player(arena.side_to_move) else '+'
+    finally:
+        arena.unmake_move()
+    return text
+
+
+def parse_san(arena, text):
+    """move_to_san() 的逆运算: 在 arena 当前局面轮到走棋一方的合法走法中找出 SAN 记法 text 对应的走法
+
+    也接受 0-0、省略等号的升变(e8Q)以及 +、#、!、? 等后缀
+    :return: 对应的 Move, 不是合法走法或者有歧义时上报 ValueError
+    :rtype : Move
+    """
+    san = text.rstrip('+#!?')
+    player_id = arena.side_to_move
+    if san in ('O-O', '0-0', 'O-O-O', '0-0-0'):
+        kingside = len(san) == 3
+        candidates = [move for move in arena.retrieve_legal_moves_of_player(player_id, unit_types=(KingUnit,))
+                      if move.flags & MOVE_CASTLING and (move.destination[0] > move.origin[0]) == kingside]
+    else:
+        match = SAN_PATTERN.match(san)
+        if match is None:
+            raise ValueError('invalid SAN: {!r}'.format(text))
+        letter, file_letter, rank_digits, target, promotion = match.groups()
+        destination = parse_square(target)
+        # 只生成记法中那一类单位的走法, 比生成全部合法走法快得多
+        unit_types = (SAN_UNIT_TYPES[letter],) if letter else (WhitePawnUnit, BlackPawnUnit)
+        candidates = []
+        for move in arena.retrieve_legal_moves_of_player(player_id, unit_types=unit_types):
+            origin = move.origin
+            if move.destination != destination:
+                continue
+            if file_letter is not None and origin[0] != ord(file_letter) - ord('a'):
+                continue
+            if rank_digits is not None and origin[1] != int(rank_digits) - 1:
+                continue
+            if move.flags & MOVE_PROMOTION:
+                if promotion is None or PROMOTION_UNIT_TYPES[move.flags >> 5] is not SAN_UNIT_TYPES[promotion]:
+                    continue
+            elif promotion is not None:
+                continue
+            candidates.append(move)
+    if len(candidates) != 1:
+        raise ValueError('{} SAN: {!r}'.format('ambiguous' if candidates else 'illegal', text))
+    return candidates[0]
+
+
+def parse_epd(line):
+    """解析一行 EPD: 四个 FEN 字段, 之后是若干以分号结束的操作, 例如 bm e4; id "test 1";
+
+    :return: (FEN 前四个字段, 操作字典 {操作码: 操作数字符串}, 带引号的操作数去掉引号)
+    :rtype : tuple
+    """
+    fields = line.split(None, 4)
+    if len(fields) < 4:
+        raise ValueError('EPD needs at least 4 fields: {!r}'.format(line))
+    operations = collections.OrderedDict()
+    rest = fields[4] if len(fields) > 4 else ''
+    position = 0
+    while rest[position:].strip():
+        match = EPD_OPERATION_PATTERN.match(rest, position)
+        if match is None:
+            raise ValueError('unterminated string in EPD: {!r}'.format(line))
+        position = match.end()
+        parts = match.group(1).split(None, 1)
+        if not parts:
+            continue
+        opcode, operand = parts[0], parts[1].strip() if len(parts) > 1 else ''
+        if len(operand) >= 2 and operand[0] == operand[-1] == '"':
+            operand = operand[1:-1]
+        operations[opcode] = operand
+    return ' '.join(fields[:4]), operations
+
+
+def load_epd(line, arena=None):
+    """按照一行 EPD 摆放局面
+
+    :return: (GameArena, 操作字典)
+    :rtype : tuple
+    """
+    fen, operations = parse_epd(line)
+    moved = [parse_square(s) for s in operations.get('moved', '').split()]
+    unmoved = [parse_square(s) for s in operations.get('unmoved', '').split()]
+    fen += ' {} {}'.format(operations.get('hmvc', 0), operations.get('fmvn', 1))
+    return load_position(parse_fen(fen, moved, unmoved), arena), operations
+
+
+def arena_to_epd(arena, operations=None):
+    """导出 GameArena 当前局面的 EPD, 包括与 FEN 推断结果不一致的 has_been_moved
+
+    :param operations: 可选, 追加的操作 {操作码: 操作数}, 操作数含空格时自动加引号
+    :rtype : str
+    """
+    placement, castling = __placement_and_castling(arena)
+    en_passant = arena.en_passant_square
+    fen = '{} {} {} {}'.format(placement, 'w' if arena.side_to_move == WHITE else 'b', castling,
+                               square_name(en_passant) if en_passant else '-')
+    inferred = dict((square, has_been_moved) for player_id, square, unit_type, has_been_moved
+                    in parse_fen(fen).units)
+    moved, unmoved = [], []
+    for player_id in arena.players:
+        for unit_id in arena.units_of_player(player_id):
+            square = arena.find_square_from_unit_id(unit_id)
+            actual = arena.is_unit_moved(unit_id)
+            if actual != inferred[square]:
+                (moved if actual else unmoved).append(square)
+    ops = collections.OrderedDict()
+    if moved:
+        ops['moved'] = ' '.join(square_name(s) for s in sorted(moved, key=lambda s: (s.y, s.x)))
+    if unmoved:
+        ops['unmoved'] = ' '.join(square_name(s) for s in sorted(unmoved, key=lambda s: (s.y, s.x)))
+    if arena.halfmove_clock:
+        ops['hmvc'] = str(arena.halfmove_clock)
+    if arena.fullmove_number != 1:
+        ops['fmvn'] = str(arena.fullmove_number)
+    ops.update(operations or {})
+    text = fen
+    for opcode, operand in ops.items():
+        operand = str(operand)
+        text += ' {} {};'.format(opcode, '"{}"'.format(operand) if ' ' in operand or not operand else operand)
+    return text
+
+
+def read_epd(source, reuse_arena=True):
+    """逐行读取 EPD 文件(空行和以 # 开头的行被忽略), 不把整个文件读进内存
+
+    :param source: 文件名或者已经打开的文本文件
+    :param reuse_arena: 为 True 时每一行都重新摆放在同一个 GameArena 上(调用者需在读取下一行之前用完上一个局面),
+                        为 False 时每一行新建一个 GameArena
+    :return: 生成器, 逐行给出 (GameArena, 操作字典)
+    """
+    f = open(source) if isinstance(source, str) else source
+    try:
+        arena = None
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            arena, operations = load_epd(line, arena if reuse_arena else None)
+            yield arena, operations
+    finally:
+        if f is not source:
+            f.close()
+
+
+def write_epd(arenas, target):
+    """把一批局面写成 EPD 文件, arenas 中的元素可以是 GameArena 或者 (GameArena, 操作字典)"""
+    f = open(target, 'w') if isinstance(target, str) else target
+    try:
+        for item in arenas:
+            arena, operations = item if isinstance(item, tuple) else (item, None)
+            f.write(arena_to_epd(arena, operations) + '\n')
+    finally:
+        if f is not target:
+            f.close()
+
+
+def benchmark(count=20000, log=None):
+    """读取 count 行 EPD 的速度
+
+    :return: 局面/秒
+    :rtype : float
+    """
+    log = log or sys.stdout
+    lines = [arena_to_epd(load_fen(fen), {'id': name}) for name, fen, counts in gamearena.PERFT_POSITIONS]
+    path = os.path.join(tempfile.mkdtemp(), 'bench.epd')
+    with open(path, 'w') as f:
+        for i in range(count):
+            f.write(lines[i % len(lines)] + '\n')
+    started = time.time()
+    positions = sum(1 for _ in read_epd(path))
+    seconds = time.time() - started
+    os.remove(path)
+    rate = positions / max(seconds, 1e-9)
+    log.write('read_epd: {} positions in {:.2f}s, {:.0f} positions/s (target {}: {})\n'.format(
+        positions, seconds, rate, EPD_POSITIONS_PER_SECOND_TARGET,
+        'ok' if rate >= EPD_POSITIONS_PER_SECOND_TARGET else 'FAIL'))
+    return rate
+
+
+def do_self_test():
+    """以下为模块自测试代码"""
+    log = sys.stdout
+    log.write('Module:{}\n'.format(__name__))
+    for name, fen, counts in gamearena.PERFT_POSITIONS:
+        arena = load_fen(fen)
+        assert arena_to_fen(arena) == fen, (arena_to_fen(arena), fen)
+        assert load_fen(arena_to_fen(arena)).position_hash == arena.position_hash
+    # 走几步棋以后(包括冲兵两格和王移动), FEN 与 EPD 都能还原局面
+    arena = load_fen(gamearena.START_POSITION_FEN)
+    for text in 'e2e4 c7c5 e4e5 d7d5 e1e2 b8c6'.split():
+        arena.make_move(gamearena.parse_coordinate_notation(arena, text))
+    fen = arena_to_fen(arena)
+    log.write('{}\n'.format(fen))
+    assert fen == 'r1bqkbnr/pp2pppp/2n5/2ppP3/8/8/PPPPKPPP/RNBQ1BNR w kq - 2 4', fen
+    # 直接征募的棋子都没有移动过, 与 FEN 的推断不同, 只有 EPD 能保存
+    arena = GameArena(8, 8)
+    knight = arena.new_unit_recruited_by_player(WHITE, (1, 0), KnightUnit)
+    king = arena.new_unit_recruited_by_player(WHITE, (4, 0), KingUnit)
+    rooks = [arena.new_unit_recruited_by_player(WHITE, (x, 0), RookUnit) for x in (0, 5, 7)]
+    arena.new_unit_recruited_by_player(BLACK, (4, 7), KingUnit)
+    arena.mark_unit_moved(rooks[2])
+    epd = arena_to_epd(arena, {'id': 'round trip'})
+    log.write('{}\n'.format(epd))
+    copy, operations = load_epd(epd)
+    assert operations['id'] == 'round trip'
+    # 没有操作数的操作码不影响后面的操作, 引号里的分号不结束操作
+    fen, operations = parse_epd('rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - noop; id "start pos"; bm e4;')
+    assert list(operations.items()) == [('noop', ''), ('id', 'start pos'), ('bm', 'e4')], operations
+    fen, operations = parse_epd('8/8/8/8/8/8/8/K6k w - - c0 "a; b";bm  Ka2 Kb1 ;noop')
+    assert list(operations.items()) == [('c0', 'a; b'), ('bm', 'Ka2 Kb1'), ('noop', '')], operations
+    for unit_id in [knight, king] + rooks:
+        square = arena.find_square_from_unit_id(unit_id)
+        assert copy.is_unit_moved(copy.unit_on_square(square)) == arena.is_unit_moved(unit_id), square
+    assert copy.position_hash == arena.position_hash
+    assert len(copy.retrieve_legal_moves_of_player(WHITE)) == len(arena.retrieve_legal_moves_of_player(WHITE))
+    stream = io.StringIO(u'\n'.join(arena_to_epd(load_fen(fen)) for name, fen, counts in gamearena.PERFT_POSITIONS))
+    assert [gamearena.perft(a, 1) for a, ops in read_epd(stream)] == [c[0] for n, f, c in gamearena.PERFT_POSITIONS]
+    benchmark(log=log)
+
+
+if '__main__' == __name__:
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        benchmark(count=int(sys.argv[2]) if len(sys.argv) > 2 else 20000)
+    else:
+        do_self_test()
@@ -0,0 +1,139 @@
+# coding=utf-8
+"""多进程并行搜索(Lazy SMP)
+
+Python 线程受 GIL 限制无法加速 CPU 密集的搜索, 因此这里用多个进程搜索同一个局面.
+所有进程共用一块 multiprocessing.shared_memory 里的置换表, 各自独立做迭代加深搜索,
+通过置换表互相利用对方的结果; 编号为奇数的辅助进程从深一层开始搜索, 使各进程的搜索顺序错开.
+0 号主进程完成搜索后通知其它进程停止, 最终结果取主进程的结果, 节点数为所有进程之和.
+
+置换表条目带异或校验(见 gametransposition), 多个进程并发读写不加锁, 被写坏的条目只会被当作未命中.
+"""
+import multiprocessing
+import multiprocessing.shared_memory
+import queue
+import sys
+import time
+
+import gamearena
+from gamesearch import Searcher, SearchLimits
+from gametransposition import TranspositionTable
+
+RESULT_POLL_SECONDS = 0.5  # 等待结果时每隔这么久检查一次子进程是否还活着
+
+
+def _search_worker(worker_index, arena, limits, shm_name, tt_size_mb, stop_event, results):
+    """在子进程里运行: 挂接共享置换表并搜索, 把 (worker_index, SearchResult, nodes) 放进 results 队列"""
+    shm = multiprocessing.shared_memory.SharedMemory(name=shm_name)
+    try:
+        table = TranspositionTable(tt_size_mb, buffer=shm.buf)
+        searcher = Searcher(table=table, stop_event=stop_event if worker_index else None)
+        result = searcher.search(arena, limits, first_depth=1 + worker_index % 2)
+        results.put((worker_index, result, searcher.nodes))
+        del searcher, table  # 释放对共享内存的引用, 否则 close() 报 BufferError
+    finally:
+        shm.close()
+
+
+def parallel_search(arena, limits=None, workers=None, tt_size_mb=64):
+    """用 workers 个进程搜索 arena 当前局面, arena 本身不会被修改
+
+    :param limits: SearchLimits, 由 0 号主进程遵守, 其它进程在主进程结束时停止
+    :param workers: 进程数, 默认为 CPU 核数
+    :rtype : SearchResult
+    """
+    limits = limits or SearchLimits()
+    workers = workers or multiprocessing.cpu_count()
+    started = time.time()
+    shm = multiprocessing.shared_memory.SharedMemory(create=True, size=TranspositionTable.bytes_needed(tt_size_mb))
+    try:
+        shm.buf[:] = bytes(shm.size)
+        stop_event = multiprocessing.Event()
+        results = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=_search_worker,
+                                             args=(i, arena, limits, shm.name, tt_size_mb, stop_event, results))
+                     for i in range(workers)]
+        for process in processes:
+            process.start()
+        try:
+            main_result, total_nodes = None, 0
+            pending = set(range(workers))  # 尚未交回结果的进程
+            while pending:
+                try:
+                    worker_index, result, nodes = results.get(timeout=RESULT_POLL_SECONDS)
+                except queue.Empty:
+                    _check_workers_alive(processes, pending, results)
+                    continue
+                pending.discard(worker_index)
+                total_nodes += nodes
+                if worker_index == 0:
+                    main_result = result
+                    stop_event.set()
+            for process in processes:
+                process.join()
+        finally:
+            stop_event.set()
+            for process in processes:
+                if process.is_alive():  # 出错时不留下孤儿进程
+                    process.terminate()
+                    process.join()
+    finally:
+        shm.close()
+        shm.unlink()
+    return main_result._replace(nodes=total_nodes, seconds=time.time() - started)
+
+
+def _check_workers_alive(processes, pending, results):
+    """还没有交回结果的进程已经退出(崩溃、内存不足被杀等)时上报 RuntimeError, 否则 parallel_search() 会永远等下去"""
+    for worker_index in sorted(pending):
+        exitcode = processes[worker_index].exitcode
+        if exitcode is None:
+            continue
+        # 进程退出前放进队列的结果可能还在管道里, 再等一次
+        try:
+            item = results.get(timeout=RESULT_POLL_SECONDS)
+        except queue.Empty:
+            raise RuntimeError('search worker {} exited with code {} without a result'.format(worker_index, exitcode))
+        results.put(item)  # 交给调用者的循环处理
+        return
+
+
+def speedup_curve(fen=None, depth=4, max_workers=None, log=None):
+    """以 1~max_workers 个进程分别搜索到固定深度, 报告达到该深度的用时(time-to-depth)和相对单进程的加速比
+
+    :return: [(进程数, 用时, 加速比), ...]
+    :rtype : list
+    """
+    log = log or sys.stdout
+    fen = fen or gamearena.PERFT_POSITIONS[1][1]
+    max_workers = max_workers or multiprocessing.cpu_count()
+    curve = []
+    baseline = None
+    for workers in range(1, max_workers + 1):
+        arena = gamearena.new_arena_from_fen(fen)
+        result = parallel_search(arena, SearchLimits(depth=depth), workers=workers)
+        baseline = baseline or result.seconds
+        curve.append((workers, result.seconds, baseline / result.seconds))
+        log.write('workers {:>3d} depth {} time {:7.2f}s nodes {:>9d} speedup {:5.2f}x best {}\n'.format(
+            workers, result.depth, result.seconds, result.nodes, baseline / result.seconds,
+            gamearena.coordinate_notation(result.move) if result.move else '(none)'))
+    return curve
+
+
+def main():
+    """用法: python gameparallel.py [curve [深度] [最大进程数] | 进程数 [秒数] ["FEN"]]"""
+    if len(sys.argv) > 1 and sys.argv[1] == 'curve':
+        speedup_curve(depth=int(sys.argv[2]) if len(sys.argv) > 2 else 4,
+                      max_workers=int(sys.argv[3]) if len(sys.argv) > 3 else None)
+        return
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else None
+    movetime = float(sys.argv[2]) if len(sys.argv) > 2 else 5.0
+    fen = sys.argv[3] if len(sys.argv) > 3 else gamearena.START_POSITION_FEN
+    result = parallel_search(gamearena.new_arena_from_fen(fen), SearchLimits(movetime=movetime), workers=workers)
+    print('depth {} score {} nodes {} time {:.2f} pv {}'.format(
+        result.depth, result.score, result.nodes, result.seconds,
+        ' '.join(gamearena.coordinate_notation(m) for m in result.pv)))
+    print('bestmove {}'.format(gamearena.coordinate_notation(result.move) if result.move else '(none)'))
+
+
+if '__main__' == __name__:
+    main()
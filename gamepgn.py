@@ -0,0 +1,266 @@
+# coding=utf-8
+"""PGN 棋谱的流式读取
+
+read_pgn() 是一个生成器, 逐行读取 PGN 文件, 每次只在内存里保留一盘棋, 多 GB 的棋谱库也只占用固定的内存.
+每盘棋的 SAN 着法由 gamenotation.parse_san() 在合法走法中解析, 同时在 GameArena 上回放, 着法有误时记录在
+PgnGame.error 中, 不影响后面的对局. 注释 {...}、; 行注释、变着 (...)、NAG $n 和着法编号都被忽略.
+
+workers > 1 时由多个进程并行解析, 主进程只负责切分对局文本, 同时交给子进程的对局数有上限, 内存仍然固定,
+产出的对局保持文件中的原有顺序.
+
+命令行: python gamepgn.py 棋谱文件 [进程数]            统计棋谱
+        python gamepgn.py convert 棋谱文件 输出文件 [进程数]  转换成 gamebook.read_games() 能读取的坐标记法文本
+"""
+import collections
+import multiprocessing
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+
+import gamearena
+import gamenotation
+
+PgnGame = collections.namedtuple('PgnGame', ['headers', 'moves', 'result', 'error'])
+
+RESULTS = ('1-0', '0-1', '1/2-1/2', '*')
+HEADER_PATTERN = re.compile(r'^\[\s*(\w+)\s+"((?:[^"\\]|\\.)*)"\s*\]')
+TOKEN_PATTERN = re.compile(r'\{[^}]*\}?|;[^\n]*|\$\d+|[()]|\d+\.+|[^\s(){};$]+')
+
+
+def split_games(lines):
+    """把 PGN 文本按对局切开, 不解析着法
+
+    :param lines: 可迭代的文本行, 例如打开的文件
+    :return: 生成器, 逐盘给出 (头部字典, 着法文本)
+    """
+    headers = collections.OrderedDict()
+    movetext = []
+    in_comment = False  # 跨行的 {...} 注释里以 [ 开头的行不是头部
+    for line in lines:
+        line = line.strip()
+        if not in_comment:
+            if line.startswith('%'):
+                continue  # PGN 规定以 % 开头的行被忽略
+            if line.startswith('['):
+                if movetext:  # 上一盘棋没有以空行结束
+                    yield headers, '\n'.join(movetext)
+                    headers, movetext = collections.OrderedDict(), []
+                match = HEADER_PATTERN.match(line)
+                if match:
+                    headers[match.group(1)] = match.group(2).replace('\\"', '"').replace('\\\\', '\\')
+                continue
+        if line:
+            movetext.append(line)
+            if '{' in line or '}' in line:
+                in_comment = line.rfind('{') > line.rfind('}')
+        elif movetext and not in_comment:
+            yield headers, '\n'.join(movetext)
+            headers, movetext = collections.OrderedDict(), []
+    if headers or movetext:
+        yield headers, '\n'.join(movetext)
+
+
+def parse_game(headers, movetext, arena=None):
+    """解析一盘棋的着法并在竞技场上回放
+
+    :param arena: 可选, 重用的 GameArena(见 gamenotation.load_fen())
+    :return: (PgnGame, 回放到最后一步的 GameArena)
+    :rtype : tuple
+    """
+    arena = gamenotation.load_fen(headers.get('FEN', gamearena.START_POSITION_FEN), arena)
+    moves = []
+    result = headers.get('Result', '*')
+    error = None
+    depth = 0  # 变着的嵌套层数
+    for token in TOKEN_PATTERN.findall(movetext):
+        first = token[0]
+        if first == '(':
+            depth += 1
+        elif first == ')':
+            depth -= 1
+        elif depth or first in '{;$' or first.isdigit() and token.endswith('.'):
+            continue
+        elif token in RESULTS:
+            result = token
+        elif error is None:
+            try:
+                move = gamenotation.parse_san(arena, token)
+            except ValueError as e:
+                error = 'ply {}: {}'.format(len(moves) + 1, e)
+                continue
+            arena.make_move(move)
+            moves.append(move)
+    return PgnGame(headers, moves, result, error), arena
+
+
+def _parse_batch(batch):
+    arena = None
+    games = []
+    for headers, movetext in batch:
+        game, arena = parse_game(headers, movetext, arena)
+        games.append(game)
+    return games
+
+
+def read_pgn(source, workers=1, batch_size=64):
+    """逐盘读取 PGN 文件
+
+    :param source: 文件名或者已经打开的文本文件
+    :param workers: 解析着法的进程数, 1 表示在当前进程中解析, None 表示 CPU 数量
+    :param batch_size: 多进程时每次交给子进程的对局数
+    :return: 生成器, 按文件中的顺序逐盘给出 PgnGame
+    """
+    f = open(source) if isinstance(source, str) else source
+    try:
+        workers = workers or multiprocessing.cpu_count()
+        if workers == 1:
+            arena = None
+            for headers, movetext in split_games(f):
+                game, arena = parse_game(headers, movetext, arena)
+                yield game
+            return
+        pool = multiprocessing.Pool(workers)
+        try:
+            pending = collections.deque()
+            batch = []
+            for item in split_games(f):
+                batch.append(item)
+                if len(batch) < batch_size:
+                    continue
+                pending.append(pool.apply_async(_parse_batch, (batch,)))
+                batch = []
+                if len(pending) >= 2 * workers:  # 限制尚未取走的对局数, 保持内存固定
+                    for game in pending.popleft().get():
+                        yield game
+            if batch:
+                pending.append(pool.apply_async(_parse_batch, (batch,)))
+            while pending:
+                for game in pending.popleft().get():
+                    yield game
+        finally:
+            pool.terminate()
+            pool.join()
+    finally:
+        if f is not source:
+            f.close()
+
+
+def replay(game, arena=None):
+    """把已经解析的对局回放到竞技场上(例如 read_pgn() 从子进程取回的对局)
+
+    :rtype : GameArena
+    """
+    arena = gamenotation.load_fen(game.headers.get('FEN', gamearena.START_POSITION_FEN), arena)
+    for move in game.moves:
+        arena.make_move(move)
+    return arena
+
+
+def write_random_games(path, count, max_plies=80, seed=0):
+    """生成 count 盘随机对局的 PGN 文件, 用于自测试和测量速度"""
+    rng = random.Random(seed)
+    with open(path, 'w') as f:
+        for i in range(count):
+            arena = gamenotation.load_fen(gamearena.START_POSITION_FEN)
+            words = []
+            for ply in range(max_plies):
+                moves = arena.retrieve_legal_moves_of_player(arena.side_to_move)
+                if not moves:
+                    break
+                move = rng.choice(sorted(moves))
+                if ply % 2 == 0:
+                    words.append('{}.'.format(ply // 2 + 1))
+                words.append(gamenotation.move_to_san(arena, move))
+                arena.make_move(move)
+            f.write('[Event "random {}"]\n[Result "*"]\n\n{} *\n\n'.format(i, ' '.join(words)))
+
+
+def do_self_test():
+    """以下为模块自测试代码"""
+    log = sys.stdout
+    log.write('Module:{}\n'.format(__name__))
+    text = '''[Event "F/S Return Match"]
+[Site "Belgrade, Serbia JUG"]
+[White "Fischer, Robert J."]
+[Black "Spassky, Boris V."]
+[Result "1/2-1/2"]
+
+1. e4 e5 2. Nf3 Nc6 3. Bb5 {This opening is called the Ruy Lopez.} 3... a6
+4. Ba4 Nf6 5. O-O Be7 6. Re1 b5 7. Bb3 d6 8. c3 O-O 9. h3 Nb8 10. d4 Nbd7
+11. c4 c6 12. cxb5 axb5 13. Nc3 Bb7 14. Bg5 b4 15. Nb1 h6 16. Bh4 c5 17. dxe5
+Nxe4 18. Bxe7 Qxe7 19. exd6 Qf6 20. Nbd2 Nxd6 21. Nc4 Nxc4 22. Bxc4 Nb6
+23. Ne5 Rae8 24. Bxf7+ Rxf7 25. Nxf7 Rxe1+ 26. Qxe1 Kxf7 27. Qe3 Qg5 28. Qxg5
+hxg5 29. b3 Ke6 30. a3 Kd6 31. axb4 cxb4 32. Ra5 Nd5 33. f3 Bc8 34. Kf2 Bf5
+35. Ra7 g6 36. Ra6+ Kc5 37. Ke1 Nf4 38. g3 Nxh3 39. Kd2 Kb5 40. Rd6 Kc5 41. Ra6
+Nf2 42. g4 Bd3 43. Re6 1/2-1/2
+
+[Event "variations, NAGs and promotion"]
+[FEN "8/P6k/8/8/8/8/6pK/8 w - - 0 1"]
+[Result "*"]
+
+1. a8=Q $1 (1. a8Q? {same move} g1=Q+) 1... g1=Q+ ; comment to end of line
+2. Kh3 Qh1+ 3. Kg3 Qxa8 *
+
+[Event "illegal move"]
+
+1. e4 e5 2. Ke3 Nc6 *
+'''
+    path = os.path.join(tempfile.mkdtemp(), 'test.pgn')
+    with open(path, 'w') as f:
+        f.write(text)
+    games = list(read_pgn(path))
+    assert [len(game.moves) for game in games] == [85, 6, 2], [len(game.moves) for game in games]
+    assert games[0].headers['White'] == 'Fischer, Robert J.' and games[0].result == '1/2-1/2'
+    assert games[0].error is None and games[1].error is None
+    assert games[2].error.startswith('ply 3'), games[2].error
+    arena = replay(games[0])
+    log.write('{}\n'.format(gamenotation.arena_to_fen(arena)))
+    assert gamenotation.arena_to_fen(arena) == '8/8/4R1p1/2k3p1/1p4P1/1P1b1P2/3K1n2/8 b - - 2 43'
+    # SAN 导出与解析互为逆运算
+    arena = replay(games[0], arena)
+    while arena.ply:
+        arena.unmake_move()
+        for move in arena.retrieve_legal_moves_of_player(arena.side_to_move):
+            assert gamenotation.parse_san(arena, gamenotation.move_to_san(arena, move)) == move
+    count = 200
+    write_random_games(path, count)
+    for workers in (1, 2):
+        started = time.time()
+        plies = sum(len(game.moves) for game in read_pgn(path, workers=workers, batch_size=16))
+        seconds = time.time() - started
+        log.write('read_pgn workers={}: {} games, {} plies in {:.2f}s, {:.0f} plies/s\n'.format(
+            workers, count, plies, seconds, plies / max(seconds, 1e-9)))
+    os.remove(path)
+
+
+def main():
+    """用法: python gamepgn.py [棋谱文件 [进程数] | convert 棋谱文件 输出文件 [进程数]]"""
+    if len(sys.argv) > 3 and sys.argv[1] == 'convert':
+        workers = int(sys.argv[4]) if len(sys.argv) > 4 else None
+        with open(sys.argv[3], 'w') as f:
+            for game in read_pgn(sys.argv[2], workers=workers):
+                if game.moves and 'FEN' not in game.headers:
+                    f.write('{} {}\n'.format(' '.join(gamearena.coordinate_notation(move) for move in game.moves),
+                                             game.result))
+    elif len(sys.argv) > 1:
+        workers = int(sys.argv[2]) if len(sys.argv) > 2 else None
+        started = time.time()
+        games = plies = errors = 0
+        for game in read_pgn(sys.argv[1], workers=workers):
+            games += 1
+            plies += len(game.moves)
+            if game.error:
+                errors += 1
+                print('game {} ({}): {}'.format(games, game.headers.get('Event', '?'), game.error))
+        seconds = time.time() - started
+        print('{} games, {} plies, {} with errors, {:.2f}s, {:.0f} plies/s'.format(
+            games, plies, errors, seconds, plies / max(seconds, 1e-9)))
+    else:
+        do_self_test()
+
+
+if '__main__' == __name__:
+    main()
@@ -0,0 +1,403 @@
+# coding=utf-8
+"""基于 GameArena 的博弈树搜索
+
+迭代加深的负极大值(negamax)搜索 + alpha-beta 剪枝, 叶子节点继续做只考虑吃子和升变的静态搜索(quiescence),
+可以按深度、节点数或者时间限制搜索量. 搜索直接在传入的 GameArena 上 make_move()/unmake_move(), 结束后局面保持不变.
+
+速度指标: 在 gamearena.PERFT_POSITIONS 参考局面上以 BENCHMARK_DEPTH 层深度搜索, 单核至少 NODES_PER_SECOND_TARGET
+节点/秒(包括静态搜索节点), 用 python gamesearch.py bench 测量. 在单核 x86-64 Linux 虚拟机、CPython 3.11 上约为
+7300 节点/秒. 深度更浅时静态搜索节点的比例更高, 每个节点的开销更大(深度 2 约 5000~5800 节点/秒), 速度指标不适用.
+"""
+import collections
+import sys
+import time
+
+import gamearena
+from gamearena import KingUnit, QueenUnit, RookUnit, BishopUnit, KnightUnit, WhitePawnUnit, BlackPawnUnit
+from gamearena import MOVE_CAPTURE, MOVE_PROMOTION
+from gametransposition import TranspositionTable, encode_move, decode_move
+from gametransposition import BOUND_EXACT, BOUND_LOWER, BOUND_UPPER
+
+NODES_PER_SECOND_TARGET = 5000
+BENCHMARK_DEPTH = 3  # NODES_PER_SECOND_TARGET 对应的搜索深度
+
+UNIT_VALUES = {
+    KingUnit: 0,
+    QueenUnit: 900,
+    RookUnit: 500,
+    BishopUnit: 330,
+    KnightUnit: 320,
+    WhitePawnUnit: 100,
+    BlackPawnUnit: 100,
+}
+
+MATE_SCORE = 100000
+MATE_BOUND = MATE_SCORE - 1000  # 分值绝对值超过该值表示已经找到将死
+INFINITE = MATE_SCORE + 1
+
+# depth: 最大搜索深度; nodes: 最多搜索的节点数; movetime: 最多用时(秒). 取值 None 表示不限制
+SearchLimits = collections.namedtuple('SearchLimits', ['depth', 'nodes', 'movetime'])
+SearchLimits.__new__.__defaults__ = (None, None, None)
+
+# move: 最佳走法; score: 站在走棋一方角度的分值; depth: 完成的深度; pv: 主要变例(走法组成的 tuple)
+SearchResult = collections.namedtuple('SearchResult', ['move', 'score', 'depth', 'pv', 'nodes', 'seconds'])
+
+
+class SearchAborted(Exception):
+    """达到节点数或时间限制, 中止当前这一轮迭代"""
+    pass
+
+
+def evaluate(arena, player_id):
+    """静态评估: 子力价值, 再加上兵的推进和马、象的中心化
+
+    :return: 站在玩家 player_id 角度的分值(单位: 1/100 兵)
+    :rtype : int
+    """
+    xmax, ymax = arena.size
+    score = 0
+    for owner in arena.players:
+        subtotal = 0
+        for unit_type, (x, y) in arena.placements_of_player(owner):
+            subtotal += UNIT_VALUES.get(unit_type, 0)
+            if unit_type is WhitePawnUnit or unit_type is BlackPawnUnit:
+                subtotal += 4 * (y - 1 if unit_type is WhitePawnUnit else ymax - 2 - y)
+            elif unit_type is KnightUnit or unit_type is BishopUnit:
+                subtotal -= 4 * (abs(2 * x - xmax + 1) + abs(2 * y - ymax + 1)) // 2
+        score += subtotal if owner == player_id else -subtotal
+    return score
+
+
+def score_to_table(score, ply):
+    """置换表中的将死分值按距离当前节点计算, 与节点在搜索树中的深度无关"""
+    if score > MATE_BOUND:
+        return score + ply
+    if score < -MATE_BOUND:
+        return score - ply
+    return score
+
+
+def score_from_table(score, ply):
+    if score > MATE_BOUND:
+        return score - ply
+    if score < -MATE_BOUND:
+        return score + ply
+    return score
+
+
+class MoveOrdering(object):
+    """走法排序: 按阶段逐步生成并给出走法, 发生 beta 截断后后面阶段的走法不再生成
+
+    阶段顺序: 置换表最佳走法 -> 吃子和升变(MVV-LVA: 被吃的子价值越高、吃子的子价值越低越靠前)
+    -> 每层两个杀手走法(killer) -> 其余走法按历史表(history)得分从高到低
+    """
+
+    def __init__(self):
+        self.killers = {}  # 层数 -> [最近一次引起截断的平静走法, 更早的一次]
+        self.history = {}  # (起点, 终点) -> 引起截断的累计得分
+
+    def clear(self):
+        self.killers = {}
+        self.history = {}
+
+    @staticmethod
+    def mvv_lva(arena, move):
+        """吃子走法的排序得分, 越大越靠前
+
+        :rtype : int
+        """
+        victim_id = arena.unit_on_square(move.destination)
+        victim = UNIT_VALUES.get(arena.type_of_unit(victim_id), 0) if victim_id else 0
+        if move.flags & gamearena.MOVE_EN_PASSANT:
+            victim = UNIT_VALUES[WhitePawnUnit]
+        attacker = UNIT_VALUES.get(arena.type_of_unit(arena.unit_on_square(move.origin)), 0)
+        if move.flags & MOVE_PROMOTION:
+            victim += UNIT_VALUES.get(gamearena.PROMOTION_UNIT_TYPES[move.flags >> 5], 0)
+        return victim * 16 - attacker // 16
+
+    def ordered_captures(self, arena, moves):
+        return sorted(moves, key=lambda move: -self.mvv_lva(arena, move))
+
+    def staged_moves(self, arena, player_id, hash_move, ply):
+        """按阶段给出玩家的全部合法走法(生成器)
+
+        :param hash_move: 置换表中的最佳走法, 可以为 None; 不合法时被忽略
+        """
+        captures = quiets = None
+        if hash_move is not None:
+            if hash_move.flags & (MOVE_CAPTURE | MOVE_PROMOTION):
+                captures = arena.retrieve_legal_moves_of_player(player_id, captures=True)
+                if hash_move in captures:
+                    yield hash_move
+                else:
+                    hash_move = None
+            else:
+                quiets = arena.retrieve_legal_moves_of_player(player_id, captures=False)
+                if hash_move in quiets:
+                    yield hash_move
+                else:
+                    hash_move = None
+        if captures is None:
+            captures = arena.retrieve_legal_moves_of_player(player_id, captures=True)
+        for move in self.ordered_captures(arena, captures):
+            if move != hash_move:
+                yield move
+        if quiets is None:
+            quiets = arena.retrieve_legal_moves_of_player(player_id, captures=False)
+        killers = [move for move in self.killers.get(ply, ()) if move != hash_move and move in quiets]
+        for move in killers:
+            yield move
+        history = self.history
+        for move in sorted(quiets, key=lambda m: -history.get((m.origin, m.destination), 0)):
+            if move != hash_move and move not in killers:
+                yield move
+
+    def record_cutoff(self, move, depth, ply):
+        """平静走法引起 beta 截断时, 记为该层的杀手走法并增加历史表得分"""
+        if move.flags & (MOVE_CAPTURE | MOVE_PROMOTION):
+            return
+        killers = self.killers.setdefault(ply, [])
+        if move not in killers:
+            killers.insert(0, move)
+            del killers[2:]
+        key = (move.origin, move.destination)
+        self.history[key] = self.history.get(key, 0) + depth * depth
+
+
+class Searcher(object):
+    """搜索引擎, 置换表和走法排序的统计数据在多次搜索之间保留"""
+
+    def __init__(self, tt_size_mb=16, evaluate=evaluate, table=None, ordering=True, stop_event=None,
+                 book=None, tablebase=None):
+        """
+        :param tt_size_mb: 置换表内存上限(MB)
+        :param evaluate: 静态评估函数 evaluate(arena, player_id)
+        :param table: 可选, 使用外部提供的 TranspositionTable(此时忽略 tt_size_mb)
+        :param ordering: 为 False 时不做走法排序, 按走法生成的顺序搜索(用于对比排序的效果)
+        :param stop_event: 可选, threading.Event 或 multiprocessing.Event, 被设置后尽快中止搜索
+        :param book: 可选, gamebook.OpeningBook, 开局库里有当前局面时直接走开局库的棋, 不再搜索
+        :param tablebase: 可选, gametablebase.Tablebase, 搜索到残局库中的局面时直接取得精确分值, 不再向下搜索
+        """
+        self.table = table if table is not None else TranspositionTable(tt_size_mb)
+        self.evaluate = evaluate
+        self.ordering = MoveOrdering() if ordering else None
+        self.stop_event = stop_event
+        self.book = book
+        self.tablebase = tablebase
+        self.nodes = 0
+        self.__arena = None
+        self.__width = 0
+        self.__node_limit = None
+        self.__deadline = None
+        self.__path = set()  # 当前搜索路径上的局面哈希, 用于判断重复局面
+        self.__pv = {}  # 层数 -> 从该层开始的主要变例
+
+    def search(self, arena, limits=None, log=None, first_depth=1):
+        """对 arena 当前局面(轮到 arena.side_to_move 走棋)进行迭代加深搜索
+
+        :param limits: SearchLimits, 全部为 None 时搜索到深度 64 为止
+        :param log: 可选, 每完成一轮迭代输出一行搜索信息
+        :param first_depth: 迭代加深的起始深度
+        :rtype : SearchResult
+        """
+        limits = limits or SearchLimits()
+        started = time.time()
+        self.nodes = 0
+        if self.book is not None:
+            move = self.book.choose_move(arena)
+            if move is not None:
+                return SearchResult(move, 0, 0, (move,), 0, time.time() - started)
+        self.__arena = arena
+        self.__width = arena.size[0]
+        self.__node_limit = limits.nodes
+        self.__deadline = started + limits.movetime if limits.movetime else None
+        self.table.new_search()
+        root_ply = arena.ply
+        result = None
+        for depth in range(min(first_depth, limits.depth or 64), (limits.depth or 64) + 1):
+            self.__path = set()
+            self.__pv = {}
+            try:
+                score = self.__negamax(depth, -INFINITE, INFINITE, 0)
+            except SearchAborted:
+                while arena.ply > root_ply:
+                    arena.unmake_move()
+                break
+            pv = tuple(self.__pv.get(0, ()))
+            result = SearchResult(pv[0] if pv else None, score, depth, pv, self.nodes, time.time() - started)
+            if log:
+                log.write('depth {} score {} nodes {} time {:.2f} pv {}\n'.format(
+                    depth, score, self.nodes, result.seconds, ' '.join(gamearena.coordinate_notation(m) for m in pv)))
+            if not pv or abs(score) > MATE_BOUND:
+                break  # 没有可走的棋, 或者已经找到将死
+        if result is None:
+            # 第一轮迭代都没有完成时, 随便给出一步合法走法
+            moves = arena.retrieve_legal_moves_of_player(arena.side_to_move)
+            move = moves[0] if moves else None
+            result = SearchResult(move, 0, 0, (move,) if move else (), self.nodes, time.time() - started)
+        return result
+
+    def __check_limits(self):
+        if self.__node_limit is not None and self.nodes >= self.__node_limit:
+            raise SearchAborted()
+        if (self.nodes & 1023) == 0:
+            if self.__deadline is not None and time.time() >= self.__deadline:
+                raise SearchAborted()
+            if self.stop_event is not None and self.stop_event.is_set():
+                raise SearchAborted()
+
+    def __negamax(self, depth, alpha, beta, ply):
+        arena = self.__arena
+        self.nodes += 1
+        self.__check_limits()
+        self.__pv[ply] = []
+        key = arena.position_hash
+        if ply and (arena.halfmove_clock >= 100 or key in self.__path):
+            return 0  # 五十回合规则或者重复局面, 按和棋计算
+        if ply and self.tablebase is not None:
+            known = self.tablebase.probe(arena)
+            if known is not None:
+                result, plies = known
+                return result * (MATE_SCORE - ply - plies)
+        hash_move = None
+        entry = self.table.probe(key)
+        if entry is not None:
+            entry_depth, entry_score, bound, move_code = entry
+            hash_move = decode_move(move_code, self.__width)
+            if ply and entry_depth >= depth:
+                entry_score = score_from_table(entry_score, ply)
+                if bound == BOUND_EXACT or \
+                        (bound == BOUND_LOWER and entry_score >= beta) or \
+                        (bound == BOUND_UPPER and entry_score <= alpha):
+                    return entry_score
+        player = arena.side_to_move
+        in_check = arena.is_in_check(player)
+        if in_check:
+            depth += 1  # 被将军时延伸一层, 避免在应将的过程中停止搜索
+        if depth <= 0:
+            return self.__quiescence(alpha, beta, ply)
+        if self.ordering is not None:
+            moves = self.ordering.staged_moves(arena, player, hash_move, ply)
+        else:
+            moves = arena.retrieve_legal_moves_of_player(player)
+        original_alpha = alpha
+        best_score, best_move = -INFINITE, None
+        self.__path.add(key)
+        for move in moves:
+            arena.make_move(move)
+            score = -self.__negamax(depth - 1, -beta, -alpha, ply + 1)
+            arena.unmake_move()
+            if score > best_score:
+                best_score, best_move = score, move
+                if score > alpha:
+                    alpha = score
+                    self.__pv[ply] = [move] + self.__pv.get(ply + 1, [])
+                    if alpha >= beta:
+                        if self.ordering is not None:
+                            self.ordering.record_cutoff(move, depth, ply)
+                        break
+        self.__path.discard(key)
+        if best_move is None:
+            return -MATE_SCORE + ply if in_check else 0  # 没有合法走法: 将死或者逼和
+        if best_score >= beta:
+            bound = BOUND_LOWER
+        elif best_score > original_alpha:
+            bound = BOUND_EXACT
+        else:
+            bound = BOUND_UPPER
+        self.table.store(key, depth, score_to_table(best_score, ply), bound, encode_move(best_move, self.__width))
+        return best_score
+
+    def __quiescence(self, alpha, beta, ply):
+        """静态搜索: 只考虑吃子和升变, 直到局面平稳再做静态评估"""
+        arena = self.__arena
+        self.nodes += 1
+        self.__check_limits()
+        player = arena.side_to_move
+        stand_pat = self.evaluate(arena, player)
+        if stand_pat >= beta:
+            return stand_pat
+        alpha = max(alpha, stand_pat)
+        moves = arena.retrieve_legal_moves_of_player(player, captures=True)
+        if self.ordering is not None:
+            moves = self.ordering.ordered_captures(arena, moves)
+        for move in moves:
+            arena.make_move(move)
+            score = -self.__quiescence(-beta, -alpha, ply + 1)
+            arena.unmake_move()
+            if score >= beta:
+                return score
+            alpha = max(alpha, score)
+        return alpha
+
+
+def benchmark(depth=BENCHMARK_DEPTH, log=None):
+    """在 perft 参考局面上以固定深度搜索, 报告每秒节点数, 深度为 BENCHMARK_DEPTH 时同时检查速度指标
+
+    :return: 全部局面合计的每秒节点数
+    :rtype : float
+    """
+    log = log or sys.stdout
+    total_nodes, total_seconds = 0, 0.0
+    for name, fen, counts in gamearena.PERFT_POSITIONS:
+        arena = gamearena.new_arena_from_fen(fen)
+        result = Searcher(tt_size_mb=16).search(arena, SearchLimits(depth=depth))
+        total_nodes += result.nodes
+        total_seconds += result.seconds
+        log.write('{:10s} depth {} nodes {:>8d} {:6.2f}s {:>7.0f} nodes/s  best {} score {}\n'.format(
+            name, result.depth, result.nodes, result.seconds, result.nodes / max(result.seconds, 1e-9),
+            gamearena.coordinate_notation(result.move), result.score))
+    nps = total_nodes / max(total_seconds, 1e-9)
+    if depth == BENCHMARK_DEPTH:
+        verdict = 'target {} nodes/s at depth {}: {}'.format(
+            NODES_PER_SECOND_TARGET, BENCHMARK_DEPTH, 'ok' if nps >= NODES_PER_SECOND_TARGET else 'FAIL')
+    else:
+        verdict = 'the target applies to depth {} only'.format(BENCHMARK_DEPTH)
+    log.write('total nodes {} {:.2f}s {:.0f} nodes/s ({})\n'.format(total_nodes, total_seconds, nps, verdict))
+    return nps
+
+
+def compare_move_ordering(depth=2, node_limit=200000, log=None):
+    """在 perft 参考局面上以固定深度分别搜索有/没有走法排序两种情况, 比较搜索的节点数
+
+    没有排序时静态搜索的节点数增长很快, 超过 node_limit 就中止, 此时节点数前面标 '>'
+
+    :return: 有排序时的总节点数 / 没有排序时的总节点数
+    :rtype : float
+    """
+    log = log or sys.stdout
+    totals = [0, 0]
+    for name, fen, counts in gamearena.PERFT_POSITIONS:
+        nodes = []
+        for ordering in (False, True):
+            arena = gamearena.new_arena_from_fen(fen)
+            searcher = Searcher(tt_size_mb=16, ordering=ordering)
+            searcher.search(arena, SearchLimits(depth=depth, nodes=node_limit))
+            nodes.append(searcher.nodes)
+        totals[0] += nodes[0]
+        totals[1] += nodes[1]
+        log.write('{:10s} depth {} unordered {:>1s}{:>7d} ordered {:>1s}{:>7d} ({:.1%})\n'.format(
+            name, depth, '>' if nodes[0] >= node_limit else '', nodes[0],
+            '>' if nodes[1] >= node_limit else '', nodes[1], nodes[1] / float(nodes[0])))
+    ratio = totals[1] / float(totals[0])
+    log.write('total unordered {} ordered {} ({:.1%})\n'.format(totals[0], totals[1], ratio))
+    return ratio
+
+
+def main():
+    """用法: python gamesearch.py [bench [深度] | ordering [深度] | "FEN" [秒数]]"""
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        benchmark(depth=int(sys.argv[2]) if len(sys.argv) > 2 else BENCHMARK_DEPTH)
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == 'ordering':
+        compare_move_ordering(depth=int(sys.argv[2]) if len(sys.argv) > 2 else 2)
+        return
+    fen = sys.argv[1] if len(sys.argv) > 1 else gamearena.START_POSITION_FEN
+    movetime = float(sys.argv[2]) if len(sys.argv) > 2 else 5.0
+    arena = gamearena.new_arena_from_fen(fen)
+    result = Searcher().search(arena, SearchLimits(movetime=movetime), log=sys.stdout)
+    print('bestmove {}'.format(gamearena.coordinate_notation(result.move) if result.move else '(none)'))
+
+
+if '__main__' == __name__:
+    main()
@@ -0,0 +1,417 @@
+# coding=utf-8
+"""只记录有棋子的格子的稀疏 GameArena 替代实现, 用于 100x100 以上的大棋盘
+
+gamearena.GameArena 为 width*ranks 个格子分配二维数组, 射线表也按格子数量预先计算, 内存和初始化时间都随棋盘面积增长.
+SparseGameArena 只保存:
+    有棋子的格子 -> 单位编码 的哈希表
+    每一横行、纵列、斜线、反斜线上有棋子的坐标的有序列表
+沿直线走的棋子用 bisect 在有序列表中二分查找火力线上的第一个阻挡棋子, 判断格子是否受攻击时从该格子反向查找,
+因此内存和查询开销只与棋子数量(以及走法本身的数量)有关, 与棋盘面积无关.
+"""
+import bisect
+
+from gamearena import Square, GameArena, AbstractPawnUnit, KingUnit
+
+
+class SparseGameArena(object):
+    """用稀疏结构表示的模拟竞技场, 公开接口与 gamearena.GameArena 相同"""
+
+    PlayerID = GameArena.PlayerID
+    UnitID = GameArena.UnitID
+
+    def __init__(self, width, ranks):
+        """初始化游戏竞技场数据
+
+        :param width: x 轴方向上棋盘的宽度(=xmax)
+        :param ranks: 横行数量(=ymax)
+        """
+        self.__width = width
+        self.__ranks = ranks
+        self.__unit_info_list = []  # 按单位的编码顺序存储所有战斗单位的信息, 单位死亡后仍然保留记录
+        self.__unit_squares = []  # 与 __unit_info_list 一一对应, 记录单位所在格子, None 表示不在棋盘上
+        self.__unit_id_on_square = {}  # (x, y) -> 单位编码, 只记录有棋子的格子
+        # 以下有序列表只记录有棋子的坐标, 空的列表随时删除:
+        self.__rows = {}  # y -> 该横行上有棋子的 x
+        self.__columns = {}  # x -> 该纵列上有棋子的 y
+        self.__diagonals = {}  # x-y -> 该斜线(↗方向)上有棋子的 x
+        self.__anti_diagonals = {}  # x+y -> 该反斜线(↖方向)上有棋子的 x
+        self.__type_counts = {}  # 玩家编号 -> {单位类型: 棋盘上该类型的单位数量}, 判断受攻击时只检查对方现有的单位类型
+
+    @property
+    def size(self):
+        """长度和宽度格子数
+
+        :rtype : int, int
+        """
+        return self.__width, self.__ranks
+
+    def __check_square(self, square):
+        x, y = square[0], square[1]
+        if x < 0 or y < 0 or x >= self.__width or y >= self.__ranks:
+            raise ValueError('invalid square:{}'.format(square))
+        return Square(x, y)
+
+    def __lines_of(self, x, y):
+        """格子所在的四条线: (有序列表所在的字典, 键, 列表中记录的坐标)"""
+        return ((self.__rows, y, x), (self.__columns, x, y),
+                (self.__diagonals, x - y, x), (self.__anti_diagonals, x + y, x))
+
+    def new_unit_recruited_by_player(self, player_id, square, unit_type):
+        """征募一个虚拟单位进入战场, 返回值表示为其分配的编码
+
+        :param player_id: 玩家编号, 每个单位必须有一个玩家归属
+        :param square: 单位的初始位置
+        :param unit_type: 单位的类型, 必须继承 class Unit
+        :return: 为新单位分配的编码, 最小值从 1 开始分配
+        :rtype : GameArena.UnitID
+        """
+        unit = unit_type(owner=player_id)
+        unit.has_been_moved = False
+        self.__unit_info_list.append(unit)
+        self.__unit_squares.append(None)
+        unit_id = self.UnitID(len(self.__unit_info_list))
+        self.__type_counts.setdefault(player_id, {})
+        if square:
+            self.__put(unit_id, self.__check_square(square))
+        return unit_id
+
+    def owner_of_unit(self, unit_id):
+        if not self.is_valid_unit_id(unit_id):
+            raise ValueError('unit_id:{} not exists'.format(unit_id))
+        return self.__unit_info_list[unit_id - 1].owner
+
+    def type_of_unit(self, unit_id):
+        if not self.is_valid_unit_id(unit_id):
+            raise ValueError('unit_id:{} not exists'.format(unit_id))
+        return type(self.__unit_info_list[unit_id - 1])
+
+    def __put(self, unit_id, square):
+        """将单位放到 square 格子上, 原先占据该格子的单位(无论敌我)被移出棋盘"""
+        victim_id = self.__unit_id_on_square.get(square)
+        if victim_id:
+            self.__remove(victim_id)
+        unit = self.__unit_info_list[unit_id - 1]
+        for lines, key, value in self.__lines_of(square.x, square.y):
+            line = lines.get(key)
+            if line is None:
+                lines[key] = [value]
+            else:
+                bisect.insort(line, value)
+        counts = self.__type_counts[unit.owner]
+        counts[type(unit)] = counts.get(type(unit), 0) + 1
+        self.__unit_id_on_square[square] = unit_id
+        self.__unit_squares[unit_id - 1] = square
+
+    def __remove(self, unit_id):
+        square = self.__unit_squares[unit_id - 1]
+        if square is None:
+            return
+        unit = self.__unit_info_list[unit_id - 1]
+        for lines, key, value in self.__lines_of(square.x, square.y):
+            line = lines[key]
+            del line[bisect.bisect_left(line, value)]
+            if not line:
+                del lines[key]
+        counts = self.__type_counts[unit.owner]
+        counts[type(unit)] -= 1
+        if not counts[type(unit)]:
+            del counts[type(unit)]
+        del self.__unit_id_on_square[square]
+        self.__unit_squares[unit_id - 1] = None
+
+    def move_unit_to_somewhere(self, unit_id, square):
+        """移动棋子
+
+        :param unit_id: 单位编码
+        :param square: 目的地坐标
+        """
+        if not self.is_valid_unit_id(unit_id):
+            raise ValueError('unit_id:{} does not exist'.format(unit_id))
+        square = self.__check_square(square)
+        self.__remove(unit_id)
+        self.__put(unit_id, square)
+        self.__unit_info_list[unit_id - 1].has_been_moved = True
+
+    def is_valid_unit_id(self, unit_id):
+        """unit_id 编码检查, 这里不区分是否已经死亡, 只要单位曾经存在即为有效 ID, unit_id=0 时无效
+
+        :rtype : bool
+        """
+        return 1 <= unit_id <= len(self.__unit_info_list)
+
+    def find_square_from_unit_id(self, unit_id):
+        """特定编码的棋子如果在棋盘上则返回坐标, 否则向上传递一个 ValueError 表示没找到
+
+        :rtype : Square
+        """
+        if not self.is_valid_unit_id(unit_id):
+            raise ValueError('Error: invalid unit_id:{}'.format(unit_id))
+        square = self.__unit_squares[unit_id - 1]
+        if square is None:
+            raise ValueError('Note: unit_id:{} is not on chessboard'.format(unit_id))
+        return square
+
+    def unit_on_square(self, square):
+        """格子上的单位编码, 空格返回 0"""
+        return self.__unit_id_on_square.get((square[0], square[1]), self.UnitID(0))
+
+    def is_occupied_square(self, square):
+        return (square[0], square[1]) in self.__unit_id_on_square
+
+    def retrieve_valid_moves_of_unit(self, unit_id):
+        """查询走法
+
+        :param unit_id: 棋子单位的编码
+        :return: 依据棋子自己的走法规则搜索该棋子所有可达位置
+        :rtype : tuple
+        """
+        if not self.is_valid_unit_id(unit_id):
+            return {}
+        square = self.find_square_from_unit_id(unit_id)  # 找不到则会向上传递 ValueError 异常
+        unit = self.__unit_info_list[unit_id - 1]
+        if isinstance(unit, AbstractPawnUnit):
+            return tuple(self.__pawn_moves(unit, square))
+        occupants = self.__unit_id_on_square
+        units = self.__unit_info_list
+        owner = unit.owner
+        moves = [target for target in self.__attacked_squares(unit, square)
+                 if target not in occupants or units[occupants[target] - 1].owner != owner]
+        if isinstance(unit, KingUnit):
+            # 判断受攻击时要先把王自己从棋盘上拿走, 否则王会挡住敌方車、象或后的火力线
+            moves = [target for target in moves if not self.__is_attacked_by_enemy(target, unit.owner, square)]
+        return tuple(moves)
+
+    def is_square_attacked(self, square, by_player):
+        """square 格子是否处于玩家 by_player 的火力范围之内
+
+        :rtype : bool
+        """
+        if by_player not in self.__type_counts:
+            return False
+        return self.__is_attacked_by(self.__check_square(square), by_player)
+
+    def __pawn_moves(self, unit, square):
+        occupants = self.__unit_id_on_square
+        dy = unit.pawn_charge_direction.dy
+        x, y = square.x, square.y + dy
+        for step in range(1 if unit.has_been_moved else 2):
+            if y < 0 or y >= self.__ranks or (x, y) in occupants:
+                break  # 跑到棋盘外面或者前方被挡住
+            yield Square(x, y)
+            y += dy
+        for target in self.__attacked_squares(unit, square):
+            occupant_id = occupants.get(target)
+            if occupant_id and self.__unit_info_list[occupant_id - 1].owner != unit.owner:
+                yield target
+
+    def __edge_distance(self, x, y, dx, dy):
+        """从 (x, y) 沿单位矢量 (dx, dy) 走到棋盘边缘为止的步数"""
+        steps = []
+        if dx:
+            steps.append(self.__width - 1 - x if dx > 0 else x)
+        if dy:
+            steps.append(self.__ranks - 1 - y if dy > 0 else y)
+        return min(steps)
+
+    def __line_through(self, x, y, dx, dy):
+        """(x, y) 所在、沿单位矢量 (dx, dy) 方向的有序列表, 以及 (x, y) 在列表中的坐标和坐标随步数增长的方向"""
+        if dy == 0:
+            return self.__rows.get(y, ()), x, dx
+        if dx == 0:
+            return self.__columns.get(x, ()), y, dy
+        if dx == dy:
+            return self.__diagonals.get(x - y, ()), x, dx
+        return self.__anti_diagonals.get(x + y, ()), x, dx
+
+    def __nearest_blocker(self, x, y, dx, dy, hidden=None):
+        """二分查找从 (x, y) 沿单位矢量 (dx, dy) 出发遇到的第一个棋子, hidden 格子当作空格
+
+        :return: 到该棋子的步数, 没有阻挡时为 None
+        """
+        line, t, step = self.__line_through(x, y, dx, dy)
+        if step > 0:
+            i = bisect.bisect_right(line, t)
+            while i < len(line):
+                distance = line[i] - t
+                if hidden is None or (x + dx * distance, y + dy * distance) != hidden:
+                    return distance
+                i += 1
+        else:
+            i = bisect.bisect_left(line, t) - 1
+            while i >= 0:
+                distance = t - line[i]
+                if hidden is None or (x + dx * distance, y + dy * distance) != hidden:
+                    return distance
+                i -= 1
+        return None
+
+    def __attacked_squares(self, unit, square):
+        """单位在 square 格上的火力范围, 不区分目标格子上是敌方还是己方的棋子
+
+        :rtype : list
+        """
+        x0, y0 = square.x, square.y
+        if isinstance(unit, AbstractPawnUnit):
+            directions, limit = unit.attack_directions, 1
+        else:
+            directions, limit = unit.directions, unit.limited_move_range
+        result = []
+        for dx, dy in directions:
+            if limit == 1:
+                x, y = x0 + dx, y0 + dy
+                if 0 <= x < self.__width and 0 <= y < self.__ranks:
+                    result.append(Square(x, y))
+            elif abs(dx) <= 1 and abs(dy) <= 1:
+                steps = self.__edge_distance(x0, y0, dx, dy)
+                if limit > 0:
+                    steps = min(steps, limit)
+                blocker = self.__nearest_blocker(x0, y0, dx, dy)
+                if blocker is not None:
+                    steps = min(steps, blocker)  # 火力线止于第一个阻挡的棋子(含该格)
+                result += [Square(x0 + dx * i, y0 + dy * i) for i in range(1, steps + 1)]
+            else:
+                # 不沿横行、纵列或斜线方向的射线(例如不限步数的马), 逐格查哈希表
+                x, y, step = x0 + dx, y0 + dy, 1
+                while 0 <= x < self.__width and 0 <= y < self.__ranks and not 0 < limit < step:
+                    result.append(Square(x, y))
+                    if (x, y) in self.__unit_id_on_square:
+                        break
+                    x, y, step = x + dx, y + dy, step + 1
+        return result
+
+    def __is_attacked_by_enemy(self, square, player_id, hidden=None):
+        for owner in self.__type_counts:
+            if owner != player_id and self.__is_attacked_by(square, owner, hidden):
+                return True
+        return False
+
+    def __is_attacked_by(self, square, attacker, hidden=None):
+        """从 square 格子反向查找玩家 attacker 的棋子, 只检查 attacker 在棋盘上现有的单位类型
+
+        :param hidden: 当作空格的格子, 计算王的走法时为王自己所在的格子
+        """
+        occupants = self.__unit_id_on_square
+        units = self.__unit_info_list
+        x0, y0 = square.x, square.y
+
+        def is_attacker(x, y, unit_type):
+            occupant_id = occupants.get((x, y))
+            if not occupant_id:
+                return False
+            unit = units[occupant_id - 1]
+            return unit.owner == attacker and type(unit) is unit_type
+
+        for unit_type in self.__type_counts[attacker]:
+            if issubclass(unit_type, AbstractPawnUnit):
+                directions, limit = unit_type.attack_directions, 1
+            else:
+                directions, limit = unit_type.directions, unit_type.limited_move_range
+            for dx, dy in directions:
+                if limit == 1:
+                    if (x0 - dx, y0 - dy) != hidden and is_attacker(x0 - dx, y0 - dy, unit_type):
+                        return True
+                elif abs(dx) <= 1 and abs(dy) <= 1:
+                    distance = self.__nearest_blocker(x0, y0, -dx, -dy, hidden)
+                    if distance is not None and not 0 < limit < distance and \
+                            is_attacker(x0 - dx * distance, y0 - dy * distance, unit_type):
+                        return True
+                else:
+                    x, y, step = x0 - dx, y0 - dy, 1
+                    while 0 <= x < self.__width and 0 <= y < self.__ranks and not 0 < limit < step:
+                        if (x, y) != hidden and (x, y) in occupants:
+                            if is_attacker(x, y, unit_type):
+                                return True
+                            break
+                        x, y, step = x - dx, y - dy, step + 1
+        return False
+
+
+def do_self_test():
+    """模块自测试: 与 gamearena.GameArena 和 gamebitboard.BitboardGameArena 对照走法结果, 并测量大棋盘上的查询速度"""
+    import random
+    import sys
+    import time
+    import gamearena
+    from gamebitboard import BitboardGameArena
+    log = sys.stdout
+    log.write('Module:{}\n'.format(__name__))
+    name_order = [gamearena.RookUnit, gamearena.KnightUnit, gamearena.BishopUnit, gamearena.QueenUnit,
+                  gamearena.KingUnit, gamearena.BishopUnit, gamearena.KnightUnit, gamearena.RookUnit]
+    arenas = [gamearena.GameArena(8, 8), SparseGameArena(8, 8)]
+    units = []
+    for arena in arenas:
+        white, black = arena.PlayerID(1), arena.PlayerID(2)
+        unit_ids = []
+        for x, unit_type in enumerate(name_order):
+            unit_ids.append(arena.new_unit_recruited_by_player(white, Square(x, 0), unit_type))
+            unit_ids.append(arena.new_unit_recruited_by_player(white, Square(x, 1), gamearena.WhitePawnUnit))
+            unit_ids.append(arena.new_unit_recruited_by_player(black, Square(x, 6), gamearena.BlackPawnUnit))
+            unit_ids.append(arena.new_unit_recruited_by_player(black, Square(x, 7), unit_type))
+        # 1.e4 e5 2.Qh5 Nc6 3.Bc4 Nf6
+        for unit_index, square in [(13, (4, 3)), (14, (4, 4)), (12, (7, 4)), (7, (2, 5)),
+                                   (20, (2, 3)), (27, (5, 5))]:
+            arena.move_unit_to_somewhere(unit_ids[unit_index], Square(*square))
+        units.append(unit_ids)
+    for i in range(len(units[0])):
+        expected, actual = [set(arena.retrieve_valid_moves_of_unit(unit_ids[i]))
+                            for arena, unit_ids in zip(arenas, units)]
+        assert expected == actual, (i, expected, actual)
+    # 随机布局(包括吃子)与位棋盘实现对照, 王被将军时要能沿背离敌方火力线的方向逃跑
+    unit_types = [gamearena.KingUnit, gamearena.QueenUnit, gamearena.RookUnit, gamearena.BishopUnit,
+                  gamearena.KnightUnit, gamearena.WhitePawnUnit, gamearena.BlackPawnUnit]
+    rng = random.Random(0)
+    for trial in range(30):
+        width, ranks = rng.randint(3, 20), rng.randint(3, 20)
+        arenas = [BitboardGameArena(width, ranks), SparseGameArena(width, ranks)]
+        placements = [(rng.randint(1, 2), rng.randrange(width), rng.randrange(ranks), rng.choice(unit_types))
+                      for _ in range(rng.randint(2, 24))]
+        relocations = [(rng.randrange(len(placements)), rng.randrange(width), rng.randrange(ranks))
+                       for _ in range(5)]
+        results = []
+        for arena in arenas:
+            unit_ids = [arena.new_unit_recruited_by_player(arena.PlayerID(player_id), Square(x, y), unit_type)
+                        for player_id, x, y, unit_type in placements]
+            for i, x, y in relocations:
+                if _is_on_board(arena, unit_ids[i]):
+                    arena.move_unit_to_somewhere(unit_ids[i], Square(x, y))
+            results.append([set(arena.retrieve_valid_moves_of_unit(unit_id)) if _is_on_board(arena, unit_id)
+                            else None for unit_id in unit_ids])
+        assert results[0] == results[1], (trial, placements, relocations)
+    arena = SparseGameArena(8, 8)
+    king = arena.new_unit_recruited_by_player(arena.PlayerID(1), Square(4, 3), gamearena.KingUnit)
+    arena.new_unit_recruited_by_player(arena.PlayerID(2), Square(0, 3), gamearena.RookUnit)
+    assert Square(5, 3) not in arena.retrieve_valid_moves_of_unit(king)
+    assert arena.is_square_attacked(Square(7, 3), arena.PlayerID(2)) is False  # 王挡住了車的火力线
+    # 大棋盘: 棋子数量不变时, 开销不随棋盘面积增长
+    for size in (8, 100, 1000, 10000):
+        started = time.time()
+        arena = SparseGameArena(size, size)
+        unit_ids = []
+        for x, unit_type in enumerate(name_order):
+            unit_ids.append(arena.new_unit_recruited_by_player(arena.PlayerID(1), Square(x, 0), unit_type))
+            unit_ids.append(arena.new_unit_recruited_by_player(arena.PlayerID(1), Square(x, 1),
+                                                               gamearena.WhitePawnUnit))
+            unit_ids.append(arena.new_unit_recruited_by_player(arena.PlayerID(2), Square(x, size - 2),
+                                                               gamearena.BlackPawnUnit))
+            unit_ids.append(arena.new_unit_recruited_by_player(arena.PlayerID(2), Square(x, size - 1), unit_type))
+        setup = time.time() - started
+        count = 100
+        started = time.time()
+        for _ in range(count):
+            for unit_id in unit_ids:
+                arena.retrieve_valid_moves_of_unit(unit_id)
+        seconds = (time.time() - started) / count
+        log.write('SparseGameArena {0}x{0}: setup {1:.2f}ms, {2:.0f} unit queries/s\n'.format(
+            size, setup * 1000, len(unit_ids) / seconds))
+
+
+def _is_on_board(arena, unit_id):
+    try:
+        arena.find_square_from_unit_id(unit_id)
+    except ValueError:
+        return False
+    return True
+
+
+if '__main__' == __name__:
+    do_self_test()
@@ -0,0 +1,391 @@
+# coding=utf-8
+"""残局库: 用逆向分析(retrograde analysis)求出少子残局每个局面的胜负和以及距离将死的步数(DTM)
+
+支持一方只剩王、另一方为 KQK、KRK、KPK、KBNK 的残局, 走法规则完全来自 GameArena.
+每张表是一个按局面编号寻址的字节数组, 保存在文件里用 mmap 查询, 查询是 O(1) 的, 不需要搜索.
+
+局面编号: 强方视为白方; 无兵残局利用棋盘的 8 种对称变换把白王变换到 a1-d1-d4 三角区(10 个格子),
+有兵残局只能左右镜像, 把白王变换到 a~d 列(32 个格子). 编号 = ((走棋方 * 白王位置数 + 白王位置) * 64 + ...) * 64 + 黑王.
+
+字节的取值: 0 和棋, 255 不可能出现的局面, 其余为 距离将死的半回合数 + 1,
+偶数表示走棋一方胜, 奇数表示走棋一方负(1 表示已经被将死).
+王車易位权利和五十回合规则不在考虑范围内.
+
+生成过程分两步: 先用进程池并行地为每个局面生成后继局面(这一步调用 GameArena 的走法生成),
+再在主进程里从已将死的局面开始, 沿前驱局面逐层向后推出全部胜负结果.
+命令行: python gametablebase.py generate [目录] [KQK KRK KPK KBNK]
+表文件(*.tb)是生成的数据, 不放进版本库(见 .gitignore); 默认目录 tablebases/ 下的 KQK、KRK、KPK 三张表
+用 python gametablebase.py generate 重新生成.
+"""
+import array
+import collections
+import mmap
+import multiprocessing
+import os
+import struct
+import sys
+import time
+
+import gamearena
+from gamearena import Square, WHITE, BLACK
+from gamearena import KingUnit, QueenUnit, RookUnit, BishopUnit, KnightUnit, WhitePawnUnit, BlackPawnUnit
+
+# 残局名称 -> 强方除王以外的棋子(白方), 弱方只有王
+MATERIAL = collections.OrderedDict([
+    ('KQK', (QueenUnit,)),
+    ('KRK', (RookUnit,)),
+    ('KPK', (WhitePawnUnit,)),
+    ('KBNK', (BishopUnit, KnightUnit)),
+])
+
+# 兵升变以后转入的残局, 不在表中的升变(升变为象或马)按和棋处理
+PROMOTION_TABLES = {QueenUnit: 'KQK', RookUnit: 'KRK'}
+
+DRAW = 0
+INVALID = 255
+
+TABLE_MAGIC = b'GAMETB01'
+HEADER = struct.Struct('<8s8sI')
+
+# 局面类型(生成第一步的中间结果)
+_ILLEGAL, _MATED, _STALEMATE, _NORMAL = range(4)
+
+
+def _symmetries(with_pawn):
+    """棋盘格子编号(y*8+x)的对称变换表; 有兵时只能左右镜像"""
+    transforms = [lambda x, y: (x, y), lambda x, y: (7 - x, y)]
+    if not with_pawn:
+        transforms += [lambda x, y: (x, 7 - y), lambda x, y: (7 - x, 7 - y),
+                       lambda x, y: (y, x), lambda x, y: (7 - y, x),
+                       lambda x, y: (y, 7 - x), lambda x, y: (7 - y, 7 - x)]
+    return [tuple(t(s % 8, s // 8)[1] * 8 + t(s % 8, s // 8)[0] for s in range(64)) for t in transforms]
+
+
+class TableIndex(object):
+    """一张残局表的局面编号方案"""
+
+    def __init__(self, name):
+        self.name = name
+        self.pieces = (KingUnit,) + MATERIAL[name] + (KingUnit,)  # 白王, 白方其他棋子..., 黑王
+        self.with_pawn = WhitePawnUnit in self.pieces
+        if self.with_pawn:
+            self.king_squares = tuple(s for s in range(64) if s % 8 < 4)
+        else:
+            self.king_squares = tuple(s for s in range(64) if s % 8 < 4 and s // 8 <= s % 8)
+        self.king_slot = dict((s, i) for i, s in enumerate(self.king_squares))
+        self.symmetries = _symmetries(self.with_pawn)
+        self.others = len(self.pieces) - 1
+        self.size = 2 * len(self.king_squares) * 64 ** self.others
+
+    def index(self, white_to_move, squares):
+        """局面编号, squares 与 self.pieces 一一对应(格子编号 y*8+x)
+
+        :rtype : int
+        """
+        for transform in self.symmetries:
+            slot = self.king_slot.get(transform[squares[0]])
+            if slot is not None:
+                break
+        index = (0 if white_to_move else 1) * len(self.king_squares) + slot
+        for square in squares[1:]:
+            index = index * 64 + transform[square]
+        return index
+
+    def decode(self, index):
+        """index() 的逆运算
+
+        :return: (白方走棋, 格子编号列表)
+        :rtype : tuple
+        """
+        squares = []
+        for _ in range(self.others):
+            squares.append(index % 64)
+            index //= 64
+        squares.append(self.king_squares[index % len(self.king_squares)])
+        squares.reverse()
+        return index // len(self.king_squares) == 0, squares
+
+
+class Tablebase(object):
+    """从目录里按需用 mmap 打开残局表并查询"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.__tables = {}  # 名称 -> (TableIndex, mmap) 或者 None(文件不存在)
+
+    def close(self):
+        for table in self.__tables.values():
+            if table is not None:
+                table[1].close()
+        self.__tables = {}
+
+    def table(self, name):
+        if name not in self.__tables:
+            path = os.path.join(self.directory, name + '.tb')
+            table = None
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                magic, stored_name, size = HEADER.unpack_from(data, 0)
+                if magic != TABLE_MAGIC or stored_name.rstrip(b'\0').decode('ascii') != name \
+                        or len(data) != HEADER.size + size:
+                    data.close()
+                    raise ValueError('{} is not a valid {} table'.format(path, name))
+                table = (TableIndex(name), data)
+            self.__tables[name] = table
+        return self.__tables[name]
+
+    def probe_squares(self, name, white_to_move, squares):
+        """按白方为强方的格子编号查询, 表不存在时返回 None
+
+        :rtype : int
+        """
+        table = self.table(name)
+        if table is None:
+            return None
+        index, data = table
+        return data[HEADER.size + index.index(white_to_move, squares)]
+
+    def probe(self, arena):
+        """查询 arena 当前局面
+
+        :return: (结果, 距离将死的半回合数), 结果为 1 走棋一方胜 / 0 和棋 / -1 走棋一方负;
+                 棋盘不是 8x8 或者子力组合不在残局库中时返回 None
+        :rtype : tuple
+        """
+        if arena.size != (8, 8) or sum(len(arena.units_of_player(p)) for p in arena.players) > 4:
+            return None
+        units = {}
+        for player_id in arena.players:
+            units[player_id] = sorted(((arena.type_of_unit(unit_id), arena.find_square_from_unit_id(unit_id))
+                                       for unit_id in arena.units_of_player(player_id)),
+                                      key=lambda unit: unit[0] is not KingUnit)
+        if len(units) != 2:
+            return None
+        strong = WHITE if len(units[WHITE]) > len(units[BLACK]) else BLACK
+        weak = BLACK if strong == WHITE else WHITE
+        if len(units[weak]) != 1 or units[weak][0][0] is not KingUnit or units[strong][0][0] is not KingUnit:
+            return None
+        extras = [WhitePawnUnit if unit_type is BlackPawnUnit else unit_type for unit_type, square in units[strong][1:]]
+        for name, material in MATERIAL.items():
+            if sorted(extras, key=id) == sorted(material, key=id):
+                break
+        else:
+            return None
+        # 强方为黑方时上下翻转棋盘并交换颜色
+        flip = (lambda s: (7 - s.y) * 8 + s.x) if strong == BLACK else (lambda s: s.y * 8 + s.x)
+        by_type = dict((unit_type, square) for unit_type, square in units[strong][1:])
+        if strong == BLACK and BlackPawnUnit in by_type:
+            by_type[WhitePawnUnit] = by_type.pop(BlackPawnUnit)
+        squares = [flip(units[strong][0][1])] + [flip(by_type[t]) for t in material] + [flip(units[weak][0][1])]
+        value = self.probe_squares(name, arena.side_to_move == strong, squares)
+        if value is None or value == INVALID:
+            return None
+        if value == DRAW:
+            return 0, 0
+        return (1 if value % 2 == 0 else -1), value - 1
+
+
+def _new_arena(pieces, white_to_move, squares):
+    arena = gamearena.GameArena(8, 8)
+    for i, (unit_type, square) in enumerate(zip(pieces, squares)):
+        player_id = BLACK if i == len(pieces) - 1 else WHITE
+        unit_id = arena.new_unit_recruited_by_player(player_id, Square(square % 8, square // 8), unit_type)
+        arena.mark_unit_moved(unit_id, not (unit_type is WhitePawnUnit and square // 8 == 1))
+    arena.side_to_move = WHITE if white_to_move else BLACK
+    return arena
+
+
+def _generate_chunk(args):
+    """进程池中运行: 为编号在 [start, stop) 之间的局面生成后继局面
+
+    :return: (start, 局面类型, 后继数偏移, 表内后继局面编号, 计数初值, 表外必胜半回合数, 表外必负半回合数)
+    """
+    name, start, stop, directory = args
+    table = TableIndex(name)
+    tablebase = Tablebase(directory)
+    pieces = table.pieces
+    kinds = bytearray(stop - start)
+    offsets = array.array('I', [0])
+    targets = array.array('I')
+    counters = array.array('H', bytes(2 * (stop - start)))
+    external_wins = array.array('H', bytes(2 * (stop - start)))  # 走入表外局面即可取胜的最少半回合数, 0 表示没有
+    external_losses = array.array('H', bytes(2 * (stop - start)))  # 表外必负后继局面的最大半回合数
+    for i, index in enumerate(range(start, stop)):
+        white_to_move, squares = table.decode(index)
+        kind = _ILLEGAL
+        if len(set(squares)) == len(squares) and \
+                not any(t is WhitePawnUnit and s // 8 in (0, 7) for t, s in zip(pieces, squares)):
+            arena = _new_arena(pieces, white_to_move, squares)
+            mover = arena.side_to_move
+            if not arena.is_in_check(arena.next_player(mover)):
+                moves = arena.retrieve_legal_moves_of_player(mover)
+                if not moves:
+                    kind = _MATED if arena.is_in_check(mover) else _STALEMATE
+                else:
+                    kind = _NORMAL
+                    counter, best_win, worst_loss = 0, 0, 0
+                    for origin, destination, flags in moves:
+                        if flags & gamearena.MOVE_CAPTURE:
+                            counter += 1  # 弱方吃掉强方的子以后必然是和棋(KK、KBK、KNK), 这个后继永远不会是强方胜
+                            continue
+                        successor = list(squares)
+                        moved = successor.index(origin.y * 8 + origin.x)
+                        successor[moved] = destination.y * 8 + destination.x
+                        if flags & gamearena.MOVE_PROMOTION:
+                            promoted = gamearena.PROMOTION_UNIT_TYPES[flags >> 5]
+                            value = DRAW
+                            if promoted in PROMOTION_TABLES:
+                                value = tablebase.probe_squares(PROMOTION_TABLES[promoted], False,
+                                                                [successor[0], successor[1], successor[2]])
+                                if value is None:
+                                    raise ValueError('{} must be generated before {}'.format(
+                                        PROMOTION_TABLES[promoted], name))
+                            if value == DRAW:
+                                counter += 1
+                            elif value % 2:  # 对方负
+                                best_win = min(best_win, value) if best_win else value
+                            else:  # 对方胜
+                                worst_loss = max(worst_loss, value)
+                            continue
+                        counter += 1
+                        targets.append(table.index(not white_to_move, successor))
+                    counters[i] = counter
+                    external_wins[i] = best_win
+                    external_losses[i] = worst_loss
+        kinds[i] = kind
+        offsets.append(len(targets))
+    tablebase.close()
+    return start, bytes(kinds), offsets, targets, counters, external_wins, external_losses
+
+
+def generate_table(name, directory, workers=None, log=None):
+    """生成一张残局表, 写入 directory/<name>.tb
+
+    :return: 表中各类局面的统计 {'win': 数量, 'loss': 数量, 'draw': 数量, 'longest': 最长半回合数}
+    :rtype : dict
+    """
+    log = log or sys.stdout
+    started = time.time()
+    table = TableIndex(name)
+    size = table.size
+    workers = workers or multiprocessing.cpu_count()
+    chunk = max(1024, size // (workers * 16))
+    jobs = [(name, start, min(start + chunk, size), directory) for start in range(0, size, chunk)]
+    value = bytearray(size)
+    counters = array.array('H', bytes(2 * size))
+    loss_floor = array.array('H', bytes(2 * size))
+    successor_begin = array.array('Q', bytes(8 * size))
+    successor_end = array.array('Q', bytes(8 * size))
+    successors = array.array('I')
+    buckets = collections.defaultdict(list)  # 半回合数 -> [(局面编号, 是否走棋一方胜), ...]
+    pool = multiprocessing.Pool(workers)
+    try:
+        for start, kinds, offsets, targets, chunk_counters, external_wins, external_losses in \
+                pool.imap_unordered(_generate_chunk, jobs):
+            base = len(successors)
+            successors.extend(targets)
+            for i, kind in enumerate(kinds):
+                index = start + i
+                successor_begin[index] = base + offsets[i]
+                successor_end[index] = base + offsets[i + 1]
+                if kind == _ILLEGAL:
+                    value[index] = INVALID
+                elif kind == _MATED:
+                    buckets[0].append((index, False))
+                elif kind == _NORMAL:
+                    # 表外后继的取值 v 就是走入该后继后到将死的半回合数
+                    counters[index] = chunk_counters[i]
+                    if external_wins[i]:
+                        buckets[external_wins[i]].append((index, True))
+                    if external_losses[i]:
+                        loss_floor[index] = external_losses[i] - 1
+                        if not chunk_counters[i]:
+                            buckets[external_losses[i]].append((index, False))
+    finally:
+        pool.terminate()
+        pool.join()
+    log.write('{}: {} positions, {} moves generated in {:.1f}s\n'.format(
+        name, size, len(successors), time.time() - started))
+    # 把后继关系反转成前驱关系
+    predecessor_offsets = array.array('Q', bytes(8 * (size + 1)))
+    for target in successors:
+        predecessor_offsets[target + 1] += 1
+    for index in range(size):
+        predecessor_offsets[index + 1] += predecessor_offsets[index]
+    fill = array.array('Q', predecessor_offsets)
+    predecessors = array.array('I', bytes(4 * len(successors)))
+    for index in range(size):
+        for k in range(successor_begin[index], successor_end[index]):
+            target = successors[k]
+            predecessors[fill[target]] = index
+            fill[target] += 1
+    del successors, successor_begin, successor_end, fill
+    # 按半回合数从小到大逐层向前推: 必负局面的前驱必胜; 全部后继都必胜的局面必负
+    level = 0
+    while buckets:
+        for index, wins in buckets.pop(level, ()):
+            if value[index]:
+                continue
+            value[index] = level + 1
+            for k in range(predecessor_offsets[index], predecessor_offsets[index + 1]):
+                previous = predecessors[k]
+                if value[previous]:
+                    continue
+                if not wins:
+                    buckets[level + 1].append((previous, True))
+                else:
+                    counters[previous] -= 1
+                    if not counters[previous]:
+                        buckets[max(level, loss_floor[previous]) + 1].append((previous, False))
+        level += 1
+    stats = {'win': 0, 'loss': 0, 'draw': 0, 'longest': 0}
+    for v in value:
+        if v == DRAW:
+            stats['draw'] += 1
+        elif v != INVALID:
+            stats['win' if v % 2 == 0 else 'loss'] += 1
+            stats['longest'] = max(stats['longest'], v - 1)
+    path = os.path.join(directory, name + '.tb')
+    with open(path + '.tmp', 'wb') as f:
+        f.write(HEADER.pack(TABLE_MAGIC, name.encode('ascii'), size))
+        f.write(value)
+    os.replace(path + '.tmp', path)
+    log.write('{}: win {} loss {} draw {}, longest mate {} plies, {:.1f}s total -> {}\n'.format(
+        name, stats['win'], stats['loss'], stats['draw'], stats['longest'], time.time() - started, path))
+    return stats
+
+
+def generate(directory, names=('KQK', 'KRK', 'KPK'), workers=None, log=None):
+    """依次生成多张残局表(KPK 依赖 KQK 和 KRK, 会自动先生成)"""
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    done = set()
+    for name in names:
+        if name == 'KPK':
+            for required in PROMOTION_TABLES.values():
+                if required not in done and not os.path.exists(os.path.join(directory, required + '.tb')):
+                    generate_table(required, directory, workers, log)
+                    done.add(required)
+        if name not in done:
+            generate_table(name, directory, workers, log)
+            done.add(name)
+
+
+def main():
+    """用法: python gametablebase.py generate [目录] [KQK KRK KPK KBNK] | probe 目录 "FEN" """
+    if len(sys.argv) > 2 and sys.argv[1] == 'probe':
+        tablebase = Tablebase(sys.argv[2])
+        print(tablebase.probe(gamearena.new_arena_from_fen(sys.argv[3])))
+        tablebase.close()
+        return
+    directory = sys.argv[2] if len(sys.argv) > 2 else 'tablebases'
+    names = sys.argv[3:] or ('KQK', 'KRK', 'KPK')
+    for name in names:
+        if name not in MATERIAL:
+            raise SystemExit('unknown table {}, choose from {}'.format(name, ' '.join(MATERIAL)))
+    generate(directory, names)
+
+
+if '__main__' == __name__:
+    main()
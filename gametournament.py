@@ -0,0 +1,328 @@
+# coding=utf-8
+"""引擎对引擎的自对弈比赛, 用于验证影响棋力的改动
+
+不依赖 gamegui, 由 GameService 决定轮到哪位玩家走棋, 在 GameArena 上走子.
+对局分配到进程池里并行进行, 每盘棋结束后立即以一行 JSON 追加到结果文件(JSONL), 不在内存里保留全部对局;
+中断后用同样的参数再次运行, 会跳过结果文件里已经完成的对局继续比赛.
+比赛结束后从结果文件统计胜负和局、Elo 差及其 95% 置信区间, 以及 SPRT 检验的对数似然比.
+
+用法示例:
+    python gametournament.py --engine name=new,depth=3 --engine name=old,depth=2 --games 200 --out results.jsonl
+"""
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import random
+import sys
+import time
+
+import gamearena
+import gamebook
+from gamearena import WHITE, BLACK, KingUnit, KnightUnit, BishopUnit
+from gamesearch import Searcher, SearchLimits
+from gameservice import GameService
+
+RESULT_WHITE_WINS = '1-0'
+RESULT_BLACK_WINS = '0-1'
+RESULT_DRAW = '1/2-1/2'
+
+
+def parse_engine_spec(spec):
+    """解析 "name=xxx,depth=3,nodes=5000,movetime=0.5,tt=16,book=开局库文件" 形式的引擎配置
+
+    :rtype : dict
+    """
+    config = {'name': spec, 'depth': None, 'nodes': None, 'movetime': None, 'tt': 16, 'book': None}
+    for item in spec.split(','):
+        key, sep, value = item.partition('=')
+        if not sep or key not in config:
+            raise argparse.ArgumentTypeError('invalid engine option: {!r}'.format(item))
+        config[key] = value if key in ('name', 'book') else float(value) if key == 'movetime' else int(value)
+    if config['depth'] is None and config['nodes'] is None and config['movetime'] is None:
+        config['depth'] = 2
+    return config
+
+
+def opening_moves(pair_index, plies, seed):
+    """每两盘棋(交换先后手)共用的随机开局, 由 seed 和 pair_index 决定, 断点续赛时可以重现
+
+    :rtype : list
+    """
+    rng = random.Random('opening:{}:{}'.format(seed, pair_index))
+    arena = gamearena.new_arena_from_fen(gamearena.START_POSITION_FEN)
+    moves = []
+    for _ in range(plies):
+        legal = arena.retrieve_legal_moves_of_player(arena.side_to_move)
+        if not legal:
+            break
+        move = rng.choice(legal)
+        arena.make_move(move)
+        moves.append(move)
+    return moves
+
+
+def is_insufficient_material(arena):
+    """双方只剩王, 或者只多一个马或象"""
+    others = [unit_id for player_id in arena.players for unit_id in arena.units_of_player(player_id)
+              if arena.type_of_unit(unit_id) is not KingUnit]
+    return not others or (len(others) == 1 and arena.type_of_unit(others[0]) in (KnightUnit, BishopUnit))
+
+
+def match_settings(engines, opening_plies, seed, max_plies):
+    """一次比赛的全部设置, 写进每条对局记录; 断点续赛和统计时只使用设置完全相同的记录
+
+    :rtype : dict
+    """
+    return {'engines': [dict(engine) for engine in engines], 'opening_plies': opening_plies, 'seed': seed,
+            'max_plies': max_plies}
+
+
+def matching_records(records, settings):
+    """结果文件中设置与 settings 相同的对局记录(包括双方引擎的名字和全部参数)
+
+    :rtype : list
+    """
+    return [record for record in records if record.get('match') == settings]
+
+
+def play_game(game_index, engines, opening_plies=8, seed=0, max_plies=300):
+    """下一盘棋: 偶数局 engines[0] 执白, 奇数局交换先后手
+
+    :return: 可以直接写成一行 JSON 的对局记录
+    :rtype : dict
+    """
+    started = time.time()
+    white, black = (engines[0], engines[1]) if game_index % 2 == 0 else (engines[1], engines[0])
+    service = GameService([WHITE, BLACK], [white['name'], black['name']])
+    configs = {WHITE: white, BLACK: black}
+    books = {}  # 两个配置使用同一个开局库文件时只打开一次
+    for config in configs.values():
+        if config['book'] and config['book'] not in books:
+            books[config['book']] = gamebook.OpeningBook(config['book'])
+    searchers = {player_id: Searcher(tt_size_mb=config['tt'], book=books.get(config['book']))
+                 for player_id, config in configs.items()}
+    arena = gamearena.new_arena_from_fen(gamearena.START_POSITION_FEN)
+    moves = []
+    for move in opening_moves(game_index // 2, opening_plies, seed):
+        arena.make_move(move)
+        moves.append(gamearena.coordinate_notation(move))
+        service.end_this_turn()
+    seen = {}
+    result = reason = None
+    while result is None:
+        player_id = service.get_current_player_id()
+        assert player_id == arena.side_to_move
+        seen[arena.position_hash] = seen.get(arena.position_hash, 0) + 1
+        if not arena.retrieve_legal_moves_of_player(player_id):
+            if arena.is_in_check(player_id):
+                result, reason = (RESULT_BLACK_WINS if player_id == WHITE else RESULT_WHITE_WINS), 'checkmate'
+            else:
+                result, reason = RESULT_DRAW, 'stalemate'
+        elif seen[arena.position_hash] >= 3:
+            result, reason = RESULT_DRAW, 'repetition'
+        elif arena.halfmove_clock >= 100:
+            result, reason = RESULT_DRAW, 'fifty moves'
+        elif is_insufficient_material(arena):
+            result, reason = RESULT_DRAW, 'insufficient material'
+        elif len(moves) >= max_plies:
+            result, reason = RESULT_DRAW, 'max plies'
+        else:
+            config = configs[player_id]
+            limits = SearchLimits(depth=config['depth'], nodes=config['nodes'], movetime=config['movetime'])
+            move = searchers[player_id].search(arena, limits).move
+            arena.make_move(move)
+            moves.append(gamearena.coordinate_notation(move))
+            service.end_this_turn()
+    for book in books.values():
+        book.close()
+    return {
+        'game': game_index,
+        'white': white['name'],
+        'black': black['name'],
+        'result': result,
+        'reason': reason,
+        'plies': len(moves),
+        'opening_plies': min(opening_plies, len(moves)),
+        'moves': ' '.join(moves),
+        'seconds': round(time.time() - started, 3),
+        'match': match_settings(engines, opening_plies, seed, max_plies),
+    }
+
+
+def _play_game_job(args):
+    return play_game(*args)
+
+
+def read_results(path):
+    """逐行读取结果文件, 忽略被中断时没有写完整的最后一行
+
+    :return: (已完成的对局记录列表, 最后一个完整行末尾的字节偏移)
+    :rtype : tuple
+    """
+    records, valid_bytes = [], 0
+    if not os.path.exists(path):
+        return records, valid_bytes
+    with open(path, 'rb') as f:
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            try:
+                records.append(json.loads(line.decode('utf-8')))
+            except ValueError:
+                break
+            valid_bytes += len(line)
+    return records, valid_bytes
+
+
+def score_of(records, engine_name):
+    """统计 engine_name 的 (胜, 负, 和)
+
+    :rtype : tuple
+    """
+    wins = losses = draws = 0
+    for record in records:
+        if engine_name not in (record['white'], record['black']):
+            continue
+        if record['result'] == RESULT_DRAW:
+            draws += 1
+        elif (record['result'] == RESULT_WHITE_WINS) == (record['white'] == engine_name):
+            wins += 1
+        else:
+            losses += 1
+    return wins, losses, draws
+
+
+def elo_from_score(score):
+    score = min(max(score, 1e-6), 1 - 1e-6)
+    return -400.0 * math.log10(1.0 / score - 1.0) + 0.0  # + 0.0 把 -0.0 变成 0.0
+
+
+def expected_score(elo):
+    return 1.0 / (1.0 + 10.0 ** (-elo / 400.0))
+
+
+def elo_estimate(wins, losses, draws):
+    """Elo 差(正数表示前者更强)及其 95% 置信区间
+
+    :return: (elo, elo 下限, elo 上限), 没有对局或者全部结果相同(方差为 0)时无法估计区间, 下限和上限为 -inf 和 inf
+    :rtype : tuple
+    """
+    games = wins + losses + draws
+    if not games:
+        return 0.0, float('-inf'), float('inf')
+    score = (wins + 0.5 * draws) / games
+    variance = (wins * (1 - score) ** 2 + losses * score ** 2 + draws * (0.5 - score) ** 2) / games
+    if variance == 0:
+        return elo_from_score(score), float('-inf'), float('inf')
+    margin = 1.96 * math.sqrt(variance / games)
+    return elo_from_score(score), elo_from_score(score - margin), elo_from_score(score + margin)
+
+
+def sprt(wins, losses, draws, elo0=0.0, elo1=5.0, alpha=0.05, beta=0.05):
+    """序贯概率比检验(正态近似), H0: Elo 差为 elo0, H1: Elo 差为 elo1
+
+    :return: (对数似然比, 下界, 上界, 结论) 结论为 'H1'(接受改动)、'H0'(拒绝改动) 或者 None(继续比赛)
+    :rtype : tuple
+    """
+    lower, upper = math.log(beta / (1 - alpha)), math.log((1 - beta) / alpha)
+    games = wins + losses + draws
+    llr = 0.0
+    if games:
+        score = (wins + 0.5 * draws) / games
+        variance = (wins * (1 - score) ** 2 + losses * score ** 2 + draws * (0.5 - score) ** 2) / games
+        if variance > 0:
+            s0, s1 = expected_score(elo0), expected_score(elo1)
+            llr = games * (s1 - s0) * (2 * score - s0 - s1) / (2 * variance)
+    verdict = 'H1' if llr >= upper else 'H0' if llr <= lower else None
+    return llr, lower, upper, verdict
+
+
+def report(records, engines, elo0, elo1, log):
+    wins, losses, draws = score_of(records, engines[0]['name'])
+    elo, elo_low, elo_high = elo_estimate(wins, losses, draws)
+    llr, lower, upper, verdict = sprt(wins, losses, draws, elo0, elo1)
+    log.write('{} vs {}: games {} +{} -{} ={}\n'.format(
+        engines[0]['name'], engines[1]['name'], wins + losses + draws, wins, losses, draws))
+    log.write('elo {:+.1f} [{:+.1f}, {:+.1f}] (95%)\n'.format(elo, elo_low, elo_high))
+    log.write('sprt elo0={} elo1={} llr {:.2f} [{:.2f}, {:.2f}] {}\n'.format(
+        elo0, elo1, llr, lower, upper, {'H1': 'H1 accepted', 'H0': 'H0 accepted', None: 'continue'}[verdict]))
+    return verdict
+
+
+def run_tournament(engines, games, out, workers=None, opening_plies=8, seed=0, max_plies=300,
+                   elo0=0.0, elo1=5.0, sprt_stop=False, log=None):
+    """进行比赛并把每盘棋的结果追加到 out 文件, 已经在 out 里的对局不会重下
+
+    :param sprt_stop: 为 True 时 SPRT 得出结论后提前结束比赛
+    :return: SPRT 结论
+    """
+    log = log or sys.stdout
+    settings = match_settings(engines, opening_plies, seed, max_plies)
+    records, valid_bytes = read_results(out)
+    if os.path.exists(out) and os.path.getsize(out) != valid_bytes:
+        with open(out, 'r+b') as f:
+            f.truncate(valid_bytes)  # 去掉被中断时写了一半的行
+    other = len(records)
+    records = matching_records(records, settings)
+    other -= len(records)
+    if other:
+        log.write('ignoring {} games in {} played with other engines or settings\n'.format(other, out))
+    done = set(record['game'] for record in records)
+    pending = [i for i in range(games) if i not in done]
+    if done:
+        log.write('resuming: {} games already in {}, {} to play\n'.format(len(done), out, len(pending)))
+    wins, losses, draws = score_of(records, engines[0]['name'])
+    del records  # 之后只保留胜负和的计数
+    jobs = [(i, engines, opening_plies, seed, max_plies) for i in pending]
+    pool = multiprocessing.Pool(workers or multiprocessing.cpu_count())
+    try:
+        with open(out, 'a') as f:
+            for record in pool.imap_unordered(_play_game_job, jobs):
+                f.write(json.dumps(record, sort_keys=True) + '\n')
+                f.flush()
+                w, l, d = score_of([record], engines[0]['name'])
+                wins, losses, draws = wins + w, losses + l, draws + d
+                log.write('game {} {} vs {}: {} ({}) score +{} -{} ={}\n'.format(
+                    record['game'], record['white'], record['black'], record['result'], record['reason'],
+                    wins, losses, draws))
+                if sprt_stop and sprt(wins, losses, draws, elo0, elo1)[3] is not None:
+                    break
+    finally:
+        pool.terminate()
+        pool.join()
+    records = [record for record in matching_records(read_results(out)[0], settings) if record['game'] < games]
+    return report(records, engines, elo0, elo1, log)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='engine-vs-engine self-play tournament')
+    parser.add_argument('--engine', type=parse_engine_spec, action='append', required=True,
+                        help='name=xxx,depth=N,nodes=N,movetime=SECONDS,tt=MB,book=FILE (give exactly twice)')
+    parser.add_argument('--games', type=int, default=100)
+    parser.add_argument('--out', default='tournament.jsonl', help='JSONL results file, appended to and resumed from')
+    parser.add_argument('--workers', type=int, default=None, help='processes, default: number of CPUs')
+    parser.add_argument('--opening-plies', type=int, default=8, help='random opening plies shared by each game pair')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--max-plies', type=int, default=300, help='adjudicate as a draw after this many plies')
+    parser.add_argument('--elo0', type=float, default=0.0)
+    parser.add_argument('--elo1', type=float, default=5.0)
+    parser.add_argument('--sprt-stop', action='store_true', help='stop as soon as SPRT reaches a verdict')
+    parser.add_argument('--report', action='store_true', help='only print statistics of the results file')
+    args = parser.parse_args()
+    if len(args.engine) != 2:
+        parser.error('exactly two --engine options are required')
+    if len(set(engine['name'] for engine in args.engine)) != 2:
+        parser.error('engine names must differ')
+    if args.report:
+        settings = match_settings(args.engine, args.opening_plies, args.seed, args.max_plies)
+        report(matching_records(read_results(args.out)[0], settings), args.engine, args.elo0, args.elo1, sys.stdout)
+        return
+    run_tournament(args.engine, args.games, args.out, workers=args.workers, opening_plies=args.opening_plies,
+                   seed=args.seed, max_plies=args.max_plies, elo0=args.elo0, elo1=args.elo1,
+                   sprt_stop=args.sprt_stop)
+
+
+if '__main__' == __name__:
+    main()
@@ -0,0 +1,189 @@
+# coding=utf-8
+"""固定内存大小的置换表(transposition table), 以 GameArena.position_hash 为键
+
+所有条目连续存放在一个 64 位无符号整数数组里, 不为每个条目创建 Python 对象.
+每个桶(bucket)有两个条目: 第一个条目优先保留搜索深度大的结果, 第二个条目总是被新结果覆盖.
+"""
+import array
+
+from gamearena import Move, Square
+
+BOUND_NONE = 0
+BOUND_EXACT = 1  # 分值是精确值
+BOUND_LOWER = 2  # 分值是下界(发生了 beta 截断)
+BOUND_UPPER = 3  # 分值是上界(没有走法超过 alpha)
+
+ENTRY_WORDS = 3  # 每个条目 3 个 64 位整数: 校验值、走法、分值/深度/类型/代数
+BUCKET_ENTRIES = 2
+BUCKET_WORDS = ENTRY_WORDS * BUCKET_ENTRIES
+WORD_BYTES = 8
+
+MASK64 = (1 << 64) - 1
+
+
+def _word_typecode():
+    """8 字节无符号整数的 array 类型码: Python 3 为 'Q'; Python 2.7 的 array 没有 'Q', LP64 平台上 'L' 是 8 字节.
+    都不是 8 字节时(例如 Windows 上的 Python 2.7)返回 None
+
+    :rtype : str
+    """
+    for typecode in ('Q', 'L'):
+        try:
+            if array.array(typecode).itemsize == WORD_BYTES:
+                return typecode
+        except ValueError:  # bad typecode
+            continue
+    return None
+
+
+WORD_TYPECODE = _word_typecode()
+SCORE_OFFSET = 1 << 31
+
+
+def encode_move(move, width):
+    """把 Move 压缩成一个整数: 起点编号 24 位, 终点编号 24 位, 标志位 16 位. 0 表示没有走法
+
+    :param width: 棋盘宽度, 格子编号为 y*width+x
+    :rtype : int
+    """
+    if move is None:
+        return 0
+    origin, destination, flags = move
+    return (origin[1] * width + origin[0]) | (destination[1] * width + destination[0]) << 24 | flags << 48
+
+
+def decode_move(code, width):
+    """encode_move() 的逆运算
+
+    :rtype : Move
+    """
+    if not code:
+        return None
+    origin = code & 0xffffff
+    destination = code >> 24 & 0xffffff
+    return Move(Square(origin % width, origin // width), Square(destination % width, destination // width), code >> 48)
+
+
+class TranspositionTable(object):
+    """按 MB 指定内存上限的置换表
+
+    条目的校验值是 key ^ 走法 ^ 分值信息, 读取时三者异或还原出 key 才算命中,
+    这样多个进程共享同一块内存(见 buffer 参数)并发写入时, 被写坏的条目只会被当作未命中
+    """
+
+    def __init__(self, size_mb, buffer=None):
+        """
+        :param size_mb: 内存上限(MB)
+        :param buffer: 可选, 支持缓冲区协议的外部内存(例如 multiprocessing.shared_memory.SharedMemory.buf),
+                       为 None 时自行分配
+        """
+        bucket_bytes = BUCKET_WORDS * WORD_BYTES
+        self.bucket_count = max(1, int(size_mb * 1024 * 1024) // bucket_bytes)
+        words = self.bucket_count * BUCKET_WORDS
+        if buffer is None:
+            if WORD_TYPECODE is not None:
+                self.__table = array.array(WORD_TYPECODE, [0]) * words
+            else:
+                self.__table = [0] * words  # 没有 8 字节的类型码, 退回到普通列表, 读写方式相同, 只是占用更多内存
+        else:
+            if len(buffer) < words * WORD_BYTES:
+                raise ValueError('buffer too small: {} < {} bytes'.format(len(buffer), words * WORD_BYTES))
+            self.__table = memoryview(buffer).cast('B')[:words * WORD_BYTES].cast('Q')
+        self.__age = 0
+
+    @staticmethod
+    def bytes_needed(size_mb):
+        """与 size_mb 对应的表实际占用的字节数, 用于事先分配共享内存
+
+        :rtype : int
+        """
+        bucket_bytes = BUCKET_WORDS * WORD_BYTES
+        return max(1, int(size_mb * 1024 * 1024) // bucket_bytes) * bucket_bytes
+
+    def new_search(self):
+        """开始新一轮搜索, 旧一轮留下的条目在替换时优先被覆盖"""
+        self.__age = (self.__age + 1) & 0xff
+
+    def clear(self):
+        table = self.__table
+        for i in range(len(table)):
+            table[i] = 0
+        self.__age = 0
+
+    def probe(self, key):
+        """查表
+
+        :param key: 64 位局面哈希
+        :return: (depth, score, bound, move_code), 未命中时返回 None
+        :rtype : tuple
+        """
+        table = self.__table
+        base = key % self.bucket_count * BUCKET_WORDS
+        for i in range(base, base + BUCKET_WORDS, ENTRY_WORDS):
+            move_code, info = table[i + 1], table[i + 2]
+            if table[i] ^ move_code ^ info == key and info:
+                return info >> 32 & 0xffff, (info & 0xffffffff) - SCORE_OFFSET, info >> 48 & 0xff, move_code
+        return None
+
+    def store(self, key, depth, score, bound, move_code):
+        """写入一条搜索结果
+
+        :param key: 64 位局面哈希
+        :param depth: 剩余搜索深度(0~65535)
+        :param score: 分值(32 位有符号整数)
+        :param bound: BOUND_EXACT / BOUND_LOWER / BOUND_UPPER
+        :param move_code: encode_move() 的结果, 0 表示没有走法
+        """
+        table = self.__table
+        base = key % self.bucket_count * BUCKET_WORDS
+        info = (score + SCORE_OFFSET) & 0xffffffff | depth << 32 | bound << 48 | self.__age << 56
+        slot = base + ENTRY_WORDS  # 默认写入总是被覆盖的条目
+        old_move, old_info = table[base + 1], table[base + 2]
+        same_key = table[base] ^ old_move ^ old_info == key
+        if same_key or depth >= (old_info >> 32 & 0xffff) or (old_info >> 56) != self.__age:
+            slot = base  # 深度优先条目: 同一局面、更深的搜索结果或者上一轮搜索的残留条目可以覆盖
+            if same_key and not move_code:
+                move_code = old_move  # 保留原来的最佳走法
+        table[slot + 1] = move_code
+        table[slot + 2] = info
+        table[slot] = key ^ move_code ^ info
+
+    def hashfull(self):
+        """抽样估计当前一轮搜索写入的条目占比(千分比)
+
+        :rtype : int
+        """
+        table = self.__table
+        samples = min(1000, self.bucket_count)
+        used = 0
+        for bucket in range(samples):
+            for i in range(bucket * BUCKET_WORDS, (bucket + 1) * BUCKET_WORDS, ENTRY_WORDS):
+                if table[i + 2] and table[i + 2] >> 56 == self.__age:
+                    used += 1
+        return used * 1000 // (samples * BUCKET_ENTRIES)
+
+
+def do_self_test():
+    """以下为模块自测试代码"""
+    import sys
+    log = sys.stdout
+    log.write('Module:{}\n'.format(__name__))
+    tt = TranspositionTable(size_mb=1)
+    log.write('buckets:{} bytes:{}\n'.format(tt.bucket_count, TranspositionTable.bytes_needed(1)))
+    move = Move(Square(4, 1), Square(4, 3), 0x02)
+    tt.store(0x123456789abcdef, depth=5, score=-37, bound=BOUND_LOWER, move_code=encode_move(move, 8))
+    depth, score, bound, move_code = tt.probe(0x123456789abcdef)
+    assert (depth, score, bound, decode_move(move_code, 8)) == (5, -37, BOUND_LOWER, move)
+    assert tt.probe(0x123456789abcdee) is None
+    # 同一个桶里深度小的结果写入总是被覆盖的条目, 不会挤掉深度大的结果
+    other = 0x123456789abcdef + tt.bucket_count
+    tt.store(other, depth=1, score=10, bound=BOUND_EXACT, move_code=0)
+    assert tt.probe(0x123456789abcdef)[0] == 5 and tt.probe(other)[1] == 10
+    # 最高位为 1 的 64 位键(Python 2.7 上表为 array('L'))
+    tt.store(MASK64, depth=2, score=3, bound=BOUND_UPPER, move_code=encode_move(move, 8))
+    assert tt.probe(MASK64)[:3] == (2, 3, BOUND_UPPER)
+    log.write('hashfull:{}\n'.format(tt.hashfull()))
+
+
+if '__main__' == __name__:
+    do_self_test()